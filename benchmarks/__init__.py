@@ -0,0 +1,3 @@
+"""
+Benchmarks of the kahi orchestrator with synthetic plugins, see benchmarks/README.md
+"""
@@ -0,0 +1,21 @@
+from kahi.KahiBase import KahiBase
+import asyncio
+
+
+class Kahi_bench_aio(KahiBase):
+    """
+    I/O-bound async plugin, waits in run_async so the async steps overlap
+
+    Parameters of the step:
+        seconds: seconds to wait, default 0.1
+    """
+
+    config = {}
+
+    def __init__(self, config):
+        self.config = config
+        self.params = config["bench_aio"]
+
+    async def run_async(self):
+        await asyncio.sleep(float(self.params.get("seconds", 0.1)))
+        return 0
@@ -0,0 +1,6 @@
+# flake8: noqa
+__version__ = '0.0.1'
+
+
+def get_version():
+    return __version__
@@ -0,0 +1,28 @@
+from kahi.KahiBase import KahiBase
+
+
+class Kahi_bench_bulk(KahiBase):
+    """
+    Plugin that inserts synthetic documents with a BulkWriter into the
+    collection bench_<task> of database_name
+
+    Parameters of the step:
+        documents: number of documents, default 10000
+        document_size: bytes of the text field of every document, default 200
+        batch_size: batch size of the BulkWriter, default 1000
+    """
+
+    config = {}
+
+    def __init__(self, config):
+        self.config = config
+        self.params = config["bench_bulk"]
+
+    def run(self):
+        documents = int(self.params.get("documents", 10000))
+        text = "x" * int(self.params.get("document_size", 200))
+        collection = "bench_{}".format(self.params.get("task") or "bulk")
+        with self.bulk_writer(collection, batch_size=int(self.params.get("batch_size", 1000))) as writer:
+            for i in range(documents):
+                writer.insert({"number": i, "text": text, "step": self.log_id})
+        return 0
@@ -0,0 +1,23 @@
+from kahi.KahiBase import KahiBase
+from hashlib import sha256
+
+
+class Kahi_bench_cpu(KahiBase):
+    """
+    CPU-bound plugin, hashes a buffer iterations times
+
+    Parameters of the step:
+        iterations: number of sha256 of a 1 KB buffer, default 20000
+    """
+
+    config = {}
+
+    def __init__(self, config):
+        self.config = config
+        self.params = config["bench_cpu"]
+
+    def run(self):
+        digest = b"\0" * 1024
+        for _ in range(int(self.params.get("iterations", 20000))):
+            digest = sha256(digest).digest() * 32
+        return 0
@@ -0,0 +1,21 @@
+from kahi.KahiBase import KahiBase
+from time import sleep
+
+
+class Kahi_bench_io(KahiBase):
+    """
+    I/O-bound plugin, waits as if it were reading from a remote service
+
+    Parameters of the step:
+        seconds: seconds to wait, default 0.1
+    """
+
+    config = {}
+
+    def __init__(self, config):
+        self.config = config
+        self.params = config["bench_io"]
+
+    def run(self):
+        sleep(float(self.params.get("seconds", 0.1)))
+        return 0
@@ -0,0 +1,15 @@
+from kahi.KahiBase import KahiBase
+
+
+class Kahi_bench_noop(KahiBase):
+    """
+    Plugin that does nothing, measures the overhead of kahi for a step
+    """
+
+    config = {}
+
+    def __init__(self, config):
+        self.config = config
+
+    def run(self):
+        return 0
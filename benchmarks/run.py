@@ -0,0 +1,300 @@
+"""
+Runs the benchmarks of the kahi orchestrator with the synthetic plugins and saves
+the results in a JSON file, see benchmarks/README.md
+
+Example:
+    python -m benchmarks.run --steps 200 --workloads noop,cpu --modes inline,pool --workers 4 --output results.json
+"""
+from benchmarks.workloads import plugins_directory, workloads, generate_workflow, write_workflow
+from time import time
+import multiprocessing
+import statistics
+import subprocess
+import platform
+import argparse
+import tempfile
+import resource
+import json
+import sys
+import os
+
+modes = ("inline", "pool", "isolation", "distributed")
+
+# modes that run all the steps in the benchmark process or in processes forked from it
+in_process_modes = ("inline", "pool")
+
+
+def setup(use_mongomock=False):
+    """
+    Puts the synthetic plugins in the path of this process and of the processes it starts,
+    and replaces MongoClient with mongomock if use_mongomock is True
+    """
+    if plugins_directory not in sys.path:
+        sys.path.insert(0, plugins_directory)
+    os.environ["PYTHONPATH"] = os.pathsep.join(
+        path for path in (plugins_directory, os.environ.get("PYTHONPATH")) if path)
+    if use_mongomock:
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit("mongomock is not installed.\nTry\n\tpip install kahi[bench]")
+        import pymongo
+        if pymongo.version_tuple[:2] >= (4, 11):
+            # the bulk updates of pymongo 4.11 pass sort, mongomock does not accept it
+            raise SystemExit("mongomock does not work with pymongo {}.\nTry\n\tpip install kahi[bench]".format(
+                pymongo.version))
+        import kahi.ClientManager
+        kahi.ClientManager.MongoClient = mongomock.MongoClient
+
+
+def mode_config(mode, workers, start_method="forkserver"):
+    """
+    Returns the config keys of a scheduling mode
+    """
+    if mode == "inline":
+        return {"max_workers": 1}
+    if mode == "pool":
+        return {"max_workers": workers}
+    if mode == "isolation":
+        return {"max_workers": workers, "isolation": {"start_method": start_method}}
+    if mode == "distributed":
+        return {"max_workers": workers, "distributed": {"lease": 60, "poll_interval": 0.1}}
+    raise ValueError("Unknown mode {}, available: {}".format(mode, ", ".join(modes)))
+
+
+def environment(use_mongomock):
+    """
+    Returns the description of the machine and the versions, to compare results
+    """
+    import kahi._version
+    import pymongo
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "kahi": kahi._version.get_version(),
+        "pymongo": pymongo.version,
+        "database": "mongomock" if use_mongomock else "mongod",
+        "commit": commit
+    }
+
+
+def peak_rss():
+    """
+    Returns the maximum resident memory in MB of this process and of its largest finished child
+    """
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+def clear(config):
+    """
+    Drops the log collection, the job queue and the database of the bulk plugin,
+    so every run executes all the steps
+    """
+    from kahi.ClientManager import ClientManager
+    client = ClientManager.default().get_client(config["database_url"])
+    client[config["log_database"]].drop_collection(config["log_collection"])
+    client[config["log_database"]].drop_collection(config["log_collection"] + "_queue")
+    client.drop_database(config["database_name"])
+
+
+def work(workflow_path):
+    """
+    Entry point of the worker processes of the distributed mode
+    """
+    setup()
+    from kahi.Kahi import Kahi
+    Kahi(workflow_path).work()
+
+
+def run_workflow(workflow_path, config, mode, workers, use_log):
+    """
+    Runs a workflow and returns the wall time and the metrics of its steps
+    """
+    from kahi.Kahi import Kahi
+    clear(config)
+    processes = []
+    if mode == "distributed":
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=work, args=(workflow_path,), daemon=True)
+                     for _ in range(workers)]
+        for process in processes:
+            process.start()
+    kahi = Kahi(workflow_path, verbose=0, use_log=use_log)
+    try:
+        time_start = time()
+        kahi.run()
+        wall_time = time() - time_start
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+    return wall_time, kahi.metrics
+
+
+def run_case(args, mode, workload_names, directory):
+    """
+    Runs args.repeat times the workflow of a mode and workloads and returns the summary
+    """
+    config = {
+        "database_url": args.database_url,
+        "database_name": "kahi_bench",
+        "log_database": "kahi_bench_log",
+        "log_collection": "log"
+    }
+    config.update(mode_config(mode, args.workers, args.start_method))
+    data = generate_workflow(args.steps, workload_names, args.tasks_per_plugin,
+                             args.dependencies, config=config)
+    workflow_path = write_workflow(os.path.join(
+        directory, "{}_{}.yml".format(mode, "_".join(workload_names))), data)
+
+    runs = []
+    for _ in range(args.repeat):
+        wall_time, metrics = run_workflow(workflow_path, config, mode, args.workers, not args.no_log)
+        if len(metrics) != args.steps:
+            raise RuntimeError("{} of {} steps ran in mode {}".format(len(metrics), args.steps, mode))
+        step_time = sum(step["wall_time"] for step in metrics.values())
+        # steps running at the same time, the overhead is the time not explained by them
+        parallelism = 1 if mode == "inline" or args.dependencies == "chain" else min(args.workers, args.steps)
+        runs.append({
+            "wall_time": wall_time,
+            "steps_per_second": args.steps / wall_time,
+            "step_time": step_time,
+            "overhead_per_step": max(0.0, wall_time - step_time / parallelism) / args.steps,
+            "step_max_rss_mb": max(step["process_max_rss_mb"] for step in metrics.values())
+        })
+    rss, children_rss = peak_rss()
+    result = {
+        "mode": mode,
+        "workloads": list(workload_names),
+        "steps": args.steps,
+        "workers": args.workers if mode != "inline" else 1,
+        "dependencies": args.dependencies,
+        "tasks_per_plugin": args.tasks_per_plugin,
+        "log": not args.no_log,
+        "repeat": args.repeat,
+        "runs": runs,
+        "max_rss_mb": rss,
+        "children_max_rss_mb": children_rss
+    }
+    # median of the runs
+    for name in runs[0].keys():
+        result[name] = statistics.median(run[name] for run in runs)
+    return result
+
+
+def micro_benchmarks(args):
+    """
+    Measures the parts of the orchestrator without running plugins:
+    building the DAG, creating plugin instances and writing the log
+    """
+    from kahi.Scheduler import Scheduler
+    from kahi.Kahi import PluginRun
+    from kahi.StepConfig import StepConfig
+    from kahi.LogWriter import LogWriter
+    from kahi.ClientManager import ClientManager
+    results = {}
+
+    data = generate_workflow(args.steps, ("noop",), args.tasks_per_plugin, args.dependencies)
+    time_start = time()
+    scheduler = Scheduler(data["workflow"], max_workers=args.workers, fan_out=True)
+    scheduler.order()
+    results["scheduler_build_seconds"] = time() - time_start
+
+    step = StepConfig.build({"database_url": args.database_url}, {"bench_noop": {}}, "bench_noop")
+    PluginRun("kahi_", step)
+    count = 1000
+    time_start = time()
+    for _ in range(count):
+        PluginRun("kahi_", step)
+    results["plugin_construction_seconds"] = (time() - time_start) / count
+
+    collection = ClientManager.default().get_client(args.database_url)["kahi_bench_log"]["micro_log"]
+    collection.drop()
+    writer = LogWriter(collection, heartbeat_interval=0)
+    time_start = time()
+    for i in range(args.steps):
+        writer.started("step{}".format(i), {"status": -1, "message": "running"})
+        writer.finished("step{}".format(i), {"status": 0, "message": "ok"})
+    writer.close()
+    results["log_entries_per_second"] = args.steps / (time() - time_start)
+    collection.drop()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the kahi orchestrator with synthetic plugins.')
+    parser.add_argument('--steps', type=int, default=200,
+                        help='number of steps of the generated workflows')
+    parser.add_argument('--tasks_per_plugin', type=int, default=10,
+                        help='consecutive plugin/task entries of the same plugin')
+    parser.add_argument('--workloads', type=str, default="noop",
+                        help='comma separated workloads of the steps: ' + ", ".join(workloads))
+    parser.add_argument('--mix', action='store_true',
+                        help='run all the workloads in one workflow instead of one workflow per workload')
+    parser.add_argument('--modes', type=str, default="inline,pool",
+                        help='comma separated scheduling modes: ' + ", ".join(modes))
+    parser.add_argument('--workers', type=int, default=4,
+                        help='max_workers of the parallel modes')
+    parser.add_argument('--dependencies', type=str, default="independent",
+                        help='chain or independent steps')
+    parser.add_argument('--start_method', type=str, default="forkserver",
+                        help='start method of the isolation mode')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of every case, the results are the median')
+    parser.add_argument('--database_url', type=str, default="localhost:27017",
+                        help='mongodb url, the benchmark drops the databases kahi_bench and kahi_bench_log')
+    parser.add_argument('--mongomock', action='store_true',
+                        help='use mongomock instead of a mongod, only for the inline and pool modes')
+    parser.add_argument('--no_log', action='store_true',
+                        help='run the workflows without log')
+    parser.add_argument('--micro', action='store_true',
+                        help='also measure the DAG build, the plugin construction and the log writes')
+    parser.add_argument('--output', type=str, default=None,
+                        help='JSON file with the results')
+    args = parser.parse_args(argv)
+
+    setup(args.mongomock)
+    selected_modes = [mode for mode in args.modes.split(",") if mode]
+    for mode in selected_modes:
+        mode_config(mode, args.workers)
+        if args.mongomock and mode not in in_process_modes:
+            raise SystemExit("Mode {} needs a mongod, mongomock only works in the modes {}".format(
+                mode, ", ".join(in_process_modes)))
+    workload_names = [name for name in args.workloads.split(",") if name]
+    cases = [workload_names] if args.mix else [[name] for name in workload_names]
+
+    results = {
+        "environment": environment(args.mongomock),
+        "time": time(),
+        "cases": []
+    }
+    with tempfile.TemporaryDirectory(prefix="kahi_bench_") as directory:
+        for mode in selected_modes:
+            for names in cases:
+                result = run_case(args, mode, names, directory)
+                results["cases"].append(result)
+                print("{:12} {:20} {:8.2f} s  {:9.1f} steps/s  {:8.2f} ms overhead/step  {:8.1f} MB".format(
+                    mode, ",".join(names), result["wall_time"], result["steps_per_second"],
+                    1000 * result["overhead_per_step"], result["max_rss_mb"]))
+    if args.micro:
+        results["micro"] = micro_benchmarks(args)
+        for name, value in results["micro"].items():
+            print("{:30} {:.6g}".format(name, value))
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(results, stream, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
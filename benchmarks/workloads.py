@@ -0,0 +1,65 @@
+from collections import OrderedDict
+import yaml
+import os
+
+# directory with the synthetic plugins, kahi_bench_<workload>
+plugins_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plugins")
+
+workloads = ("noop", "cpu", "io", "aio", "bulk")
+
+default_parameters = {
+    "noop": {},
+    "cpu": {"iterations": 20000},
+    "io": {"seconds": 0.1},
+    "aio": {"seconds": 0.1},
+    "bulk": {"documents": 10000, "document_size": 200, "batch_size": 1000}
+}
+
+
+def generate_workflow(steps, workload_names=("noop",), tasks_per_plugin=10, dependencies="chain",
+                      parameters=None, config=None):
+    """
+    Returns a workflow with steps plugin/task entries of the synthetic plugins,
+    groups of tasks_per_plugin consecutive tasks of the same plugin, cycling through
+    the workloads.
+
+    Parameters:
+    ____________
+    steps:int
+        number of entries of the workflow
+    workload_names:list
+        workloads of the entries, see workloads
+    tasks_per_plugin:int
+        number of consecutive tasks of the same plugin
+    dependencies:str
+        chain: every step depends on the previous one,
+        independent: no dependencies (depends_on: [])
+    parameters:dict
+        parameters of the steps by workload, default default_parameters
+    config:dict
+        config section of the workflow
+    """
+    if dependencies not in ("chain", "independent"):
+        raise ValueError("Unknown dependencies {}, use chain or independent".format(dependencies))
+    for name in workload_names:
+        if name not in workloads:
+            raise ValueError("Unknown workload {}, available: {}".format(name, ", ".join(workloads)))
+    parameters = parameters or default_parameters
+    workflow = OrderedDict()
+    for i in range(steps):
+        name = workload_names[(i // max(1, tasks_per_plugin)) % len(workload_names)]
+        params = dict(parameters.get(name, {}))
+        if dependencies == "independent":
+            params["depends_on"] = []
+        workflow["bench_{}/t{}".format(name, i)] = params
+    return {"config": dict(config or {}), "workflow": workflow}
+
+
+def write_workflow(path, data):
+    """
+    Saves the workflow in a yaml file, keeping the order of the steps
+    """
+    document = {"config": data["config"], "workflow": dict(data["workflow"])}
+    with open(path, "w") as stream:
+        yaml.safe_dump(document, stream, sort_keys=False, default_flow_style=False)
+    return path
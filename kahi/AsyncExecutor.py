@@ -0,0 +1,53 @@
+from concurrent.futures import wait as wait_futures
+from kahi.ClientManager import ClientManager
+import threading
+import inspect
+import asyncio
+
+
+class AsyncExecutor:
+    """
+    Executor that runs the submitted coroutine functions in an event loop of a background
+    thread, so several async steps run concurrently in the process of kahi and overlap
+    their I/O. The other callables are passed to executor.
+    """
+
+    def __init__(self, executor):
+        """
+        Parameters:
+        ____________
+        executor:executor
+            executor of the synchronous steps
+        """
+        self.executor = executor
+        self.futures = set()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="kahi-event-loop", daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        if inspect.iscoroutinefunction(fn):
+            future = asyncio.run_coroutine_threadsafe(fn(*args, **kwargs), self.loop)
+            self.futures.add(future)
+            future.add_done_callback(self.futures.discard)
+            return future
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        """
+        Shuts down the executor of the synchronous steps, waits for the async steps
+        or cancels them, and closes the async clients and the event loop.
+        """
+        self.executor.shutdown(wait=wait)
+        futures = list(self.futures)
+        if not wait:
+            for future in futures:
+                future.cancel()
+        if futures:
+            wait_futures(futures)
+        asyncio.run_coroutine_threadsafe(
+            ClientManager.default().close_async(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -0,0 +1,359 @@
+from collections import defaultdict
+import unicodedata
+import zlib
+import re
+
+separators = re.compile(r"[^a-z0-9]+")
+
+# spellings that sound the same in spanish names, applied in order
+phonetic_rules = [(re.compile(pattern), replacement) for pattern, replacement in (
+    (r"ph", "f"),
+    (r"qu", "k"),
+    (r"ch", "0"),
+    (r"ll", "y"),
+    (r"c(?=[ei])", "s"),
+    (r"g(?=[ei])", "j"),
+    (r"[cq]", "k"),
+    (r"z", "s"),
+    (r"v", "b"),
+    (r"w", "u"),
+    (r"h", ""),
+    (r"(.)\1+", r"\1")
+)]
+
+block_kinds = ("tokens", "initials", "phonetic", "ngrams")
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ModuleNotFoundError(
+            "BlockingIndex needs numpy.\nTry\n\tpip install kahi[blocking]")
+    return numpy
+
+
+def normalize_name(name):
+    """
+    Returns the name in lowercase without accents and punctuation, ex: "Pérez-Gómez, J." -> "perez gomez j"
+    """
+    name = unicodedata.normalize("NFKD", str(name))
+    name = "".join(char for char in name if not unicodedata.combining(char)).lower()
+    return " ".join(separators.sub(" ", name).split())
+
+
+def phonetic_key(token, length=6):
+    """
+    Returns a phonetic key of a normalized token: the first letter and the consonants
+    after applying the rules of phonetic_rules, ex: "gonzalez" and "gonsales" -> "gnsls"
+    """
+    for pattern, replacement in phonetic_rules:
+        token = pattern.sub(replacement, token)
+    if not token:
+        return ""
+    return (token[0] + re.sub(r"[aeiouy]", "", token[1:]))[:length]
+
+
+class BlockingIndex:
+    """
+    In-memory index of names to find the candidates of a name without comparing it with all
+    the records, for the disambiguation of persons, affiliations and other entities.
+
+    Every record has one or more names (full name, aliases...), normalized without accents,
+    case and punctuation. The names are grouped in blocks by their keys:
+        tokens: every word of the name, ex: perez
+        initials: every word with the initial of another one, in any order, ex: perez j
+        phonetic: the phonetic key of every word, ex: prs
+        ngrams: the character n-grams of the words, high recall but bigger blocks
+    The candidates of a name are the records that share a block with it, the blocks with more
+    than max_block_size names (common words) are ignored, and they are scored in batch with
+    NumPy by the cosine similarity of the hashed character n-grams of the names.
+
+    Example:
+        index = self.blocking_index()
+        for person in collection.find({}, {"full_name": 1, "aliases": 1, "first_names": 1, "last_names": 1}):
+            index.add_person(person)
+        matches = index.query_batch(names, threshold=0.7, limit=5)
+    """
+
+    def __init__(self, blocks=("tokens", "initials", "phonetic"), ngram=3, dim=2 ** 14,
+                 max_block_size=10000, max_candidates=1000, batch_size=512):
+        """
+        Parameters:
+        ____________
+        blocks:tuple
+            kinds of blocks: tokens, initials, phonetic, ngrams
+        ngram:int
+            size of the character n-grams of the scores and of the ngrams blocks
+        dim:int
+            size of the hashed n-gram vectors
+        max_block_size:int
+            blocks with more names are not used to find candidates
+        max_candidates:int
+            maximum number of names scored per query, the ones sharing more blocks
+        batch_size:int
+            number of queries scored at once
+        """
+        unknown = set(blocks) - set(block_kinds)
+        if unknown:
+            raise ValueError("Unknown blocks {}, available: {}".format(
+                ", ".join(sorted(unknown)), ", ".join(block_kinds)))
+        self.np = import_numpy()
+        self.block_kinds = tuple(blocks)
+        self.ngram = ngram
+        self.dim = dim
+        self.max_block_size = max_block_size
+        self.max_candidates = max_candidates
+        self.batch_size = batch_size
+
+        self.ids = []
+        self.record_index = {}
+        # every name of a record is an entry of the index
+        self.entry_records = []
+        self.entry_names = []
+        self.entry_grams = []
+        self.blocks = defaultdict(list)
+        # n-gram hashes and phonetic keys of the words, names repeat a lot of them
+        self.token_grams = {}
+        self.token_phonetic = {}
+        # arrays built from the lists when the index is queried
+        self.arrays = None
+
+    def grams(self, name):
+        """
+        Returns the sorted unique hashes of the character n-grams of the words of a normalized name
+        """
+        hashes = set()
+        for token in name.split():
+            token_hashes = self.token_grams.get(token)
+            if token_hashes is None:
+                padded = "#" + token + "#"
+                token_hashes = tuple(set(
+                    zlib.crc32(padded[i:i + self.ngram].encode()) % self.dim
+                    for i in range(max(1, len(padded) - self.ngram + 1))))
+                self.token_grams[token] = token_hashes
+            hashes.update(token_hashes)
+        return sorted(hashes)
+
+    def keys(self, name):
+        """
+        Returns the keys of the blocks of a normalized name
+        """
+        tokens = name.split()
+        words = [token for token in tokens if len(token) > 1]
+        keys = set()
+        if "tokens" in self.block_kinds:
+            keys.update("t:" + word for word in words)
+        if "initials" in self.block_kinds:
+            keys.update("i:{} {}".format(word, other[0])
+                        for word in words for other in tokens if other is not word)
+        if "phonetic" in self.block_kinds:
+            for word in words:
+                key = self.token_phonetic.get(word)
+                if key is None:
+                    key = self.token_phonetic[word] = phonetic_key(word)
+                if key:
+                    keys.add("p:" + key)
+        if "ngrams" in self.block_kinds:
+            for word in words:
+                padded = "#" + word + "#"
+                keys.update("g:" + padded[i:i + self.ngram] for i in range(max(1, len(padded) - self.ngram + 1)))
+        return keys
+
+    def add(self, record_id, names):
+        """
+        Adds the names of a record
+
+        Parameters:
+        ____________
+        record_id:object
+            id returned in the results, ex: the _id of the document
+        names:str or list
+            name or names of the record
+        """
+        if isinstance(names, str):
+            names = [names]
+        record = self.record_index.get(record_id)
+        if record is None:
+            record = len(self.ids)
+            self.record_index[record_id] = record
+            self.ids.append(record_id)
+        for name in set(normalize_name(name) for name in names if name):
+            if not name:
+                continue
+            entry = len(self.entry_names)
+            self.entry_records.append(record)
+            self.entry_names.append(name)
+            self.entry_grams.append(self.grams(name))
+            for key in self.keys(name):
+                self.blocks[key].append(entry)
+        self.arrays = None
+
+    def add_many(self, records):
+        """
+        Adds an iterable of (record_id, names)
+        """
+        for record_id, names in records:
+            self.add(record_id, names)
+
+    @staticmethod
+    def person_names(person):
+        """
+        Returns the names of a document with the fields of empty_person
+        """
+        names = [person.get("full_name")] + list(person.get("aliases") or [])
+        parts = list(person.get("first_names") or []) + list(person.get("last_names") or [])
+        if parts:
+            names.append(" ".join(parts))
+        return [name for name in names if name]
+
+    @staticmethod
+    def affiliation_names(affiliation):
+        """
+        Returns the names of a document with the fields of empty_affiliation
+        """
+        names = [name.get("name") if isinstance(name, dict) else name
+                 for name in affiliation.get("names") or []]
+        names.extend(affiliation.get("aliases") or [])
+        names.extend(affiliation.get("abbreviations") or [])
+        return [name for name in names if name]
+
+    def add_person(self, person):
+        self.add(person["_id"], self.person_names(person))
+
+    def add_affiliation(self, affiliation):
+        self.add(affiliation["_id"], self.affiliation_names(affiliation))
+
+    def build(self):
+        """
+        Builds the arrays of the index, called by the queries after the names are added
+        """
+        np = self.np
+        lengths = np.array([len(grams) for grams in self.entry_grams], dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        grams = np.fromiter((gram for entry in self.entry_grams for gram in entry),
+                            dtype=np.int64, count=int(offsets[-1]))
+        self.arrays = {
+            "offsets": offsets,
+            "grams": grams,
+            "norms": np.sqrt(np.maximum(lengths, 1)),
+            "records": np.array(self.entry_records, dtype=np.int64),
+            "blocks": {key: np.array(entries, dtype=np.int64) for key, entries in self.blocks.items()
+                       if len(entries) <= self.max_block_size}
+        }
+        return self.arrays
+
+    def candidates(self, name):
+        """
+        Returns the entries that share a block with a normalized name,
+        at most max_candidates, the ones that share more blocks first
+        """
+        np = self.np
+        blocks = self.arrays["blocks"]
+        postings = [blocks[key] for key in self.keys(name) if key in blocks]
+        if not postings:
+            return np.zeros(0, dtype=np.int64)
+        entries, counts = np.unique(np.concatenate(postings), return_counts=True)
+        if len(entries) > self.max_candidates:
+            entries = entries[np.argpartition(-counts, self.max_candidates - 1)[:self.max_candidates]]
+        return entries
+
+    def scores(self, queries, query_norms, pair_queries, pair_entries):
+        """
+        Returns the cosine similarity of the pairs of queries and entries
+
+        Parameters:
+        ____________
+        queries:numpy.ndarray
+            dense binary matrix of the hashed n-grams of the queries
+        query_norms:numpy.ndarray
+            norms of the queries
+        pair_queries:numpy.ndarray
+            row in queries of every pair
+        pair_entries:numpy.ndarray
+            entry of every pair
+        """
+        np = self.np
+        offsets = self.arrays["offsets"]
+        starts = offsets[pair_entries]
+        lengths = offsets[pair_entries + 1] - starts
+        # positions of the n-grams of all the entries of the pairs, one after the other
+        pair_index = np.repeat(np.arange(len(pair_entries)), lengths)
+        positions = np.arange(int(lengths.sum())) - np.repeat(np.cumsum(lengths) - lengths, lengths) \
+            + np.repeat(starts, lengths)
+        shared = queries[pair_queries[pair_index], self.arrays["grams"][positions]]
+        dot = np.bincount(pair_index, weights=shared, minlength=len(pair_entries))
+        return dot / (query_norms[pair_queries] * self.arrays["norms"][pair_entries])
+
+    def query_batch(self, names, threshold=0.0, limit=10):
+        """
+        Returns the records most similar to every query
+
+        Parameters:
+        ____________
+        names:list
+            queries, every one a name or a list of names of the same entity
+        threshold:float
+            minimum score of the results, between 0 and 1
+        limit:int
+            maximum number of results per query, None for all
+
+        Returns:
+        ____________
+        list with a list of (record_id, score) per query, the best first
+        """
+        np = self.np
+        if self.arrays is None:
+            self.build()
+        results = []
+        for start in range(0, len(names), self.batch_size):
+            batch = names[start:start + self.batch_size]
+            rows = []
+            for query, query_names in enumerate(batch):
+                if isinstance(query_names, str):
+                    query_names = [query_names]
+                rows.extend((query, name) for name in set(map(normalize_name, query_names)) if name)
+            matrix = np.zeros((len(rows), self.dim), dtype=np.uint8)
+            norms = np.ones(len(rows))
+            pair_queries = []
+            pair_entries = []
+            for row, (_, name) in enumerate(rows):
+                grams = self.grams(name)
+                matrix[row, grams] = 1
+                norms[row] = np.sqrt(max(len(grams), 1))
+                entries = self.candidates(name)
+                pair_queries.append(np.full(len(entries), row, dtype=np.int64))
+                pair_entries.append(entries)
+            best = [{} for _ in batch]
+            if rows:
+                pair_queries = np.concatenate(pair_queries)
+                pair_entries = np.concatenate(pair_entries)
+                scores = self.scores(matrix, norms, pair_queries, pair_entries)
+                selected = scores >= threshold
+                records = self.arrays["records"][pair_entries[selected]]
+                for row, record, score in zip(pair_queries[selected].tolist(), records.tolist(),
+                                              scores[selected].tolist()):
+                    query_best = best[rows[row][0]]
+                    if score > query_best.get(record, -1.0):
+                        query_best[record] = score
+            for query_best in best:
+                ranked = sorted(query_best.items(), key=lambda item: -item[1])[:limit]
+                results.append([(self.ids[record], score) for record, score in ranked])
+        return results
+
+    def query(self, names, threshold=0.0, limit=10):
+        """
+        Returns the records most similar to a name or list of names, see query_batch
+        """
+        return self.query_batch([names], threshold, limit)[0]
+
+    def stats(self):
+        sizes = [len(entries) for entries in self.blocks.values()]
+        return {
+            "records": len(self.ids),
+            "names": len(self.entry_names),
+            "blocks": len(sizes),
+            "skipped_blocks": sum(1 for size in sizes if size > self.max_block_size),
+            "max_block_size": max(sizes) if sizes else 0
+        }
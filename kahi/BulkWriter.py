@@ -0,0 +1,222 @@
+from pymongo import InsertOne, UpdateOne, ReplaceOne, DeleteOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, PyMongoError
+from bson import ObjectId, encode
+from time import time, sleep
+from kahi.Entity import Entity
+
+
+class BulkWriter:
+    """
+    Buffer of write operations for a collection.
+    The operations are accumulated and sent to the server as bulk_write batches
+    when the buffer reaches batch_size operations or max_bytes of BSON data,
+    unordered by default so the server can apply them in parallel.
+    Batches that fail with network or retryable errors are sent again. Inserted
+    documents get their _id before they are buffered, so a retried insert that was
+    already applied only produces duplicate key errors, which are ignored;
+    updates are sent again as they are, so they should be idempotent ($set instead of $inc).
+
+    Use it as a context manager, or call close at the end, to flush the last batch.
+
+    Example:
+        with self.bulk_writer("works") as writer:
+            for work in works:
+                writer.insert(work)
+        print(writer.stats())
+    """
+
+    def __init__(self, collection, batch_size=1000, max_bytes=None,
+                 ordered=False, retries=3, retry_wait=1.0):
+        """
+        Parameters:
+        ____________
+        collection:pymongo.collection.Collection
+            collection where the operations are applied
+        batch_size:int
+            maximum number of operations per batch
+        max_bytes:int
+            maximum size in bytes of the documents of a batch, None to only use batch_size,
+            the documents are encoded to measure them only when it is set
+        ordered:bool
+            ordered parameter of bulk_write
+        retries:int
+            number of times a batch is sent again after a transient error
+        retry_wait:float
+            seconds to wait before the first retry, doubled on every retry
+        """
+        self.collection = collection
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.ordered = ordered
+        self.retries = retries
+        self.retry_wait = retry_wait
+
+        self.operations = []
+        self.size = 0
+        self.counters = {
+            "operations": 0,
+            "inserted": 0,
+            "matched": 0,
+            "modified": 0,
+            "upserted": 0,
+            "deleted": 0,
+            "batches": 0,
+            "retries": 0,
+            "errors": 0,
+            "bytes": 0,
+            "time": 0.0
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def add(self, operation, size=0):
+        """
+        Adds an operation to the buffer and flushes it if it is full
+        """
+        self.operations.append(operation)
+        self.size += size
+        if len(self.operations) >= self.batch_size or (self.max_bytes and self.size >= self.max_bytes):
+            self.flush()
+
+    def document_size(self, *documents):
+        if not self.max_bytes:
+            return 0
+        return sum(len(encode(document)) for document in documents if document is not None)
+
+    def insert(self, document):
+        """
+        Buffers an insert, the _id is assigned if the document does not have one.
+        Entity records are converted with to_dict.
+        """
+        if isinstance(document, Entity):
+            document = document.to_dict()
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        self.add(InsertOne(document), self.document_size(document))
+
+    def update(self, filter, update, upsert=False):
+        """
+        Buffers an update_one with the given update document or pipeline
+        """
+        size = self.document_size(filter, update) if isinstance(update, dict) else 0
+        self.add(UpdateOne(filter, update, upsert=upsert), size)
+
+    def upsert(self, filter, update):
+        """
+        Buffers an update_one with upsert=True
+        """
+        self.update(filter, update, upsert=True)
+
+    def replace(self, filter, document, upsert=False):
+        """
+        Buffers a replace_one
+        """
+        if isinstance(document, Entity):
+            document = document.to_dict()
+        self.add(ReplaceOne(filter, document, upsert=upsert),
+                 self.document_size(filter, document))
+
+    def delete(self, filter):
+        """
+        Buffers a delete_one
+        """
+        self.add(DeleteOne(filter), self.document_size(filter))
+
+    def count(self, inserted=0, matched=0, modified=0, upserted=0, deleted=0):
+        self.counters["inserted"] += inserted
+        self.counters["matched"] += matched
+        self.counters["modified"] += modified
+        self.counters["upserted"] += upserted
+        self.counters["deleted"] += deleted
+
+    def is_transient(self, error):
+        """
+        Returns True if the error is worth a retry
+        """
+        if isinstance(error, ConnectionFailure):
+            return True
+        return isinstance(error, PyMongoError) and error.has_error_label("RetryableWriteError")
+
+    def is_applied_insert(self, error, operations):
+        """
+        Returns True if the error is a duplicate key of an insert applied before a retry
+        """
+        return error.get("code") == 11000 and isinstance(operations[error["index"]], InsertOne)
+
+    def execute(self, operations):
+        """
+        Sends a batch to the server retrying transient errors
+        """
+        attempt = 0
+        while True:
+            try:
+                result = self.collection.bulk_write(operations, ordered=self.ordered)
+                self.count(result.inserted_count, result.matched_count, result.modified_count,
+                           result.upserted_count, result.deleted_count)
+                return
+            except BulkWriteError as e:
+                details = e.details
+                self.count(details.get("nInserted", 0), details.get("nMatched", 0),
+                           details.get("nModified", 0), details.get("nUpserted", 0),
+                           details.get("nRemoved", 0))
+                errors = details.get("writeErrors", [])
+                if attempt > 0:
+                    # inserts applied before the transient error
+                    errors = [error for error in errors if not self.is_applied_insert(error, operations)]
+                if errors or details.get("writeConcernErrors"):
+                    self.counters["errors"] += len(errors)
+                    raise
+                return
+            except PyMongoError as e:
+                if attempt >= self.retries or not self.is_transient(e):
+                    self.counters["errors"] += 1
+                    raise
+                sleep(self.retry_wait * 2 ** attempt)
+                attempt += 1
+                self.counters["retries"] += 1
+
+    def flush(self):
+        """
+        Sends the buffered operations to the server
+        """
+        if not self.operations:
+            return
+        operations = self.operations
+        size = self.size
+        self.operations = []
+        self.size = 0
+        time_start = time()
+        try:
+            self.execute(operations)
+        finally:
+            self.counters["time"] += time() - time_start
+            self.counters["operations"] += len(operations)
+            self.counters["batches"] += 1
+            self.counters["bytes"] += size
+
+    def close(self):
+        """
+        Flushes the remaining operations
+        """
+        self.flush()
+
+    def throughput(self):
+        """
+        Returns the number of operations per second spent in bulk_write
+        """
+        if not self.counters["time"]:
+            return 0.0
+        return self.counters["operations"] / self.counters["time"]
+
+    def stats(self):
+        """
+        Returns the counters of the writer and its throughput
+        """
+        stats = self.counters.copy()
+        stats["throughput"] = self.throughput()
+        return stats
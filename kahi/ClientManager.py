@@ -0,0 +1,129 @@
+from pymongo import MongoClient
+import kahi.Metrics  # noqa: F401, registers the command listener of the process
+import threading
+import inspect
+import asyncio
+import atexit
+import os
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:
+    # pymongo < 4.10, use motor if it is installed
+    try:
+        from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+    except ImportError:
+        AsyncMongoClient = None
+
+
+class ClientManager:
+    """
+    Cache of MongoClient instances keyed by url and client options.
+    Every MongoClient holds its own pool of connections, so sharing the clients
+    between the steps of the workflow avoids opening new pools and handshakes
+    for every plugin. The options are the keyword arguments of MongoClient,
+    ex: maxPoolSize, compressors, readConcernLevel, w.
+    The clients send their commands to the CommandMetrics listener of the process,
+    registered globally in pymongo when kahi.Metrics is imported.
+    """
+    _default = None
+
+    def __init__(self):
+        self.clients = {}
+        self.async_clients = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def default(cls):
+        """
+        Returns the manager shared by the whole process.
+        """
+        if cls._default is None:
+            cls._default = cls()
+            atexit.register(cls._default.close)
+        return cls._default
+
+    @classmethod
+    def _reset_after_fork(cls):
+        # MongoClient is not fork safe, the child process must open its own clients
+        if cls._default is not None:
+            cls._default.clients = {}
+            cls._default.async_clients = {}
+            cls._default.lock = threading.Lock()
+
+    def key(self, url, options):
+        """
+        Returns the key of the cache for a url and options
+        """
+        return (url, tuple(sorted((name, repr(value)) for name, value in options.items())))
+
+    def get_client(self, url, **options):
+        """
+        Returns a cached client, creating it if needed.
+
+        Parameters:
+        ____________
+        url:str
+            mongodb url, ex: localhost:27017
+        options:dict
+            keyword arguments passed to MongoClient
+        """
+        key = self.key(url, options)
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                client = MongoClient(url, **options)
+                self.clients[key] = client
+        return client
+
+    def get_async_client(self, url, **options):
+        """
+        Returns a cached asyncio client for the running event loop, creating it if needed.
+        It is a pymongo AsyncMongoClient, or a motor client with pymongo < 4.10.
+
+        Parameters:
+        ____________
+        url:str
+            mongodb url, ex: localhost:27017
+        options:dict
+            keyword arguments passed to the client
+        """
+        if AsyncMongoClient is None:
+            raise ModuleNotFoundError(
+                "An async MongoDB client needs pymongo>=4.10 or motor.\nTry\n\tpip install -U pymongo")
+        # the clients are bound to the event loop where they are used
+        loop = asyncio.get_running_loop()
+        key = (id(loop),) + self.key(url, options)
+        with self.lock:
+            client = self.async_clients.get(key)
+            if client is None:
+                client = AsyncMongoClient(url, **options)
+                self.async_clients[key] = client
+        return client
+
+    async def close_async(self):
+        """
+        Closes the async clients of the running event loop
+        """
+        loop_id = id(asyncio.get_running_loop())
+        with self.lock:
+            keys = [key for key in self.async_clients.keys() if key[0] == loop_id]
+            clients = [self.async_clients.pop(key) for key in keys]
+        for client in clients:
+            closed = client.close()
+            if inspect.isawaitable(closed):
+                await closed
+
+    def close(self):
+        """
+        Closes all the clients of the cache
+        """
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients = {}
+        for client in clients:
+            client.close()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=ClientManager._reset_after_fork)
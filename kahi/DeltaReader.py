@@ -0,0 +1,237 @@
+from pymongo.errors import OperationFailure
+from time import time
+
+# error codes of a resume token that is not in the oplog anymore
+history_lost_codes = (136, 280, 286)
+
+
+def prefix_filter(filter, prefix):
+    """
+    Returns the filter with the fields prefixed, to apply a filter
+    of the documents to the fullDocument of the change events
+    """
+    result = {}
+    for key, value in filter.items():
+        if key in ("$and", "$or", "$nor"):
+            result[key] = [prefix_filter(item, prefix) for item in value]
+        elif key.startswith("$"):
+            result[key] = value
+        else:
+            result[prefix + key] = value
+    return result
+
+
+class DeltaReader:
+    """
+    Reads the documents of a collection inserted or modified since the previous successful
+    run of the step, given by its watermark, in batches of batch_size documents.
+
+    Without change_stream the watermark is the maximum of field (default updated.time, the
+    time of the provenance entries of the templates) when the reading starts, and the documents
+    with field greater or equal than the previous watermark are read. With source only the
+    provenance entries of that source are compared. field should have an index.
+
+    With change_stream the watermark is the resume token of a change stream of the collection
+    (it needs a replica set), the documents are the full documents of the insert, update and
+    replace events since the token, each document once. Without a previous token, or if the
+    token is not in the oplog anymore, the whole collection is read.
+
+    The new watermark is available in watermark after all the documents were read,
+    and kahi saves it in the log only if the step finishes successfully.
+    """
+
+    def __init__(self, collection, previous=None, field="updated.time", source=None, filter=None,
+                 projection=None, batch_size=1000, change_stream=False, max_await_time_ms=1000,
+                 on_complete=None):
+        """
+        Parameters:
+        ____________
+        collection:pymongo.collection.Collection
+            collection to read
+        previous:object
+            watermark of the previous run, None to read all the documents
+        field:str
+            field with the time of the modification of the documents
+        source:str
+            source of the provenance entries compared, ex: openalex
+        filter:dict
+            filter of the documents
+        projection:dict
+            projection of the documents, not used with change_stream
+        batch_size:int
+            number of documents of every batch
+        change_stream:bool
+            if True the watermark is a resume token of a change stream
+        max_await_time_ms:int
+            milliseconds the change stream waits for new events before the reading ends
+        on_complete:callable
+            on_complete(watermark) is called when all the documents were read
+        """
+        self.collection = collection
+        self.previous = previous
+        self.field = field
+        self.source = source
+        self.filter = filter or {}
+        self.projection = projection
+        self.batch_size = batch_size
+        self.change_stream = change_stream
+        self.max_await_time_ms = max_await_time_ms
+        self.on_complete = on_complete
+        self.watermark = None
+        self.count = 0
+        self.full_scan = previous is None
+        self.time_start = None
+        self.time_end = None
+
+    def field_condition(self, condition):
+        """
+        Returns the filter of condition on field, for the entries of source if it is set
+        """
+        if self.source is None:
+            return {self.field: condition}
+        parent, name = self.field.rsplit(".", 1)
+        return {parent: {"$elemMatch": {"source": self.source, name: condition}}}
+
+    def query_filter(self, watermark=None):
+        conditions = [self.filter] if self.filter else []
+        if watermark is not None:
+            conditions.append(self.field_condition({"$gte": watermark}))
+        elif self.source is not None:
+            conditions.append(self.field_condition({"$exists": True}))
+        if not conditions:
+            return {}
+        return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+    def high_watermark(self):
+        """
+        Returns the maximum of field in the collection, of the entries of source if it is set
+        """
+        if self.source is not None:
+            return self.source_high_watermark()
+        last = list(self.collection.find(
+            self.field_condition({"$exists": True}), {self.field: 1}).sort(self.field, -1).limit(1))
+        if not last:
+            return None
+        values = [last[0]]
+        for name in self.field.split("."):
+            next_values = []
+            for value in values:
+                if isinstance(value, list):
+                    next_values.extend(item.get(name) for item in value if isinstance(item, dict))
+                elif isinstance(value, dict):
+                    next_values.append(value.get(name))
+            values = [value for value in next_values if value is not None]
+        flat = []
+        for value in values:
+            flat.extend(value if isinstance(value, list) else [value])
+        return max(flat) if flat else None
+
+    def source_high_watermark(self):
+        """
+        Returns the maximum of field in the entries of source, the entries of the other
+        sources of the documents are filtered out before taking the maximum
+        """
+        parent, name = self.field.rsplit(".", 1)
+        entries = {"$filter": {"input": "$" + parent, "as": "entry",
+                               "cond": {"$eq": ["$$entry.source", self.source]}}}
+        result = list(self.collection.aggregate([
+            {"$match": self.field_condition({"$exists": True})},
+            {"$project": {"_id": 0, "entries": entries}},
+            {"$unwind": "$entries"},
+            {"$group": {"_id": None, "value": {"$max": "$entries." + name}}}
+        ]))
+        return result[0]["value"] if result else None
+
+    def batches(self, cursor):
+        batch = []
+        for document in cursor:
+            batch.append(document)
+            if len(batch) >= self.batch_size:
+                self.count += len(batch)
+                yield batch
+                batch = []
+        if batch:
+            self.count += len(batch)
+            yield batch
+
+    def query(self):
+        # the documents modified while they are read are read again in the next run
+        watermark = self.high_watermark()
+        cursor = self.collection.find(self.query_filter(self.previous), self.projection,
+                                      batch_size=self.batch_size)
+        yield from self.batches(cursor)
+        self.complete(watermark if watermark is not None else self.previous)
+
+    def watch(self, resume_after=None):
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}]
+        if self.filter:
+            pipeline.append({"$match": prefix_filter(self.filter, "fullDocument.")})
+        return self.collection.watch(pipeline, full_document="updateLookup", resume_after=resume_after,
+                                     max_await_time_ms=self.max_await_time_ms)
+
+    def stream(self):
+        if self.previous is not None:
+            try:
+                stream = self.watch(self.previous)
+            except OperationFailure as e:
+                if e.code not in history_lost_codes:
+                    raise
+                print("Resume token of {} not found in the oplog, reading the whole collection".format(
+                    self.collection.full_name))
+                self.full_scan = True
+            else:
+                with stream:
+                    yield from self.batches(self.changed_documents(stream))
+                    self.complete(stream.resume_token)
+                return
+        # the token is taken before the full read, the documents modified during it are read again
+        with self.watch() as stream:
+            stream.try_next()
+            watermark = stream.resume_token
+        yield from self.batches(self.collection.find(self.query_filter(), batch_size=self.batch_size))
+        self.complete(watermark)
+
+    def changed_documents(self, stream):
+        seen = set()
+        while stream.alive:
+            change = stream.try_next()
+            if change is None:
+                break
+            document = change.get("fullDocument")
+            # deleted after the event, or already read in this run
+            if document is None or document["_id"] in seen:
+                continue
+            seen.add(document["_id"])
+            yield document
+
+    def complete(self, watermark):
+        self.watermark = watermark
+        self.time_end = time()
+        if self.on_complete:
+            self.on_complete(watermark)
+
+    def __iter__(self):
+        """
+        Yields the documents in lists of batch_size
+        """
+        self.time_start = time()
+        if self.change_stream:
+            return self.stream()
+        return self.query()
+
+    def records(self):
+        """
+        Yields the documents one by one
+        """
+        for batch in self:
+            yield from batch
+
+    def stats(self):
+        return {
+            "collection": self.collection.full_name,
+            "documents": self.count,
+            "full_scan": self.full_scan,
+            "previous": self.previous,
+            "watermark": self.watermark,
+            "time": (self.time_end or time()) - self.time_start if self.time_start else 0
+        }
@@ -0,0 +1,131 @@
+from concurrent.futures import Future
+from pymongo.errors import ConnectionFailure
+from bson import ObjectId
+from time import time
+import threading
+import sys
+
+
+class DistributedExecutor:
+    """
+    Executor that puts the submitted steps in a JobQueue, where they are claimed
+    by workers (see kahi.Worker) running on any host with access to the log database.
+    Only the calls to run_plugin can be submitted, they are queued as the documents of
+    JobQueue.step_call and the workers run them with their own run_plugin.
+    A thread of the coordinator polls the queue every poll_interval seconds to resolve
+    the futures of the finished jobs and to queue again the jobs whose lease expired.
+    When the database can not be reached, ex: during a replica set failover, the thread
+    retries with a growing interval and fails the pending steps after retry_timeout
+    seconds without reaching it, or at once on any other error.
+    The number of jobs in the queue at the same time is limited by the scheduler.
+    """
+
+    def __init__(self, queue, lease=300, max_attempts=3, poll_interval=2.0, retry_timeout=300):
+        """
+        Parameters:
+        ____________
+        queue:JobQueue
+            queue of the jobs
+        lease:float
+            seconds a worker owns a job without a heartbeat
+        max_attempts:int
+            maximum number of times a job is claimed
+        poll_interval:float
+            seconds between checks of the queue
+        retry_timeout:float
+            seconds the checks are retried while the database can not be reached
+        """
+        self.queue = queue
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.retry_timeout = retry_timeout
+        self.run_id = ObjectId()
+        self.futures = {}
+        self.error = None
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(
+            target=self.watch, name="kahi-queue-monitor", daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        if getattr(fn, "__name__", None) != "run_plugin":
+            raise TypeError("DistributedExecutor only runs workflow steps, not {!r}".format(fn))
+        if self.error is not None:
+            raise self.error
+        future = Future()
+        call = self.queue.step_call(*args, **kwargs)
+        # the log id of the step is saved to identify the job
+        job_id = self.queue.enqueue(call["step"]["log_id"], call,
+                                    run_id=self.run_id, max_attempts=self.max_attempts)
+        future.set_running_or_notify_cancel()
+        with self.lock:
+            self.futures[job_id] = future
+        return future
+
+    def check(self):
+        """
+        Resolves the futures of the finished jobs
+        """
+        self.queue.requeue_expired()
+        with self.lock:
+            job_ids = list(self.futures.keys())
+        if not job_ids:
+            return
+        for job in self.queue.finished(job_ids):
+            with self.lock:
+                future = self.futures.pop(job["_id"])
+            ok, value = self.queue.outcome(job)
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def watch(self):
+        interval = self.poll_interval
+        failing_since = None
+        while not self.stop.wait(interval):
+            try:
+                self.check()
+            except ConnectionFailure as e:
+                # the workers keep running the jobs, their results are read when the database is back
+                now = time()
+                if failing_since is None:
+                    failing_since = now
+                if now - failing_since > self.retry_timeout:
+                    self.fail_pending(e)
+                    return
+                interval = min(interval * 2, max(self.poll_interval, 60))
+                print("The job queue can not be reached, retrying in {:.1f} s: {}".format(interval, e),
+                      file=sys.stderr)
+                continue
+            except Exception as e:
+                self.fail_pending(e)
+                return
+            interval = self.poll_interval
+            failing_since = None
+
+    def fail_pending(self, error):
+        """
+        Fails the pending steps, the coordinator can not read the queue
+        """
+        self.error = error
+        with self.lock:
+            futures = list(self.futures.values())
+            self.futures = {}
+        for future in futures:
+            future.set_exception(error)
+
+    def shutdown(self, wait=True):
+        """
+        Stops the monitor, if wait is True after the pending jobs finish,
+        otherwise the jobs not claimed yet are cancelled.
+        """
+        if not wait:
+            with self.lock:
+                self.queue.cancel(self.futures.keys())
+        while wait and self.futures and self.error is None and self.thread.is_alive():
+            self.stop.wait(self.poll_interval)
+        self.stop.set()
+        self.thread.join()
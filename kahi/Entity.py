@@ -0,0 +1,179 @@
+from copy import deepcopy
+
+
+def rebuild(name, template, omit_defaults, values):
+    """
+    Returns a record of a class generated by Entity.define, used to unpickle the records.
+    The class is generated again from the template if the process does not have it.
+    """
+    for entity_class in Entity.classes.get(name, []):
+        if entity_class.omit_defaults == omit_defaults and (
+                entity_class.defaults is template or entity_class.defaults == template):
+            break
+    else:
+        entity_class = Entity.define(name, template, omit_defaults)
+    entity = entity_class()
+    for field, value in values.items():
+        object.__setattr__(entity, field, value)
+    return entity
+
+
+class Entity:
+    """
+    Compact record built from a template like KahiBase.empty_work.
+    The classes are generated with Entity.define, every field of the template
+    is a slot, so the records have no __dict__, unknown field names raise
+    AttributeError (KeyError with item access), and the empty containers of
+    the template are only created when a field is read or written.
+    The records can be pickled, ex: to send them to other processes, the
+    generated class is rebuilt from its template when they are unpickled.
+
+    A record behaves like the dict of the template for the common operations:
+        work = self.entity("work")
+        work["titles"].append({"title": title, "lang": "en", "source": "openalex"})
+        work.year_published = 2020
+        collection.insert_one(work.to_dict())
+    """
+    __slots__ = ()
+    fields = ()
+    defaults = {}
+    factories = {}
+    omit_defaults = False
+    # generated classes by name
+    classes = {}
+
+    @classmethod
+    def define(cls, name, template, omit_defaults=False):
+        """
+        Returns a new Entity class with the fields of the template.
+
+        Parameters:
+        ____________
+        name:str
+            name of the class
+        template:dict
+            fields and default values, ex: the output of KahiBase.empty_work()
+        omit_defaults:bool
+            default of to_dict for omitting the fields with the default value
+        """
+        fields = tuple(template.keys())
+        slots = fields if "_id" in template else fields + ("_id",)
+        factories = {}
+        for field, default in template.items():
+            if isinstance(default, (list, dict)) and not default:
+                factories[field] = type(default)
+            elif isinstance(default, (list, dict, set)):
+                factories[field] = (lambda value: lambda: deepcopy(value))(default)
+            else:
+                factories[field] = (lambda value: lambda: value)(default)
+        entity_class = type(name, (cls,), {
+            "__slots__": slots,
+            "fields": fields,
+            "defaults": template,
+            "factories": factories,
+            "omit_defaults": omit_defaults
+        })
+        Entity.classes.setdefault(name, []).append(entity_class)
+        return entity_class
+
+    def __reduce__(self):
+        cls = type(self)
+        values = {name: object.__getattribute__(self, name) for name in cls.__slots__ if self.is_set(name)}
+        return (rebuild, (cls.__name__, cls.defaults, cls.omit_defaults, values))
+
+    def __init__(self, **values):
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    def __getattr__(self, name):
+        # only called when the slot was never set
+        factory = type(self).factories.get(name)
+        if factory is None:
+            raise AttributeError("{} has no field {}".format(type(self).__name__, name))
+        value = factory()
+        object.__setattr__(self, name, value)
+        return value
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        try:
+            setattr(self, name, value)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return name in type(self).factories or (name == "_id" and self.is_set(name))
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, self.to_dict())
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def is_set(self, name):
+        """
+        Returns True if the field was read or written
+        """
+        try:
+            object.__getattribute__(self, name)
+        except AttributeError:
+            return False
+        return True
+
+    def value(self, value):
+        if isinstance(value, Entity):
+            return value.to_dict()
+        if isinstance(value, list) and value and isinstance(value[0], Entity):
+            return [item.to_dict() if isinstance(item, Entity) else item for item in value]
+        return value
+
+    def to_dict(self, omit_defaults=None):
+        """
+        Returns the record as a dict ready to be saved in MongoDB.
+
+        Parameters:
+        ____________
+        omit_defaults:bool
+            if True the fields with the default value of the template are omitted,
+            default is the omit_defaults of the class
+        """
+        cls = type(self)
+        if omit_defaults is None:
+            omit_defaults = cls.omit_defaults
+        record = {}
+        if self.is_set("_id"):
+            record["_id"] = self._id
+        for name in cls.fields:
+            try:
+                value = object.__getattribute__(self, name)
+            except AttributeError:
+                if omit_defaults:
+                    continue
+                value = cls.factories[name]()
+            else:
+                if omit_defaults and value == cls.defaults[name]:
+                    continue
+            record[name] = self.value(value)
+        return record
+
+    @classmethod
+    def from_dict(cls, record):
+        """
+        Returns a record from a dict, ex: a document read from MongoDB.
+        It raises AttributeError if the dict has fields that are not in the template.
+        """
+        entity = cls()
+        for name, value in record.items():
+            setattr(entity, name, value)
+        return entity
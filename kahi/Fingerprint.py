@@ -0,0 +1,129 @@
+from kahi.ClientManager import ClientManager
+from hashlib import sha256
+import json
+import glob
+import os
+
+
+class Fingerprint:
+    """
+    Computes the fingerprint of a step from its parameters, the version of the plugin
+    and the state of its declared inputs. If the fingerprint of a step did not change
+    since its last successful run, the step does not need to run again.
+
+    The inputs are declared in the reserved parameter inputs of the step, a list of:
+        path or glob pattern of files, ex: scimago/*.csv
+        {file: path, hash: true} to use the sha256 of the content instead of size and mtime
+        {collection: name, database: name, database_url: url, field: updated.time}
+            for a collection, its number of documents and the maximum of field,
+            database and database_url default to the config section.
+            The field should have an index, field: null only uses the count.
+    """
+
+    def __init__(self, config, client_manager=None):
+        """
+        Parameters:
+        ____________
+        config:dict
+            config section of the workflow
+        client_manager:ClientManager
+            manager of the database clients
+        """
+        self.config = config
+        self.client_manager = client_manager or ClientManager.default()
+
+    def file_state(self, path, hash=False):
+        """
+        Returns the state of a file: size and mtime, or the sha256 of the content
+        """
+        if not os.path.exists(path):
+            return {"file": path, "exists": False}
+        if hash:
+            digest = sha256()
+            with open(path, "rb") as file:
+                for block in iter(lambda: file.read(1024 * 1024), b""):
+                    digest.update(block)
+            return {"file": path, "sha256": digest.hexdigest()}
+        stat = os.stat(path)
+        return {"file": path, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    def files_state(self, pattern, hash=False):
+        paths = sorted(glob.glob(pattern)) or [pattern]
+        return [self.file_state(path, hash) for path in paths]
+
+    def collection_state(self, collection, database=None, database_url=None, field="updated.time"):
+        """
+        Returns the state of a collection: number of documents and maximum value of field
+        """
+        client = self.client_manager.get_client(
+            database_url or self.config["database_url"],
+            **(self.config.get("client_options") or {}))
+        database = database or self.config["database_name"]
+        state = {
+            "collection": database + "." + collection,
+            "count": client[database][collection].estimated_document_count()
+        }
+        if field:
+            last = list(client[database][collection].find(
+                {field: {"$exists": True}}, {field: 1}).sort(field, -1).limit(1))
+            state["max"] = self.field_max(last[0], field) if last else None
+        return state
+
+    def field_max(self, document, field):
+        values = [document]
+        for name in field.split("."):
+            next_values = []
+            for value in values:
+                if isinstance(value, list):
+                    next_values.extend(item.get(name) for item in value if isinstance(item, dict))
+                elif isinstance(value, dict):
+                    next_values.append(value.get(name))
+            values = next_values
+        values = [value for value in values if value is not None]
+        return max(values) if values else None
+
+    def inputs_state(self, inputs):
+        """
+        Returns the state of the declared inputs
+        """
+        if not inputs:
+            return []
+        if isinstance(inputs, (str, dict)):
+            inputs = [inputs]
+        state = []
+        for source in inputs:
+            if isinstance(source, str):
+                state.extend(self.files_state(source))
+            elif "file" in source:
+                state.extend(self.files_state(source["file"], source.get("hash", False)))
+            elif "collection" in source:
+                state.append(self.collection_state(
+                    source["collection"],
+                    source.get("database"),
+                    source.get("database_url"),
+                    source.get("field", "updated.time")))
+            else:
+                raise ValueError("Unknown input {}".format(source))
+        return state
+
+    def step(self, params, version, inputs=None):
+        """
+        Returns the fingerprint of a step
+
+        Parameters:
+        ____________
+        params:dict or list
+            parameters of the step passed to the plugin
+        version:str
+            version of the plugin
+        inputs:list
+            declared inputs of the step
+        """
+        data = {
+            "params": params,
+            "version": version,
+            "database_url": self.config.get("database_url"),
+            "database_name": self.config.get("database_name"),
+            "inputs": self.inputs_state(inputs)
+        }
+        return sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
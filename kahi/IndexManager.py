@@ -0,0 +1,254 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from kahi.ClientManager import ClientManager
+from pymongo import IndexModel
+from time import time
+import threading
+
+
+class IndexManager:
+    """
+    Manages the indexes declared in the indexes section of the workflow around the bulk loads.
+
+    The secondary indexes of the collections declared in the reserved parameter bulk_load of
+    a step are dropped before the step runs, the unique indexes are kept because they protect
+    the data. The indexes of a collection are built again in a background thread as soon as
+    no step that bulk loads it is left, and the steps that declare the collection in inputs
+    wait until they are ready. The collections are built in parallel, one thread each, with
+    one createIndexes command per collection so the server reads the collection once.
+    The indexes still missing at the end of the workflow are built before it finishes.
+
+    The indexes section maps collections of database_name, or database.collection, to lists of:
+        field name, ex: doi
+        list of [field, direction] pairs, ex: [[year_published, -1], [types.type, 1]]
+        mapping of fields to directions, ex: {external_ids.id: 1}
+        mapping with keys and the options of createIndexes, ex: {keys: doi, unique: true, sparse: true}
+    """
+
+    def __init__(self, indexes, config, client_manager=None, on_built=None, verbose=0):
+        """
+        Parameters:
+        ____________
+        indexes:dict
+            indexes section of the workflow
+        config:dict
+            config section of the workflow
+        client_manager:ClientManager
+            manager of the database clients
+        on_built:callable
+            on_built(log_id, result) is called when the build of a collection finishes, result has
+            collection, indexes, seconds and error if it failed. log_id is the step that dropped
+            the indexes or the first step that needed them, None for the final build.
+        verbose:int
+            verbosity level
+        """
+        self.config = config
+        self.client_manager = client_manager or ClientManager.default()
+        self.on_built = on_built
+        self.verbose = verbose
+        self.indexes = self.parse(indexes, config)
+        # namespaces whose indexes exist, are being built and were dropped by kahi
+        self.built = set()
+        self.builds = {}
+        self.dropped = set()
+        # step where the build of a namespace is recorded
+        self.owners = {}
+        # namespace -> steps that bulk load it and did not finish
+        self.loaders = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, len(self.indexes)),
+                                       thread_name_prefix="kahi-index")
+
+    @staticmethod
+    def namespace(collection, database=None, config=None):
+        """
+        Returns database.collection, collection is in database_name of the config
+        unless it has the database or database is given
+        """
+        if database:
+            return database + "." + collection
+        if "." in collection:
+            return collection
+        return config["database_name"] + "." + collection
+
+    @staticmethod
+    def index_keys(keys, where):
+        if isinstance(keys, str):
+            return [(keys, 1)]
+        if isinstance(keys, dict) and keys:
+            return list(keys.items())
+        if isinstance(keys, list) and keys and all(
+                isinstance(pair, (list, tuple)) and len(pair) == 2 for pair in keys):
+            return [tuple(pair) for pair in keys]
+        raise ValueError("Invalid keys {} of an index of {}".format(keys, where))
+
+    @classmethod
+    def parse(cls, indexes, config):
+        """
+        Returns the IndexModel of the indexes section by namespace,
+        it raises ValueError if the section is not valid
+        """
+        if indexes is None:
+            return OrderedDict()
+        if not isinstance(indexes, dict):
+            raise ValueError("The indexes section must be a mapping of collections to lists of indexes")
+        models = OrderedDict()
+        for collection, specs in indexes.items():
+            namespace = cls.namespace(collection, config=config)
+            if not isinstance(specs, list):
+                specs = [specs]
+            models[namespace] = []
+            for spec in specs:
+                if isinstance(spec, dict) and "keys" in spec:
+                    options = dict(spec)
+                    keys = cls.index_keys(options.pop("keys"), namespace)
+                    models[namespace].append(IndexModel(keys, **options))
+                else:
+                    models[namespace].append(IndexModel(cls.index_keys(spec, namespace)))
+        return models
+
+    def namespaces(self, collections):
+        """
+        Returns the managed namespaces of a bulk_load or inputs parameter,
+        a list of collection names or of mappings with collection and database
+        """
+        namespaces = []
+        for collection in collections or []:
+            if isinstance(collection, dict):
+                if "collection" not in collection:
+                    continue
+                namespace = self.namespace(collection["collection"], collection.get("database"), self.config)
+            elif isinstance(collection, str):
+                namespace = self.namespace(collection, config=self.config)
+            else:
+                continue
+            if namespace in self.indexes and namespace not in namespaces:
+                namespaces.append(namespace)
+        return namespaces
+
+    def collection(self, namespace):
+        database, collection = namespace.split(".", 1)
+        client = self.client_manager.get_client(
+            self.config["database_url"], **(self.config.get("client_options") or {}))
+        return client[database][collection]
+
+    def register(self, log_id, bulk_load):
+        """
+        Declares a step that bulk loads the collections of bulk_load
+        """
+        for namespace in self.namespaces(bulk_load):
+            self.loaders.setdefault(namespace, set()).add(log_id)
+
+    def drop(self, log_id, namespaces):
+        """
+        Drops the secondary indexes of the namespaces before a bulk load,
+        waiting first for their builds. Returns the names of the dropped indexes by namespace.
+        """
+        dropped = OrderedDict()
+        for namespace in namespaces:
+            with self.lock:
+                build = self.builds.get(namespace)
+            if build is not None:
+                try:
+                    build.result()
+                except Exception:
+                    pass
+            collection = self.collection(namespace)
+            existing = collection.index_information()
+            names = [model.document["name"] for model in self.indexes[namespace]
+                     if not model.document.get("unique") and model.document["name"] in existing]
+            for name in names:
+                collection.drop_index(name)
+            with self.lock:
+                self.built.discard(namespace)
+                self.dropped.add(namespace)
+                self.owners[namespace] = log_id
+            dropped[namespace] = names
+            if self.verbose > 4:
+                print("Dropped indexes {} of {} before {}".format(", ".join(names) or "-", namespace, log_id))
+        return dropped
+
+    def finished(self, log_id):
+        """
+        Called when a step finishes or is skipped, starts the builds of the dropped
+        collections that no other step bulk loads
+        """
+        ready = []
+        for namespace, loaders in self.loaders.items():
+            loaders.discard(log_id)
+            if not loaders and namespace in self.dropped:
+                ready.append(namespace)
+        if ready:
+            self.build(ready)
+
+    def build(self, namespaces, log_id=None):
+        """
+        Starts in the background the builds of the namespaces whose indexes are not built
+        and returns their futures
+        """
+        futures = []
+        for namespace in namespaces:
+            with self.lock:
+                if namespace in self.built:
+                    continue
+                future = self.builds.get(namespace)
+                if future is None:
+                    self.owners.setdefault(namespace, log_id)
+                    future = self.pool.submit(self.build_collection, namespace)
+                    self.builds[namespace] = future
+            futures.append(future)
+        return futures
+
+    def build_collection(self, namespace):
+        """
+        Creates the indexes of a namespace, executed in the threads of the manager
+        """
+        names = [model.document["name"] for model in self.indexes[namespace]]
+        if self.verbose > 4:
+            print("Building indexes {} of {}".format(", ".join(names), namespace))
+        time_start = time()
+        result = {"collection": namespace, "indexes": names}
+        try:
+            self.collection(namespace).create_indexes(self.indexes[namespace])
+        except Exception as e:
+            result["error"] = str(e)
+            raise
+        else:
+            with self.lock:
+                self.built.add(namespace)
+                self.dropped.discard(namespace)
+        finally:
+            result["seconds"] = time() - time_start
+            with self.lock:
+                self.builds.pop(namespace, None)
+                owner = self.owners.pop(namespace, None)
+            if self.on_built:
+                self.on_built(owner, result)
+        return result
+
+    def wait(self, log_id, namespaces):
+        """
+        Builds the missing indexes of the namespaces a step reads and waits for them,
+        it raises the error of a build. Returns the seconds waited.
+        """
+        time_start = time()
+        for future in self.build(namespaces, log_id):
+            future.result()
+        return time() - time_start
+
+    def finish(self):
+        """
+        Builds all the indexes that are missing and waits for them,
+        it raises the first error after all the builds finish
+        """
+        error = None
+        for future in self.build(list(self.indexes.keys())):
+            try:
+                future.result()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def close(self):
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,196 @@
+from concurrent.futures import Future
+from time import time, sleep
+import multiprocessing
+import traceback
+import threading
+
+
+class StepLimitExceeded(Exception):
+    """
+    Raised when an isolated step is killed because it exceeded its memory or time limit
+    """
+    pass
+
+
+class StepProcessError(Exception):
+    """
+    Raised when the process of an isolated step dies without sending its result,
+    ex: killed by the OOM killer
+    """
+    pass
+
+
+class StepTerminated(Exception):
+    """
+    Raised when the process of an isolated step is terminated by its owner, ex: a worker that lost its job
+    """
+    pass
+
+
+class RemoteTraceback(Exception):
+    """
+    Traceback of an exception raised in the process of a step
+    """
+
+    def __str__(self):
+        return self.args[0]
+
+
+def run_isolated(connection, fn, args, kwargs):
+    """
+    Entry point of the process of a step, sends the result or the exception to the parent
+    """
+    try:
+        result = fn(*args, **kwargs)
+        message = (True, result, None)
+    except BaseException as e:
+        message = (False, e, traceback.format_exc())
+    try:
+        connection.send(message)
+    except Exception as e:
+        # the result or the exception can not be pickled
+        connection.send((False, StepProcessError(repr(message[1])), repr(e)))
+    finally:
+        connection.close()
+
+
+class IsolatedExecutor:
+    """
+    Executor that runs every submitted callable in a new process, so the memory used
+    by a step is returned to the system when it finishes and a runaway step can be
+    killed without losing the orchestrator. A monitor thread kills the processes that
+    go over max_rss MB of resident memory or run for more than timeout seconds,
+    their futures fail with StepLimitExceeded.
+    The number of processes running at the same time is limited by the scheduler.
+    """
+
+    def __init__(self, start_method="forkserver", max_rss=None, timeout=None, poll_interval=1.0):
+        """
+        Parameters:
+        ____________
+        start_method:str
+            multiprocessing start method, forkserver or spawn start clean processes
+        max_rss:float
+            maximum resident memory of a step in MB, None for no limit
+        timeout:float
+            maximum seconds of a step, None for no limit
+        poll_interval:float
+            seconds between checks of the running processes
+        """
+        self.context = multiprocessing.get_context(start_method)
+        self.max_rss = max_rss
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.running = {}
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.monitor = threading.Thread(
+            target=self.watch, name="kahi-isolation-monitor", daemon=True)
+        self.monitor.start()
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        receiver, sender = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=run_isolated, args=(sender, fn, args, kwargs), daemon=False)
+        process.start()
+        sender.close()
+        future.set_running_or_notify_cancel()
+        with self.lock:
+            self.running[future] = (process, receiver, time())
+        return future
+
+    def rss(self, pid):
+        """
+        Returns the resident memory of a process in MB, None if it is not available
+        """
+        try:
+            with open("/proc/{}/status".format(pid)) as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) / 1024
+        except (OSError, ValueError):
+            return None
+        return None
+
+    def finish(self, future, process, receiver):
+        with self.lock:
+            if self.running.pop(future, None) is None:
+                # killed meanwhile
+                return
+        try:
+            ok, value, remote_traceback = receiver.recv()
+        except EOFError:
+            process.join()
+            future.set_exception(StepProcessError(
+                "Step process exited with code {} without result".format(process.exitcode)))
+            return
+        finally:
+            receiver.close()
+        process.join()
+        if ok:
+            future.set_result(value)
+        else:
+            if remote_traceback:
+                value.__cause__ = RemoteTraceback(remote_traceback)
+            future.set_exception(value)
+
+    def kill(self, future, process, receiver, message, error_class=StepLimitExceeded):
+        with self.lock:
+            if self.running.pop(future, None) is None:
+                # finished or killed meanwhile
+                return False
+        process.kill()
+        process.join()
+        receiver.close()
+        future.set_exception(error_class(message))
+        return True
+
+    def terminate(self, future, message):
+        """
+        Kills the process of a running step, its future fails with StepTerminated(message).
+        Returns False if the step already finished.
+        """
+        with self.lock:
+            running = self.running.get(future)
+        if running is None:
+            return False
+        process, receiver, _ = running
+        return self.kill(future, process, receiver, message, StepTerminated)
+
+    def watch(self):
+        while not self.stop.is_set() or self.running:
+            with self.lock:
+                running = list(self.running.items())
+            for future, (process, receiver, time_start) in running:
+                if receiver.poll():
+                    self.finish(future, process, receiver)
+                    continue
+                if not process.is_alive():
+                    # the result can arrive between poll and is_alive
+                    self.finish(future, process, receiver)
+                    continue
+                elapsed = time() - time_start
+                if self.timeout and elapsed > self.timeout:
+                    self.kill(future, process, receiver,
+                              "time limit exceeded: {:.1f} s > {} s".format(elapsed, self.timeout))
+                    continue
+                if self.max_rss:
+                    rss = self.rss(process.pid)
+                    if rss is not None and rss > self.max_rss:
+                        self.kill(future, process, receiver,
+                                  "memory limit exceeded: {:.0f} MB > {} MB".format(rss, self.max_rss))
+            sleep(self.poll_interval if running else min(self.poll_interval, 0.1))
+
+    def shutdown(self, wait=True):
+        """
+        Stops the monitor, if wait is True after the running steps finish,
+        otherwise the running processes are killed.
+        """
+        if not wait:
+            with self.lock:
+                running = list(self.running.items())
+            for future, (process, receiver, _) in running:
+                self.kill(future, process, receiver, "executor shutdown")
+        self.stop.set()
+        self.monitor.join()
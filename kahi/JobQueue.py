@@ -0,0 +1,237 @@
+from pymongo import ASCENDING, ReturnDocument
+from bson import ObjectId
+from bson.errors import InvalidDocument
+from kahi.StepConfig import StepConfig
+from time import time
+import traceback
+import socket
+import os
+
+
+class JobFailed(Exception):
+    """
+    Error of a step that failed in a worker, rebuilt from the error saved in the job.
+    error_type and remote_traceback are the type and the traceback of the exception
+    raised in the worker, step_metrics and step_profile the ones of the failed step.
+    """
+
+    def __init__(self, message, error_type=None, remote_traceback=None, step_metrics=None, step_profile=None):
+        super().__init__(message)
+        self.error_type = error_type
+        self.remote_traceback = remote_traceback
+        if step_metrics is not None:
+            self.step_metrics = step_metrics
+        if step_profile is not None:
+            self.step_profile = step_profile
+
+    def __str__(self):
+        if self.error_type:
+            return "{}: {}".format(self.error_type, self.args[0])
+        return self.args[0]
+
+
+class JobQueue:
+    """
+    Queue of workflow steps stored in a MongoDB collection, used to run the steps
+    of a workflow in workers on other hosts.
+
+    A job holds the arguments of run_plugin as plain BSON values: the plugin prefix,
+    the fields of the StepConfig (see StepConfig.to_document) and the state of the step,
+    no code or pickled objects, so the workers only run the installed plugins.
+    A worker claims the oldest queued job with a lease of lease seconds that it renews
+    with heartbeats while the job runs, and saves the result or the error of the job
+    as documents. When a worker dies its lease expires and the coordinator queues
+    the job again, at most max_attempts times; the updates of a worker are matched
+    by its id and the attempt, so a worker that lost the job can not save it.
+    The lease times use the clocks of the hosts, which should be synchronized.
+
+    Job fields:
+        status: queued, running, done, failed or cancelled
+        log_id, run_id, call, attempts, max_attempts, worker, lease_until,
+        heartbeat, created, started, finished, result, error, message
+    """
+
+    def __init__(self, collection):
+        """
+        Parameters:
+        ____________
+        collection:pymongo.collection.Collection
+            collection of the jobs, by default the log collection name with the _queue suffix
+        """
+        self.collection = collection
+        self.collection.create_index([("status", ASCENDING), ("created", ASCENDING)])
+
+    @staticmethod
+    def worker_id():
+        """
+        Returns an id for a worker process, hostname:pid
+        """
+        return "{}:{}".format(socket.gethostname(), os.getpid())
+
+    @staticmethod
+    def step_call(plugin_prefix, step, profile=None, checkpoint=None, use_log=True, writes=None, watermarks=None):
+        """
+        Returns the document of a call to run_plugin, the arguments are the ones of run_plugin
+        """
+        return {
+            "plugin_prefix": plugin_prefix,
+            "step": step.to_document(),
+            "profile": profile,
+            "checkpoint": checkpoint,
+            "use_log": use_log,
+            # the collection names have dots, they can not be keys of a document
+            "writes": [[namespace, count] for namespace, count in (writes or {}).items()],
+            "watermarks": watermarks
+        }
+
+    @staticmethod
+    def step_args(call):
+        """
+        Returns the arguments of run_plugin of a document returned by step_call
+        """
+        return (
+            call["plugin_prefix"],
+            StepConfig.from_document(call["step"]),
+            call["profile"],
+            call["checkpoint"],
+            call["use_log"],
+            {namespace: count for namespace, count in call["writes"]},
+            call["watermarks"])
+
+    def enqueue(self, log_id, call, run_id=None, max_attempts=3):
+        """
+        Adds a job for a document returned by step_call and returns its _id
+        """
+        job = {
+            "_id": ObjectId(),
+            "log_id": log_id,
+            "run_id": run_id,
+            "status": "queued",
+            "call": call,
+            "attempts": 0,
+            "max_attempts": max_attempts,
+            "worker": None,
+            "lease_until": None,
+            "created": time()
+        }
+        self.collection.insert_one(job)
+        return job["_id"]
+
+    def call(self, job):
+        """
+        Returns the arguments of run_plugin of a job
+        """
+        return self.step_args(job["call"])
+
+    @staticmethod
+    def owner(job, worker):
+        """
+        Returns the filter of a job claimed by the worker, it does not match
+        if the lease expired and the job was claimed again, even by the same worker
+        """
+        return {"_id": job["_id"], "worker": worker, "attempts": job["attempts"], "status": "running"}
+
+    def claim(self, worker, lease=300):
+        """
+        Assigns the oldest queued job to the worker and returns it, None if the queue is empty
+        """
+        now = time()
+        return self.collection.find_one_and_update(
+            {"status": "queued"},
+            {"$set": {"status": "running", "worker": worker, "lease_until": now + lease,
+                      "heartbeat": now, "started": now},
+             "$inc": {"attempts": 1}},
+            sort=[("created", ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+
+    def heartbeat(self, job, worker, lease=300):
+        """
+        Extends the lease of a claimed job, returns False if the worker lost the job
+        """
+        now = time()
+        result = self.collection.update_one(
+            self.owner(job, worker), {"$set": {"lease_until": now + lease, "heartbeat": now}})
+        return result.matched_count > 0
+
+    def complete(self, job, worker, result):
+        """
+        Saves the result of a job, a dict of BSON values, it is ignored if the worker lost the job.
+        Returns False if the worker lost the job.
+        """
+        try:
+            update = self.collection.update_one(
+                self.owner(job, worker), {"$set": {"status": "done", "finished": time(), "result": result}})
+        except InvalidDocument as e:
+            return self.fail(job, worker, TypeError("The result of the step can not be saved: {}".format(e)))
+        return update.matched_count > 0
+
+    def fail(self, job, worker, exception):
+        """
+        Saves the error of a job, it is ignored if the worker lost the job.
+        Returns False if the worker lost the job.
+        """
+        error = {
+            "type": type(exception).__name__,
+            "message": str(exception),
+            "traceback": "".join(traceback.format_exception(
+                type(exception), exception, exception.__traceback__)),
+            "metrics": getattr(exception, "step_metrics", None),
+            "profile": getattr(exception, "step_profile", None)
+        }
+        update = {"status": "failed", "finished": time(), "error": error, "message": error["message"]}
+        try:
+            result = self.collection.update_one(self.owner(job, worker), {"$set": update})
+        except InvalidDocument:
+            # metrics or profile with values that are not BSON
+            error["metrics"] = error["profile"] = None
+            result = self.collection.update_one(self.owner(job, worker), {"$set": update})
+        return result.matched_count > 0
+
+    def requeue_expired(self):
+        """
+        Queues again the running jobs whose lease expired, or marks them as failed
+        if they reached max_attempts. Returns the number of jobs queued again.
+        """
+        now = time()
+        requeued = 0
+        expired = {"status": "running", "lease_until": {"$lt": now}}
+        for job in self.collection.find(expired, {"attempts": 1, "max_attempts": 1, "worker": 1}):
+            # the worker field makes the update fail if the job was renewed meanwhile
+            filter = dict(expired, _id=job["_id"], worker=job["worker"])
+            if job["attempts"] >= job["max_attempts"]:
+                self.collection.update_one(
+                    filter, {"$set": {"status": "failed", "finished": now,
+                                      "message": "lease of worker {} expired after {} attempts".format(
+                                          job["worker"], job["attempts"])}})
+            else:
+                result = self.collection.update_one(
+                    filter, {"$set": {"status": "queued", "worker": None, "lease_until": None}})
+                requeued += result.modified_count
+        return requeued
+
+    def finished(self, job_ids):
+        """
+        Returns the jobs of job_ids that are done or failed
+        """
+        return list(self.collection.find(
+            {"_id": {"$in": list(job_ids)}, "status": {"$in": ["done", "failed"]}}))
+
+    def outcome(self, job):
+        """
+        Returns (True, result) for a done job and (False, JobFailed) for a failed one
+        """
+        if job["status"] == "done":
+            return True, job["result"]
+        error = job.get("error")
+        if error is not None:
+            return False, JobFailed(error["message"], error["type"], error["traceback"],
+                                    error.get("metrics"), error.get("profile"))
+        return False, JobFailed(job.get("message", "job failed"))
+
+    def cancel(self, job_ids):
+        """
+        Cancels the jobs of job_ids that were not claimed yet
+        """
+        self.collection.update_many(
+            {"_id": {"$in": list(job_ids)}, "status": "queued"},
+            {"$set": {"status": "cancelled", "finished": time()}})
@@ -1,13 +1,27 @@
 import yaml
-from importlib import import_module
-import pkgutil
+import inspect
+import threading
+import sys
+import asyncio
 from collections import OrderedDict
-from pymongo import MongoClient
+from datetime import timedelta
 from time import time
-import cProfile
-import pstats
-import io
-from pstats import SortKey
+from kahi.Scheduler import Scheduler
+from kahi.ClientManager import ClientManager
+from kahi.LogWriter import LogWriter
+from kahi.PluginLoader import PluginLoader
+from kahi.Metrics import StepMetrics
+from kahi.Profiler import Profiler
+from kahi.Fingerprint import Fingerprint
+from kahi.LookupCache import LookupCache
+from kahi.StepConfig import StepConfig, interpolate, thaw
+from kahi.IsolatedExecutor import IsolatedExecutor
+from kahi.AsyncExecutor import AsyncExecutor
+from kahi.DistributedExecutor import DistributedExecutor
+from kahi.JobQueue import JobQueue
+from kahi.Worker import Worker
+from kahi.IndexManager import IndexManager
+from concurrent.futures import Future
 
 
 class OrderedLoader(yaml.SafeLoader):
@@ -21,18 +35,226 @@ class OrderedLoader(yaml.SafeLoader):
             construct_dict_order)
 
 
+class PluginRun:
+    """
+    Instance of the plugin of a step and the measures of its execution,
+    used by run_plugin and run_plugin_async.
+    """
+
+    def __init__(self, plugin_prefix, step, profile=None, checkpoint=None, use_log=True, writes=None,
+                 watermarks=None):
+        LookupCache.synchronize(writes)
+        plugin_config = step.plugin_config()
+        plugin_class = PluginLoader(plugin_prefix).load(step.module_name)
+        self.plugin = plugin_class(config=plugin_config)
+        self.plugin.client_manager = ClientManager.default()
+        self.plugin.log_id = step.log_id
+        self.plugin.use_log = use_log
+        self.plugin.checkpoint_data = checkpoint
+        self.plugin.watermark_data = watermarks
+
+        self.metrics = StepMetrics(
+            ignore_databases=[plugin_config.get("log_database")],
+            count_bytes=plugin_config.get("metrics_bytes", False))
+        self.profiler = Profiler(step.log_id, **profile) if profile is not None else None
+        self.time_start = None
+        self.time_elapsed = None
+        self.progress = None
+        self.profile_summary = None
+
+    def is_async(self):
+        """
+        Returns True if the plugin implements the coroutine run_async
+        """
+        return inspect.iscoroutinefunction(getattr(self.plugin, "run_async", None))
+
+    def start(self, shared=False):
+        """
+        Starts the measures of the step, shared is True for the async steps
+        that run in the event loop of kahi with other steps
+        """
+        if self.profiler:
+            self.profiler.start()
+        self.metrics.start(shared)
+        self.time_start = time()
+
+    def stop(self, error=None):
+        """
+        Stops the measures of the step, also when the plugin failed.
+        The metrics and the profile summary of a failed step are attached
+        to the exception as step_metrics and step_profile.
+        """
+        self.time_elapsed = time() - self.time_start
+        self.progress = self.stop_progress()
+        self.metrics.stop()
+        LookupCache.invalidate_namespaces(self.metrics.metrics["written"])
+        self.profile_summary = self.stop_profiler()
+        if error is not None:
+            error.step_metrics = self.metrics.metrics
+            error.step_profile = self.profile_summary
+
+    def stop_profiler(self):
+        """
+        Stops the profiler and returns its summary, an error saving the profile does not fail the step
+        """
+        if self.profiler is None:
+            return None
+        try:
+            return self.profiler.stop()
+        except Exception as e:
+            print("Profile of {} not saved: {}".format(self.profiler.log_id, e), file=sys.stderr)
+            return None
+
+    def result(self, status):
+        """
+        Returns the result of the step
+        """
+        return {
+            "status": status,
+            "time": self.time_start,
+            "time_elapsed": self.time_elapsed,
+            "metrics": self.metrics.metrics,
+            "profile": self.profile_summary,
+            "watermarks": self.plugin.__dict__.get("new_watermarks", []),
+            "progress": self.progress
+        }
+
+    def close_bulk_writers(self):
+        """
+        Flushes the operations left in the BulkWriters of the plugin after run returns
+        """
+        for writer in self.plugin.__dict__.pop("bulk_writers", []):
+            writer.close()
+
+    def stop_progress(self):
+        """
+        Stops the progress monitor of the plugin, also when the plugin failed,
+        and returns the final progress
+        """
+        monitor = self.plugin.__dict__.pop("progress_monitor", None)
+        return monitor.stop() if monitor else None
+
+    async def run_async(self):
+        """
+        Runs run_async of the plugin in its own event loop and closes the async clients of the loop
+        """
+        try:
+            return await self.plugin.run_async()
+        finally:
+            await self.plugin.client_manager.close_async()
+
+
+def run_plugin(plugin_prefix, step, profile=None, checkpoint=None, use_log=True, writes=None, watermarks=None):
+    """
+    Creates an instance of the plugin and runs it.
+    This function is executed in the worker processes when the workflow
+    runs steps in parallel, so it only receives picklable arguments.
+    Plugins that implement the coroutine run_async run in a new event loop.
+
+    Parameters:
+    ____________
+    plugin_prefix:str
+        prefix of the plugin packages
+    step:StepConfig
+        resolved configuration of the step
+    profile:dict
+        parameters of the Profiler, None to run without profiling
+    checkpoint:object
+        value saved with KahiBase.checkpoint in the previous run of the step
+    use_log:bool
+        if True the plugin can save checkpoints in the log
+    writes:dict
+        number of steps that wrote to every collection, to invalidate the lookup caches
+    watermarks:list
+        watermarks of the collections read with KahiBase.changed_records in the previous run
+
+    Returns:
+    ____________
+    dict with the status returned by the plugin, the start time, the elapsed time,
+    the metrics of the step, the profile summary, the new watermarks and the final progress
+    """
+    plugin_run = PluginRun(plugin_prefix, step, profile, checkpoint, use_log, writes, watermarks)
+    error = None
+    plugin_run.start()
+    try:
+        if plugin_run.is_async():
+            status = asyncio.run(plugin_run.run_async())
+        else:
+            status = plugin_run.plugin.run()
+        plugin_run.close_bulk_writers()
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        plugin_run.stop(error)
+    return plugin_run.result(status)
+
+
+async def run_plugin_async(plugin_prefix, step, profile=None, checkpoint=None, use_log=True, writes=None,
+                           watermarks=None):
+    """
+    Coroutine version of run_plugin for the plugins that implement run_async,
+    used to run several async steps concurrently in the event loop of AsyncExecutor.
+    The operations counted in the metrics of the steps running at the same time include
+    the ones of each other, since they share the process, the written collections are
+    the ones of the step. cProfile can not separate the steps that share the thread,
+    so the profile is taken in sampling mode.
+    The parameters and the result are the ones of run_plugin.
+    """
+    if profile is not None and profile.get("mode", "cprofile") == "cprofile":
+        print("Plugin {} is profiled in sampling mode, cprofile can not profile the async steps".format(
+            step.log_id), file=sys.stderr)
+        profile = dict(profile, mode="sampling")
+    plugin_run = PluginRun(plugin_prefix, step, profile, checkpoint, use_log, writes, watermarks)
+    if not plugin_run.is_async():
+        raise TypeError("Plugin {} is declared as async but it does not implement the coroutine run_async".format(
+            step.module_name))
+    error = None
+    plugin_run.start(shared=True)
+    try:
+        status = await plugin_run.plugin.run_async()
+        plugin_run.close_bulk_writers()
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        plugin_run.stop(error)
+    return plugin_run.result(status)
+
+
 class Kahi:
     def __init__(self, workflow_file, verbose=0, use_log=True):
         self.plugin_prefix = "kahi_"
+        # parameters of the workflow entries used by kahi, not passed to the plugins
+        self.reserved_parameters = ("depends_on", "profile", "inputs", "bulk_load")
         self.workflow_file = workflow_file
         self.workflow = None
         self.config = None
-        self.plugins = {}
+        self.indexes = None
+        self.index_manager = None
+        self.plugins = PluginLoader(self.plugin_prefix)
+        self.scheduler = None
+        self.metrics = {}
+        self.fingerprints = {}
+        self.writes = {}
+        self.steps = {}
+        self.executed = set()
 
         self.client = None
+        self.client_manager = ClientManager.default()
 
         self.log_db = None
         self.log = None
+        self.log_writer = None
+        self.log_projection = {
+            "status": 1,
+            "time": 1,
+            "time_elapsed": 1,
+            "plugin_version": 1,
+            "checkpoint": 1,
+            "watermarks": 1,
+            "fingerprint": 1
+        }
         self.use_log = use_log
         self.verbose = verbose
 
@@ -43,187 +265,765 @@ class Kahi:
         with open(self.workflow_file, "r") as stream:
             data = yaml.load(stream, Loader=OrderedLoader)
             self.workflow = data["workflow"]
-            self.config = data["config"]
-            self.client = MongoClient(self.config["database_url"])
+            self.config = interpolate(data["config"], where="config")
+            self.indexes = interpolate(data.get("indexes"), where="indexes")
+            self.steps = {}
+            self.client = None
+            self.get_client()
             if self.verbose > 4:
                 print(data)
 
+    def get_client(self):
+        """
+        Returns the shared client of the database_url of the config, it is requested again
+        from the client manager after close, so the same instance can run the workflow again
+        """
+        if self.client is None:
+            self.client = self.client_manager.get_client(
+                self.config["database_url"], **(self.config.get("client_options") or {}))
+        return self.client
+
     def load_plugins(self, verbose=0):
         """
-        Loads all plugins available in the system
+        Finds the plugins available in the system without importing them
         """
         discovered_plugins = {
-            name: import_module(name)
-            for finder, name, ispkg
-            in pkgutil.iter_modules()
-            if name.startswith(self.plugin_prefix + "_")
+            name: self.plugins.package(name)
+            for name in self.plugins.entry_points().keys()
         }
+        for log_id in (self.workflow or {}).keys():
+            name = log_id.split("/")[0]
+            if name not in discovered_plugins and self.plugins.available(name):
+                discovered_plugins[name] = self.plugins.package(name)
         self.discovered_plugins = discovered_plugins
+        return discovered_plugins
+
+    def workflow_log_ids(self):
+        """
+        Returns the ids of the log entries the workflow can have,
+        the entries and the shards of the list-valued entries.
+        """
+        log_ids = []
+        for log_id, params in self.workflow.items():
+            log_ids.append(log_id)
+            if isinstance(params, list):
+                log_ids.extend("{}[{}]".format(log_id, i)
+                               for i in range(len(params)))
+        return log_ids
 
     def retrieve_logs(self):
         """
-        Retrieves the logs from the database
+        Retrieves from the database the logs of the steps of the workflow,
+        only the fields needed to decide if a step must run.
         """
 
-        self.log_db = self.client[self.config["log_database"]]
-        log = list(self.log_db[self.config["log_collection"]].find())
-        if log:
-            self.log = log
+        self.log_db = self.get_client()[self.config["log_database"]]
+        self.log = {}
+        for log in self.log_db[self.config["log_collection"]].find(
+                {"_id": {"$in": self.workflow_log_ids()}}, self.log_projection):
+            self.log[log["_id"]] = log
 
         if self.verbose > 1:
             print("Log retrieved from database")
         if self.verbose > 4:
-            print(log)
+            print(self.log)
+
+    def refresh_log(self, *log_ids):
+        """
+        Reloads from the database the log entries of the given ids
+        """
+        found = set()
+        for log in self.log_db[self.config["log_collection"]].find(
+                {"_id": {"$in": list(log_ids)}}, self.log_projection):
+            self.log[log["_id"]] = log
+            found.add(log["_id"])
+        for log_id in log_ids:
+            if log_id not in found:
+                self.log.pop(log_id, None)
+
+    def entry(self, log_id):
+        """
+        Returns the workflow entry and the shard index of a step,
+        the shard is None if the entry is not split.
+        """
+        if self.scheduler and log_id in self.scheduler.nodes:
+            return self.scheduler.nodes[log_id]
+        return log_id, None
+
+    def module_name(self, log_id):
+        """
+        Returns the plugin name of a workflow entry
+        """
+        return self.entry(log_id)[0].split("/")[0]
+
+    def step(self, log_id):
+        """
+        Returns the StepConfig of a step, resolved the first time it is needed:
+        the global config plus the entry parameters with the task injected and
+        the environment variables interpolated, see kahi.StepConfig.
+        The reserved parameters (depends_on, profile, inputs...) are not passed to the plugin.
+        If the step is a shard, the plugin receives a list with the element
+        of the shard.
+        """
+        step = self.steps.get(log_id)
+        if step is None:
+            entry, shard = self.entry(log_id)
+            step = StepConfig.build(self.config, self.workflow, log_id, entry, shard,
+                                    self.reserved_parameters)
+            self.steps[log_id] = step
+        return step
+
+    def step_config(self, log_id):
+        """
+        Returns a copy of the configuration passed to the plugin of a step
+        """
+        return self.step(log_id).plugin_config()
+
+    def profile_config(self, log_id):
+        """
+        Returns the parameters of the Profiler for a step or None if the step is not profiled.
+        profile can be set in the config section for all the steps and in a step to
+        override it, as a boolean or a mapping with the parameters of the Profiler
+        (mode, directory, top, collapsed, interval).
+        """
+        profile = self.config.get("profile", False)
+        reserved = self.step(log_id).reserved
+        if "profile" in reserved:
+            step_profile = reserved["profile"]
+            if isinstance(step_profile, dict) and isinstance(profile, dict):
+                profile = dict(profile, **step_profile)
+            elif isinstance(step_profile, dict) or not step_profile:
+                profile = step_profile
+            elif not profile:
+                profile = True
+        if not profile:
+            return None
+        if not isinstance(profile, dict):
+            return {}
+        return dict(profile)
+
+    def checkpoint(self, log_id):
+        """
+        Returns the checkpoint saved by the plugin in the previous run of the step
+        """
+        if not self.use_log or not self.log:
+            return None
+        checkpoint = self.log.get(log_id, {}).get("checkpoint")
+        if checkpoint is None:
+            return None
+        if self.verbose > 4:
+            print("Resuming plugin {} from checkpoint {}".format(
+                log_id, checkpoint["value"]))
+        return checkpoint["value"]
+
+    def watermarks(self, log_id):
+        """
+        Returns the watermarks saved by the previous successful run of the step,
+        they are discarded if the parameters of the step or the version of the plugin changed
+        """
+        if not self.use_log or not self.log:
+            return None
+        fingerprint = self.watermark_fingerprint(log_id)
+        return [watermark for watermark in self.log.get(log_id, {}).get("watermarks") or []
+                if watermark.get("fingerprint") == fingerprint]
+
+    def watermark_fingerprint(self, log_id):
+        """
+        Returns the fingerprint of the parameters of the step and the version of the plugin,
+        without the inputs that change every time the collections are updated
+        """
+        step = self.step(log_id)
+        return Fingerprint(self.config, self.client_manager).step(
+            step.params, self.plugins.version(step.module_name)())
+
+    def step_fingerprint(self, log_id):
+        """
+        Returns the fingerprint of the step, see kahi.Fingerprint
+        """
+        step = self.step(log_id)
+        return Fingerprint(self.config, self.client_manager).step(
+            step.params,
+            self.plugins.version(step.module_name)(),
+            step.reserved.get("inputs"))
+
+    def is_changed(self, log_id):
+        """
+        Returns True if the fingerprint of the step changed since its last run
+        or if a step it declares in depends_on ran in this workflow, the implicit
+        dependency on the previous step only keeps the order of the steps.
+        The checkpoint of a changed step is discarded.
+        """
+        self.fingerprints[log_id] = self.step_fingerprint(log_id)
+        upstream = [dependency for dependency in self.scheduler.declared.get(log_id, [])
+                    if dependency in self.executed]
+        log = self.log.get(log_id) or self.log.get(self.entry(log_id)[0]) or {}
+        stored = log.get("fingerprint")
+        changed = stored is not None and stored != self.fingerprints[log_id]
+        if changed and log_id in self.log:
+            self.log[log_id].pop("checkpoint", None)
+        if self.verbose > 4:
+            if changed:
+                print("Plugin {} changed since its last run".format(log_id))
+            elif upstream:
+                print("Plugin {} depends on {} which ran".format(
+                    log_id, ", ".join(upstream)))
+        return changed or bool(upstream)
+
+    def is_executed(self, log_id):
+        """
+        Returns True if the step finished successfully in a previous run,
+        the shards of an entry are skipped if the whole entry finished.
+        With incremental in the config section, the steps whose fingerprint
+        changed and the steps that declare them in depends_on run again.
+        A skipped step without fingerprint in the log (it ran without incremental)
+        gets the current one, so its next changes are found.
+        """
+        executed_module = False
+        if self.use_log:
+            log_ids = set([log_id, self.entry(log_id)[0]])
+            self.refresh_log(*log_ids)
+            executed_id = None
+            for _id in log_ids:
+                if self.log.get(_id, {}).get("status") == 0:
+                    executed_module = True
+                    executed_id = _id
+                    break
+            if self.config.get("incremental", False):
+                if self.is_changed(log_id):
+                    executed_module = False
+                elif executed_module and "fingerprint" not in self.log[executed_id] and self.log_writer:
+                    self.log[executed_id]["fingerprint"] = self.fingerprints[log_id]
+                    self.log_writer.write(executed_id, {"fingerprint": self.fingerprints[log_id]})
+        if executed_module and self.verbose > 4:
+            print("Skipped plugin: " + self.plugin_prefix + log_id)
+        if executed_module and self.index_manager:
+            self.index_manager.finished(log_id)
+        if not executed_module:
+            self.executed.add(log_id)
+        return executed_module
+
+    def log_entry(self, log_id, **fields):
+        """
+        Returns the fields saved in the log for a step
+        """
+        step = self.step(log_id)
+        plugin_class_version = self.plugins.version(step.module_name)
+        entry = {
+            "plugin_version": plugin_class_version(),
+            "config": thaw(step.params)
+        }
+        if log_id in self.fingerprints:
+            entry["fingerprint"] = self.fingerprints[log_id]
+        entry.update(fields)
+        return entry
+
+    def submit_step(self, executor, log_id):
+        """
+        Submits the step to the executor of the scheduler
+        """
+        if self.verbose > 4:
+            print("Running plugin: " + self.plugin_prefix + log_id)
+        if self.log_writer:
+            self.log_writer.started(log_id, self.log_entry(
+                log_id,
+                time=int(time()),
+                status=-1,
+                message="running"
+            ))
+        # async steps share the event loop of kahi when the executor has one
+        function = run_plugin
+        if isinstance(executor, AsyncExecutor) and self.plugins.is_async(self.module_name(log_id)):
+            function = run_plugin_async
+        args = (
+            self.plugin_prefix,
+            self.step(log_id),
+            self.profile_config(log_id),
+            self.checkpoint(log_id),
+            self.use_log,
+            dict(self.writes),
+            self.watermarks(log_id))
+        if self.index_manager:
+            future = Future()
+            if self.scheduler.max_workers == 1:
+                self.prepare_and_submit(future, executor, log_id, function, args)
+            else:
+                # the scheduler keeps running the other steps while the indexes are dropped or built
+                threading.Thread(target=self.prepare_and_submit, args=(future, executor, log_id, function, args),
+                                 name="kahi-indexes", daemon=True).start()
+            return future
+        return executor.submit(function, *args)
+
+    def prepare_and_submit(self, future, executor, log_id, function, args):
+        """
+        Prepares the indexes of a step and submits it, the result of the step is set in future
+        """
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            self.prepare_indexes(log_id)
+            step_future = executor.submit(function, *args)
+        except Exception as e:
+            future.set_exception(e)
+            return
+
+        def done(step_future):
+            error = step_future.exception()
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(step_future.result())
+        step_future.add_done_callback(done)
+
+    def step_succeeded(self, log_id, result):
+        """
+        Saves the log of a step that finished
+        """
+        if self.verbose > 4:
+            print("Plugin {} finished in {} seconds".format(
+                log_id,
+                result["time_elapsed"]
+            ))
+            if result.get("progress"):
+                print("Plugin {} processed {:,} {} at {:,.1f} {}/s".format(
+                    log_id, result["progress"]["processed"], result["progress"]["unit"],
+                    result["progress"]["rate"], result["progress"]["unit"]))
+        self.metrics[log_id] = result["metrics"]
+        if self.index_manager:
+            self.index_manager.finished(log_id)
+        for namespace in result["metrics"]["written"]:
+            self.writes[namespace] = self.writes.get(namespace, 0) + 1
+        if self.log_writer:
+            fields = {}
+            # the documents of a step that reports a failure are read again in the next run
+            if result.get("watermarks") and result["status"] == 0:
+                fields["watermarks"] = self.merge_watermarks(log_id, result["watermarks"])
+            if result.get("progress"):
+                fields["progress"] = result["progress"]
+            self.log_writer.finished(log_id, self.log_entry(
+                log_id,
+                time=int(result["time"]),
+                status=result["status"],
+                message="ok",
+                time_elapsed=int(result["time_elapsed"]),
+                metrics=result["metrics"],
+                profile=result["profile"],
+                **fields
+            ), unset=["checkpoint"] if result["status"] == 0 else None)
+        if result["profile"] and self.verbose > 4:
+            print("Profile of {} saved in {}".format(
+                log_id, result["profile"].get("file", result["profile"].get("collapsed_file"))))
+        if self.config.get("metrics_file"):
+            StepMetrics.write_prometheus(
+                self.config["metrics_file"], self.metrics)
+
+    def merge_watermarks(self, log_id, watermarks):
+        """
+        Returns the watermarks of the previous run of the step updated with the new ones
+        """
+        keys = ("collection", "field", "source", "change_stream")
+        fingerprint = self.watermark_fingerprint(log_id)
+        new_keys = [tuple(watermark.get(name) for name in keys) for watermark in watermarks]
+        merged = [watermark for watermark in self.watermarks(log_id) or []
+                  if tuple(watermark.get(name) for name in keys) not in new_keys]
+        return merged + [dict(watermark, fingerprint=fingerprint) for watermark in watermarks]
+
+    def step_failed(self, log_id, exception):
+        """
+        Saves the log of a step that raised an exception
+        """
+        if self.index_manager:
+            self.index_manager.finished(log_id)
+        metrics = getattr(exception, "step_metrics", None)
+        fields = {}
+        if metrics:
+            self.metrics[log_id] = metrics
+            for namespace in metrics["written"]:
+                self.writes[namespace] = self.writes.get(namespace, 0) + 1
+            fields["metrics"] = metrics
+        profile_summary = getattr(exception, "step_profile", None)
+        if profile_summary:
+            fields["profile"] = profile_summary
+        if self.log_writer:
+            self.log_writer.finished(log_id, self.log_entry(
+                log_id,
+                time=int(time()),
+                status=1,
+                message=str(exception),
+                time_elapsed=int(metrics["wall_time"]) if metrics else 0,
+                **fields
+            ), event="failed")
+        print("Plugin {} failed: {}".format(log_id, exception))
+        if metrics and self.config.get("metrics_file"):
+            StepMetrics.write_prometheus(
+                self.config["metrics_file"], self.metrics)
+
+    def close(self, raise_errors=True):
+        """
+        Saves the pending log writes and closes the database clients shared by the steps.
+        An error saving the log is printed and raised if raise_errors is True, it is False
+        when the workflow already failed, so its exception is not replaced.
+        """
+        error = None
+        try:
+            if self.index_manager:
+                self.index_manager.close()
+            if self.log_writer:
+                self.log_writer.close()
+        except Exception as e:
+            print("The log of the workflow could not be saved: {}".format(e), file=sys.stderr)
+            error = e
+        finally:
+            self.index_manager = None
+            self.log_writer = None
+            self.client_manager.close()
+        self.client = None
+        self.log_db = None
+        self.log = None
+        if error is not None and raise_errors:
+            raise error
+
+    def build_scheduler(self):
+        """
+        Builds the DAG of the workflow and the StepConfig of its steps, it raises ValueError
+        if the dependencies are not valid or an environment variable is not set
+        """
+        self.scheduler = Scheduler(
+            self.workflow,
+            max_workers=self.config.get("max_workers", 1),
+            fan_out=self.config.get("fan_out", False),
+            fan_out_workers=self.config.get("fan_out_workers", None),
+            executor_factory=self.executor_factory(),
+            verbose=self.verbose)
+        # resolve the configuration of every step once, before running any of them
+        self.steps = {}
+        for log_id in self.scheduler.nodes.keys():
+            self.step(log_id)
+        return self.scheduler
+
+    def build_index_manager(self):
+        """
+        Returns the IndexManager of the indexes section with the steps that bulk load
+        collections registered, None if the workflow does not declare indexes
+        """
+        if not self.indexes:
+            return None
+        manager = IndexManager(self.indexes, self.config, self.client_manager,
+                               on_built=self.indexes_built, verbose=self.verbose)
+        for log_id in self.scheduler.nodes.keys():
+            manager.register(log_id, self.step(log_id).reserved.get("bulk_load"))
+        return manager
+
+    def prepare_indexes(self, log_id):
+        """
+        Drops the indexes of the collections the step bulk loads and waits
+        for the indexes of the collections it declares in inputs
+        """
+        step = self.step(log_id)
+        loads = self.index_manager.namespaces(step.reserved.get("bulk_load"))
+        dropped = self.index_manager.drop(log_id, loads)
+        if self.log_writer:
+            for namespace, names in dropped.items():
+                self.log_writer.event(log_id, "indexes_dropped", collection=namespace, indexes=names)
+        reads = [namespace for namespace in self.index_manager.namespaces(step.reserved.get("inputs"))
+                 if namespace not in loads]
+        waited = self.index_manager.wait(log_id, reads)
+        if reads and self.verbose > 4:
+            print("Plugin {} waited {:.1f} seconds for the indexes of {}".format(
+                log_id, waited, ", ".join(reads)))
+
+    def finish_indexes(self, raise_errors=True):
+        """
+        Builds the indexes still missing at the end of the workflow. An error is printed
+        and raised if raise_errors is True, it is False when a step already failed.
+        """
+        if not self.index_manager:
+            return
+        try:
+            self.index_manager.finish()
+        except Exception as e:
+            print("The indexes could not be built: {}".format(e), file=sys.stderr)
+            if raise_errors:
+                raise
+
+    def indexes_built(self, log_id, result):
+        """
+        Records in the log of the step the build of the indexes of a collection
+        """
+        if "error" in result:
+            print("Indexes of {} failed after {:.1f} seconds: {}".format(
+                result["collection"], result["seconds"], result["error"]))
+        elif self.verbose > 4:
+            print("Indexes of {} built in {:.1f} seconds".format(result["collection"], result["seconds"]))
+        if self.log_writer and log_id is not None:
+            self.log_writer.event(log_id, "indexes_built", **result)
+
+    def isolated_executor(self):
+        """
+        Returns an IsolatedExecutor for the isolation section of the config, None if it is not set.
+
+        isolation: true runs every step in a new process, or a dict with
+            start_method: forkserver (default) or spawn
+            max_rss: maximum resident memory of a step in MB
+            timeout: maximum seconds of a step
+        """
+        isolation = self.config.get("isolation")
+        if not isolation:
+            return None
+        if not isinstance(isolation, dict):
+            isolation = {}
+        return IsolatedExecutor(
+            start_method=isolation.get("start_method", "forkserver"),
+            max_rss=isolation.get("max_rss"),
+            timeout=isolation.get("timeout"))
+
+    def distributed_config(self):
+        """
+        Returns the distributed section of the config, with the defaults
+            queue_collection: collection of the jobs, log_collection with the _queue suffix
+            lease: seconds a worker owns a job without a heartbeat, 300
+            max_attempts: maximum number of times a job is claimed, 3
+            poll_interval: seconds between checks of the queue, 2
+            retry_timeout: seconds the coordinator retries while the queue can not be reached, the lease
+        """
+        distributed = self.config.get("distributed")
+        distributed = dict(distributed) if isinstance(distributed, dict) else {}
+        distributed.setdefault("queue_collection", self.config["log_collection"] + "_queue")
+        distributed.setdefault("lease", 300)
+        distributed.setdefault("max_attempts", 3)
+        distributed.setdefault("poll_interval", 2)
+        distributed.setdefault("retry_timeout", distributed["lease"])
+        return distributed
+
+    def job_queue(self):
+        """
+        Returns the queue of the steps in the log database
+        """
+        return JobQueue(self.get_client()[self.config["log_database"]][
+            self.distributed_config()["queue_collection"]])
+
+    def executor_factory(self):
+        """
+        Returns a function that creates the executor of the steps from the distributed
+        or isolation sections of the config. By default the async steps run in an event
+        loop of the process of kahi and the others in the executor of the scheduler.
+        """
+        if self.config.get("distributed"):
+            distributed = self.distributed_config()
+
+            def factory():
+                return DistributedExecutor(
+                    self.job_queue(),
+                    lease=distributed["lease"],
+                    max_attempts=distributed["max_attempts"],
+                    poll_interval=distributed["poll_interval"],
+                    retry_timeout=distributed["retry_timeout"])
+            return factory
+        if self.config.get("isolation"):
+            return self.isolated_executor
+
+        def factory():
+            return AsyncExecutor(self.scheduler.process_executor())
+        return factory
+
+    def work(self, max_jobs=None, idle_timeout=None):
+        """
+        Runs as a worker the steps queued by the workflows with the distributed section,
+        in new processes if the isolation section is set.
+
+        Parameters:
+        ____________
+        max_jobs:int
+            the worker stops after max_jobs steps, None for no limit
+        idle_timeout:float
+            the worker stops after idle_timeout seconds without steps, None to wait forever
+
+        Returns:
+        ____________
+        number of steps executed
+        """
+        if not self.workflow:
+            self.load_workflow()
+        distributed = self.distributed_config()
+        worker = Worker(
+            self.job_queue(),
+            run_plugin,
+            executor=self.isolated_executor(),
+            lease=distributed["lease"],
+            poll_interval=distributed["poll_interval"],
+            max_jobs=max_jobs,
+            idle_timeout=idle_timeout,
+            verbose=self.verbose)
+        if self.verbose > 0:
+            print("Worker {} waiting for steps".format(worker.id))
+        try:
+            jobs = worker.run()
+        except BaseException:
+            self.close(raise_errors=False)
+            raise
+        self.close()
+        return jobs
+
+    def estimate(self, log_id):
+        """
+        Returns the seconds the step took in its last successful run, None if unknown
+        """
+        for _id in (log_id, self.entry(log_id)[0]):
+            log = self.log.get(_id) if self.log else None
+            if log and log.get("status") == 0 and log.get("time_elapsed") is not None:
+                return log["time_elapsed"]
+        return None
+
+    def plan(self):
+        """
+        Validates the workflow and returns what run would do without running any plugin:
+        the steps that are skipped or run, the missing plugins, the estimated durations
+        from the log and the critical path.
+
+        Returns:
+        ____________
+        dict with the steps (action and estimate), errors, estimated times and critical path
+        """
+        if not self.workflow:
+            self.load_workflow()
+        if self.log is None:
+            self.retrieve_logs()
+        self.executed = set()
+
+        errors = []
+        invalid = set()
+        for log_id, params in self.workflow.items():
+            module_name = log_id.split("/")[0]
+            if not isinstance(params, (dict, list)):
+                errors.append("Step {} parameters must be a mapping or a list".format(log_id))
+                invalid.add(log_id)
+            elif isinstance(params, list) and not all(isinstance(item, dict) for item in params):
+                errors.append("Step {} parameters must be a list of mappings".format(log_id))
+                invalid.add(log_id)
+            if not self.plugins.available(module_name):
+                errors.append("Plugin {} not found. Try pip install {}".format(
+                    module_name, self.plugin_prefix + module_name))
+                invalid.add(log_id)
+        plan = {"steps": OrderedDict(), "errors": errors}
+        try:
+            self.build_scheduler()
+        except ValueError as e:
+            errors.append(str(e))
+            return plan
+        try:
+            IndexManager.parse(self.indexes, self.config)
+        except ValueError as e:
+            errors.append(str(e))
+
+        finish = {}
+        previous = {}
+        for log_id in self.scheduler.order():
+            entry = self.entry(log_id)[0]
+            if entry in invalid:
+                action = "invalid"
+            else:
+                action = "skip" if self.is_executed(log_id) else "run"
+            estimate = self.estimate(log_id)
+            plan["steps"][log_id] = {"action": action, "estimate": estimate}
+            start = 0
+            for dependency in self.scheduler.dependencies[log_id]:
+                if finish[dependency] >= start:
+                    start = finish[dependency]
+                    previous[log_id] = dependency
+            finish[log_id] = start + ((estimate or 0) if action == "run" else 0)
+
+        to_run = [step for step in plan["steps"].values() if step["action"] == "run"]
+        plan["total"] = sum(step["estimate"] or 0 for step in to_run)
+        plan["unknown"] = [log_id for log_id, step in plan["steps"].items()
+                           if step["action"] == "run" and step["estimate"] is None]
+        critical_path = []
+        if finish:
+            log_id = max(reversed(list(finish.keys())), key=lambda node: finish[node])
+            plan["critical_time"] = finish[log_id]
+            while log_id is not None:
+                if plan["steps"][log_id]["action"] == "run":
+                    critical_path.append(log_id)
+                log_id = previous.get(log_id)
+        else:
+            plan["critical_time"] = 0
+        plan["critical_path"] = list(reversed(critical_path))
+        plan["estimated_time"] = max(
+            plan["critical_time"], plan["total"] / self.scheduler.max_workers)
+        return plan
+
+    def print_plan(self, plan=None):
+        """
+        Prints the plan of the workflow, see plan
+        """
+        if plan is None:
+            plan = self.plan()
+
+        def duration(seconds):
+            return "?" if seconds is None else str(timedelta(seconds=int(seconds)))
+
+        print("Workflow plan: {}".format(self.workflow_file))
+        if plan["steps"]:
+            width = max(len(log_id) for log_id in plan["steps"].keys())
+            for log_id, step in plan["steps"].items():
+                print("  {}  {:7}  {}".format(
+                    log_id.ljust(width), step["action"], duration(step["estimate"])))
+            to_run = sum(1 for step in plan["steps"].values() if step["action"] == "run")
+            print("Steps to run: {} of {}".format(to_run, len(plan["steps"])))
+            print("Estimated time: {} ({} sequential, {} workers)".format(
+                duration(plan["estimated_time"]), duration(plan["total"]), self.scheduler.max_workers))
+            print("Critical path ({}): {}".format(
+                duration(plan["critical_time"]), " -> ".join(plan["critical_path"]) or "-"))
+            if plan["unknown"]:
+                print("Steps without previous duration: {}".format(", ".join(plan["unknown"])))
+        if plan["errors"]:
+            print("Errors:")
+            for error in plan["errors"]:
+                print("  " + error)
+        return plan
 
     def run(self):
         if not self.workflow:
             self.load_workflow()
-        if not self.log:
+        if self.log is None:
             self.retrieve_logs()
 
-        # import modules
+        # check that the plugins are installed, they are imported right before their steps run
         for module_name in self.workflow.keys():
             if self.verbose > 4:
-                print("Loading plugin: " + self.plugin_prefix + module_name)
+                print("Looking for plugin: " + self.plugin_prefix + module_name)
             if len(module_name.split("/")) > 1:
                 module_name = module_name.split("/")[0]
-            try:
-                self.plugins[module_name] = import_module(
-                    self.plugin_prefix + module_name + "." + self.plugin_prefix.capitalize() + module_name)
-                self.plugins[module_name + "._version"] = import_module(
-                    self.plugin_prefix + module_name + "._version")
-            except ModuleNotFoundError as e:
-                if self.verbose > 0 and self.verbose < 5:
-                    print(e)
+            if not self.plugins.available(module_name):
+                if self.verbose > 4:
+                    raise ModuleNotFoundError(
+                        "No module named '{}'".format(self.plugin_prefix + module_name))
+                if self.verbose > 0:
                     print("Plugin {} not found.\nTry\n\tpip install {}".format(
                         module_name,
                         self.plugin_prefix + module_name
                     ))
-                    return None
-                if self.verbose > 4:
-                    raise
+                return None
 
         # run workflow
-        for log_id, params in self.workflow.items():
-            executed_module = False
-            log_split = log_id.split("/")
-            if len(log_split) > 1:
-                module_name = log_split[0]
-                params["task"] = log_split[1]
-            else:
-                module_name = log_id
+        self.executed = set()
+        try:
+            # the workflow is validated before the log writer starts its thread
+            self.build_scheduler()
             if self.use_log:
-                if self.log:
-                    for log in self.log:
-                        if log["_id"] == log_id:
-                            if log["status"] == 0:
-                                executed_module = True
-                                break
-            if executed_module:
-                if self.verbose > 4:
-                    print("Skipped plugin: " + self.plugin_prefix + log_id)
-                continue
-            if self.verbose > 4:
-                print("Running plugin: " + self.plugin_prefix + log_id)
-
-            plugin_class = getattr(
-                self.plugins[module_name],
-                self.plugin_prefix.capitalize() + module_name)
-
-            plugin_class_version = getattr(
-                self.plugins[module_name + "._version"], "get_version")
-
-            plugin_config = self.config.copy()
-            plugin_config[module_name] = self.workflow[log_id]
-            if isinstance(plugin_config[module_name], list):
-                for i in range(len(plugin_config[module_name])):
-                    plugin_config[module_name][i]["task"] = params["task"] if "task" in params else None
-            else:
-                plugin_config[module_name]["task"] = params["task"] if "task" in params else None
-            plugin_instance = plugin_class(config=plugin_config)
-
-            run = getattr(plugin_instance, "run")
+                self.log_writer = LogWriter(
+                    self.log_db[self.config["log_collection"]],
+                    heartbeat_interval=self.config.get("log_heartbeat", 60))
+            self.index_manager = self.build_index_manager()
             try:
-                if self.config["profile"]:
-                    pr = cProfile.Profile()
-                    pr.enable()
-                time_start = time()
-                status = run()
-                time_elapsed = time() - time_start
-                if self.config["profile"]:
-                    pr.disable()
-                    s = io.StringIO()
-                    sortby = SortKey.CUMULATIVE
-                    ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
-                    ps.print_stats()
-                    print(s.getvalue())
-                if self.verbose > 4:
-                    print("Plugin {} finished in {} seconds".format(
-                        log_id,
-                        time_elapsed
-                    ))
-                if self.use_log:
-                    if self.log_db[self.config["log_collection"]
-                                   ].find_one({"_id": log_id}):
-                        self.log_db[self.config["log_collection"]].update_one(
-                            {
-                                "_id": log_id
-                            },
-                            {"$set":
-                                {
-                                    "plugin_version": plugin_class_version(),
-                                    "config": plugin_config[module_name],
-                                    "time": int(time_start),
-                                    "status": status,
-                                    "message": "ok",
-                                    "time_elapsed": int(time_elapsed)
-                                }
-                             }
-                        )
-                    else:
-                        self.log_db[self.config["log_collection"]].insert_one(
-                            {
-                                "_id": log_id,
-                                "plugin_version": plugin_class_version(),
-                                "config": plugin_config[module_name],
-                                "time": int(time_start),
-                                "status": status,
-                                "message": "ok",
-                                "time_elapsed": int(time_elapsed)
-                            }
-                        )
-            except Exception as e:
-                if self.use_log:
-                    if self.log_db[self.config["log_collection"]
-                                   ].find_one({"_id": log_id}):
-                        self.log_db[self.config["log_collection"]].update_one(
-                            {
-                                "_id": log_id
-                            },
-                            {"$set":
-                                {
-                                    "plugin_version": plugin_class_version(),
-                                    "config": plugin_config[module_name],
-                                    "time": int(time()),
-                                    "status": 1,
-                                    "message": str(e),
-                                    "time_elapsed": 0
-                                }
-                             }
-                        )
-                    else:
-                        self.log_db[self.config["log_collection"]].insert_one(
-                            {
-                                "_id": log_id,
-                                "plugin_version": plugin_class_version(),
-                                "config": plugin_config[module_name],
-                                "time": int(time()),
-                                "status": 1,
-                                "message": str(e),
-                                "time_elapsed": 0
-                            }
-                        )
-                print("Plugin {} failed".format(log_id))
+                self.scheduler.run(self.submit_step, self.step_succeeded,
+                                   self.step_failed, skip=self.is_executed)
+            except BaseException:
+                # the collections are not left without indexes, also if a step failed
+                self.finish_indexes(raise_errors=False)
                 raise
+            self.finish_indexes()
+        except BaseException:
+            self.close(raise_errors=False)
+            raise
+        self.close()
         if self.verbose > 0:
             print("Workflow finished")
@@ -1,8 +1,332 @@
 
+from kahi.ClientManager import ClientManager
+from kahi.BulkWriter import BulkWriter
+from kahi.Entity import Entity
+from kahi.LookupCache import LookupCache
+from kahi.RecordReader import RecordReader
+from kahi.ParallelScan import ParallelScan
+from kahi.DeltaReader import DeltaReader
+from kahi.Progress import Progress, ProgressMonitor
+from kahi.BlockingIndex import BlockingIndex
+from time import time
+
+
 class KahiBase:
+    config = {}
+    client_manager = None
+    entity_classes = {}
+    # set by kahi before the plugin runs
+    log_id = None
+    use_log = False
+    checkpoint_data = None
+    watermark_data = None
+
     def __init__(self):
         pass
 
+    def get_client(self, url=None, **options):
+        """
+        Returns a MongoClient shared with the other steps of the workflow.
+        The client options are taken from client_options in the config section
+        and can be overridden with keyword arguments.
+
+        Parameters:
+        ____________
+        url:str
+            mongodb url, default is database_url from the config
+        options:dict
+            keyword arguments passed to MongoClient, ex: maxPoolSize
+        """
+        manager = self.client_manager or ClientManager.default()
+        client_options = dict(self.config.get("client_options") or {})
+        client_options.update(options)
+        if url is None:
+            url = self.config["database_url"]
+        return manager.get_client(url, **client_options)
+
+    def get_async_client(self, url=None, **options):
+        """
+        Returns an asyncio MongoDB client for run_async, shared with the other async
+        steps running in the same event loop. The options are the same as get_client.
+
+        Parameters:
+        ____________
+        url:str
+            mongodb url, default is database_url from the config
+        options:dict
+            keyword arguments passed to the client, ex: maxPoolSize
+        """
+        manager = self.client_manager or ClientManager.default()
+        client_options = dict(self.config.get("client_options") or {})
+        client_options.update(options)
+        if url is None:
+            url = self.config["database_url"]
+        return manager.get_async_client(url, **client_options)
+
+    def get_checkpoint(self, default=None):
+        """
+        Returns the value saved with checkpoint in the previous run of the step,
+        or default if the step starts from scratch. It is available in run().
+        """
+        if self.checkpoint_data is None:
+            return default
+        return self.checkpoint_data
+
+    def checkpoint(self, value):
+        """
+        Saves in the log entry of the step where the plugin is, ex: an offset in a file,
+        the last _id processed or a dict. If the step fails, the next run gets the value
+        with get_checkpoint to resume from there; it is removed when the step finishes.
+        The value must be BSON serializable, and the plugin should call it after the
+        work before the checkpoint was written to the database (ex: after a flush).
+
+        Parameters:
+        ____________
+        value:object
+            opaque cursor of the plugin
+        """
+        self.checkpoint_data = value
+        if not self.use_log or self.log_id is None:
+            return
+        collection = self.get_client()[self.config["log_database"]][self.config["log_collection"]]
+        collection.update_one(
+            {"_id": self.log_id},
+            {"$set": {"checkpoint": {"value": value, "time": int(time())}}},
+            upsert=True)
+
+    def watermark_key(self, collection, field="updated.time", source=None, change_stream=False):
+        return {"collection": collection.full_name, "field": field, "source": source,
+                "change_stream": change_stream}
+
+    def get_watermark(self, collection, field="updated.time", source=None, change_stream=False):
+        """
+        Returns the watermark of a collection saved by the previous successful run
+        of the step, None if there is not one. See changed_records.
+        """
+        key = self.watermark_key(collection, field, source, change_stream)
+        for watermark in self.watermark_data or []:
+            if all(watermark.get(name) == value for name, value in key.items()):
+                return watermark["value"]
+        return None
+
+    def set_watermark(self, collection, value, field="updated.time", source=None, change_stream=False):
+        """
+        Sets the new watermark of a collection, kahi saves it in the log when the step finishes
+        successfully. changed_records calls it after reading all the documents.
+        """
+        if "new_watermarks" not in self.__dict__:
+            self.new_watermarks = []
+        watermark = self.watermark_key(collection, field, source, change_stream)
+        self.new_watermarks = [item for item in self.new_watermarks
+                               if any(item.get(name) != key for name, key in watermark.items())]
+        watermark["value"] = value
+        self.new_watermarks.append(watermark)
+
+    def changed_records(self, collection, database=None, field="updated.time", source=None,
+                        change_stream=False, batch_size=1000, **kwargs):
+        """
+        Returns a DeltaReader that yields in batches the documents of a collection inserted
+        or modified since the previous successful run of the step, all of them in the first run.
+        The watermark of the collection is saved in the log entry of the step when all
+        the documents were read and the step finishes successfully.
+
+        Parameters:
+        ____________
+        collection:str or pymongo.collection.Collection
+            collection or name of a collection
+        database:str
+            database of the collection, default is database_name of the config
+        field:str
+            field with the time of the modification, default updated.time
+        source:str
+            only compare the provenance entries of a source, ex: openalex
+        change_stream:bool
+            if True use a change stream with resume token instead of field, needs a replica set
+        batch_size:int
+            number of documents of every batch
+        kwargs:dict
+            parameters of DeltaReader, ex: filter, projection
+        """
+        if isinstance(collection, str):
+            collection = self.get_client()[database or self.config["database_name"]][collection]
+
+        def on_complete(value):
+            self.set_watermark(collection, value, field, source, change_stream)
+        return DeltaReader(
+            collection,
+            previous=self.get_watermark(collection, field, source, change_stream),
+            field=field, source=source, change_stream=change_stream, batch_size=batch_size,
+            on_complete=on_complete, **kwargs)
+
+    def lookup_cache(self, collection, key, value="_id", database=None, preload=True, filter=None, **kwargs):
+        """
+        Returns a LookupCache to resolve the values of key into value, shared with
+        the other steps that run in the same process and invalidated by kahi when
+        a step writes to the collection.
+
+        Parameters:
+        ____________
+        collection:str or pymongo.collection.Collection
+            collection or name of a collection
+        key:str
+            field with the keys, ex: external_ids.id
+        value:str
+            field returned for a key, default _id
+        database:str
+            database of the collection, default is database_name of the config
+        preload:bool
+            if True the keys of the collection are loaded in bulk the first time
+        filter:dict
+            filter of the documents preloaded
+        kwargs:dict
+            parameters of LookupCache, ex: max_items. spill_directory defaults to
+            lookup_spill_directory of the config
+        """
+        if isinstance(collection, str):
+            collection = self.get_client()[database or self.config["database_name"]][collection]
+        kwargs.setdefault("spill_directory", self.config.get("lookup_spill_directory"))
+        cache = LookupCache.shared(collection, key, value, **kwargs)
+        if preload and not cache.preloaded:
+            cache.preload(filter)
+        return cache
+
+    def bulk_writer(self, collection, **kwargs):
+        """
+        Returns a BulkWriter that buffers the writes to a collection
+        and sends them in unordered bulk_write batches.
+        The writers not closed by the plugin are flushed when run returns.
+
+        Parameters:
+        ____________
+        collection:str or pymongo.collection.Collection
+            collection or name of a collection in database_name of the config
+        kwargs:dict
+            parameters of BulkWriter, ex: batch_size, max_bytes, retries
+        """
+        if isinstance(collection, str):
+            collection = self.get_client()[self.config["database_name"]][collection]
+        writer = BulkWriter(collection, **kwargs)
+        if "bulk_writers" not in self.__dict__:
+            self.bulk_writers = []
+        self.bulk_writers.append(writer)
+        return writer
+
+    def stream_records(self, paths, batch_size=10000, workers=1, **kwargs):
+        """
+        Returns a RecordReader that yields the records of CSV or JSON Lines files,
+        plain or compressed, in batches of batch_size dicts without loading the files in memory.
+
+        Parameters:
+        ____________
+        paths:str or list
+            path or glob pattern of the files, or a list of them, ex: openalex/works/*/*.gz
+        batch_size:int
+            number of records of every batch
+        workers:int
+            number of processes that parse the files in parallel
+        kwargs:dict
+            parameters of RecordReader, ex: format, chunk_size, encoding, delimiter
+        """
+        return RecordReader(paths, batch_size=batch_size, workers=workers, **kwargs)
+
+    def parallel_scan(self, collection, database=None, workers=None, **kwargs):
+        """
+        Returns a ParallelScan that splits a collection in _id ranges or hashed partitions
+        and processes them in worker processes, each one with its own client.
+        Use run to let the workers write the results or map to get them back.
+
+        Parameters:
+        ____________
+        collection:str
+            name of the collection
+        database:str
+            database of the collection, default is database_name of the config
+        workers:int
+            number of processes, default scan_workers of the config or the number of CPUs
+        kwargs:dict
+            parameters of ParallelScan, ex: partitions, mode, filter, projection, batch_size
+        """
+        return ParallelScan(
+            self.config["database_url"], database or self.config["database_name"], collection,
+            workers=workers or self.config.get("scan_workers"),
+            client_options=self.config.get("client_options"), **kwargs)
+
+    def progress(self, total=None, unit="records"):
+        """
+        Returns the Progress of the step, that the plugin updates with progress.update(count)
+        from its loops. When the step runs in kahi, a background thread samples it to show the
+        rate and the ETA, saves it in the log and flags the step if it stalls, with the
+        parameters of the progress section of the config: interval, log_interval,
+        stall_timeout and render. Calling it again sets the total of the same progress.
+
+        Parameters:
+        ____________
+        total:int
+            number of items to process, None if unknown
+        unit:str
+            name of the items, ex: works
+        """
+        progress = self.__dict__.get("step_progress")
+        if progress is not None:
+            progress.set_total(total)
+            return progress
+        progress = Progress(total, unit)
+        self.step_progress = progress
+        if self.log_id is None:
+            return progress
+        options = self.config.get("progress")
+        options = dict(options) if isinstance(options, dict) else {}
+        collection = None
+        if self.use_log:
+            collection = self.get_client()[self.config["log_database"]][self.config["log_collection"]]
+        self.progress_monitor = ProgressMonitor(self.log_id, collection, **options)
+        self.progress_monitor.watch(progress)
+        return progress
+
+    def blocking_index(self, **kwargs):
+        """
+        Returns an empty BlockingIndex to find the candidate records of person or affiliation
+        names in batch, without comparing every pair. It needs numpy (pip install kahi[blocking]).
+
+        Parameters:
+        ____________
+        kwargs:dict
+            parameters of BlockingIndex, ex: blocks, max_block_size, max_candidates
+        """
+        return BlockingIndex(**kwargs)
+
+    def entity_class(self, kind, omit_defaults=False):
+        """
+        Returns the Entity class generated from the template empty_<kind>,
+        the class is generated once per plugin class.
+
+        Parameters:
+        ____________
+        kind:str
+            work, person, affiliation, publisher, source, subjects, event,
+            project, patent or work_other
+        omit_defaults:bool
+            if True to_dict omits the fields with the default value
+        """
+        key = (type(self), kind, omit_defaults)
+        entity_class = KahiBase.entity_classes.get(key)
+        if entity_class is None:
+            template = getattr(self, "empty_" + kind)()
+            name = "".join(word.capitalize() for word in kind.split("_"))
+            entity_class = Entity.define(name, template, omit_defaults)
+            KahiBase.entity_classes[key] = entity_class
+        return entity_class
+
+    def entity(self, kind, **values):
+        """
+        Returns a compact record with the fields of empty_<kind>, see kahi.Entity.
+        The empty fields are only created when they are used, and
+        entity.to_dict() returns the document to save in the database.
+        config.entity_omit_defaults sets if to_dict omits the fields with the default value.
+        """
+        omit_defaults = self.config.get("entity_omit_defaults", False)
+        return self.entity_class(kind, omit_defaults)(**values)
+
     def empty_affiliation(self):
         entry = {
             "updated": [],
@@ -208,7 +532,8 @@ class KahiBase:
 
     def run(self):
         """
-        entry point for the execution of the plugin, this method must be implemented
+        entry point for the execution of the plugin, this method must be implemented,
+        unless the plugin implements the coroutine run_async instead
         """
         raise NotImplementedError(
             self.__class__.__name__ + '.run() not implemented')
@@ -0,0 +1,139 @@
+from pymongo import UpdateOne
+from time import time
+import threading
+import queue
+
+
+class LogWriter:
+    """
+    Writes the entries of the run log with atomic upserts.
+    The writes are queued and sent by a background thread in ordered batches,
+    so the steps are not blocked by the log, and every running step gets a
+    heartbeat timestamp every heartbeat_interval seconds.
+    Every entry keeps the last events of the step (started, finished, failed...)
+    in the events list.
+    """
+
+    def __init__(self, collection, heartbeat_interval=60, flush_interval=1.0, max_events=100):
+        """
+        Parameters:
+        ____________
+        collection:pymongo.collection.Collection
+            log collection
+        heartbeat_interval:float
+            seconds between heartbeats of the running steps, 0 disables them
+        flush_interval:float
+            maximum seconds a write waits in the queue
+        max_events:int
+            number of events kept in every entry
+        """
+        self.collection = collection
+        self.heartbeat_interval = heartbeat_interval
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+
+        self.queue = queue.Queue()
+        self.running = set()
+        self.error = None
+        self.stop = threading.Event()
+        self.thread = threading.Thread(
+            target=self.worker, name="kahi-log-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, log_id, fields, event=None, unset=None, **data):
+        """
+        Queues an upsert of the fields of the log entry, and optionally an event.
+
+        Parameters:
+        ____________
+        log_id:str
+            _id of the log entry
+        fields:dict
+            fields to set
+        event:str
+            name of the event to record, ex: started, finished
+        unset:list
+            fields to remove
+        data:dict
+            additional fields of the event
+        """
+        update = {}
+        if fields:
+            update["$set"] = fields
+        if unset:
+            update["$unset"] = {name: "" for name in unset}
+        if event:
+            data["event"] = event
+            data["time"] = int(time())
+            update["$push"] = {"events": {
+                "$each": [data], "$slice": -self.max_events}}
+        if update:
+            self.queue.put(UpdateOne({"_id": log_id}, update, upsert=True))
+
+    def event(self, log_id, event, **data):
+        """
+        Queues an event of a step
+        """
+        self.write(log_id, None, event=event, **data)
+
+    def started(self, log_id, fields=None):
+        """
+        Records that a step started, it gets heartbeats until it finishes
+        """
+        self.running.add(log_id)
+        self.write(log_id, fields, event="started")
+
+    def finished(self, log_id, fields, event="finished", unset=None):
+        """
+        Records the final status of a step
+        """
+        self.running.discard(log_id)
+        self.write(log_id, fields, event=event, unset=unset)
+
+    def worker(self):
+        last_heartbeat = time()
+        while not self.stop.is_set() or not self.queue.empty():
+            operations = []
+            try:
+                operations.append(self.queue.get(timeout=self.flush_interval))
+                while True:
+                    operations.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            queued = len(operations)
+            # None is queued by close to wake up the thread
+            operations = [operation for operation in operations if operation is not None]
+            if self.heartbeat_interval and time() - last_heartbeat >= self.heartbeat_interval:
+                last_heartbeat = time()
+                operations.extend(UpdateOne({"_id": log_id}, {"$set": {"heartbeat": int(last_heartbeat)}})
+                                  for log_id in list(self.running))
+            try:
+                if operations:
+                    self.collection.bulk_write(operations, ordered=True)
+            except Exception as e:
+                self.error = e
+            finally:
+                for _ in range(queued):
+                    self.queue.task_done()
+
+    def flush(self):
+        """
+        Waits until the queued writes are saved, it raises the last error of the writer
+        """
+        self.queue.join()
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def close(self):
+        """
+        Saves the queued writes and stops the background thread
+        """
+        self.stop.set()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
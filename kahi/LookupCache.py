@@ -0,0 +1,285 @@
+from collections import OrderedDict
+import threading
+import tempfile
+import sqlite3
+import pickle
+import atexit
+import os
+
+
+def hashable(value):
+    """
+    Returns the key of the cache for a value of the key field, the dicts as tuples of their
+    items sorted by name and the lists as tuples, ex: the ids of scienti in external_ids.id
+    """
+    if isinstance(value, dict):
+        return tuple(sorted(((name, hashable(item)) for name, item in value.items()), key=lambda item: item[0]))
+    if isinstance(value, list):
+        return tuple(hashable(item) for item in value)
+    return value
+
+
+class LookupCache:
+    """
+    Cache to resolve the values of a key field of a collection into another field,
+    ex: ROR, ORCID, DOI or OpenAlex ids into _id, without a query per record.
+
+    The cache can be preloaded in bulk from the collection, keeps at most max_items
+    entries in memory with LRU eviction and, with spill_directory, moves the evicted
+    entries to a local sqlite file read through a memory map instead of dropping them.
+    The keys not found in memory are looked up in the database, one query per batch with get_many.
+    Keys missing in the collection are also cached.
+
+    The caches are shared by the steps that run in the same process (see LookupCache.shared),
+    and kahi invalidates them when a step writes to their collection. The writes are seen by
+    the command listener of kahi.Metrics, registered globally in pymongo, so they are seen in
+    any client created after kahi is imported, also in the processes of ParallelScan;
+    the writes of other programs are not seen.
+    The key can be a dotted path inside lists, ex: external_ids.id. The keys that are dicts or
+    lists are stored with the function hashable, the dicts match with any order of their fields,
+    and get_many returns them with the hashable key.
+    """
+    caches = {}
+    versions = {}
+    lock = threading.Lock()
+    missing = object()
+
+    def __init__(self, collection, key, value="_id", max_items=1000000, spill_directory=None, mmap_size=1 << 30):
+        """
+        Parameters:
+        ____________
+        collection:pymongo.collection.Collection
+            collection to resolve the keys
+        key:str
+            field with the keys, ex: doi or external_ids.id
+        value:str
+            field returned for a key, default _id
+        max_items:int
+            maximum number of entries in memory
+        spill_directory:str
+            directory for the sqlite file of the evicted entries, None to drop them
+        mmap_size:int
+            bytes of the spill file mapped in memory
+        """
+        self.collection = collection
+        self.key = key
+        self.value = value
+        self.max_items = max_items
+        self.spill_directory = spill_directory
+        self.mmap_size = mmap_size
+
+        self.items = OrderedDict()
+        self.spill = None
+        self.spill_path = None
+        self.preloaded = False
+        self.counters = {"hits": 0, "misses": 0, "queries": 0, "evictions": 0, "spill_hits": 0}
+
+    @classmethod
+    def shared(cls, collection, key, value="_id", **kwargs):
+        """
+        Returns the cache of the process for the collection, key and value,
+        creating it if needed.
+        """
+        namespace = collection.database.name + "." + collection.name
+        cache_key = (namespace, key, value)
+        with cls.lock:
+            cache = cls.caches.get(cache_key)
+            if cache is None:
+                cache = cls(collection, key, value, **kwargs)
+                cls.caches[cache_key] = cache
+        return cache
+
+    @classmethod
+    def invalidate_namespaces(cls, namespaces):
+        """
+        Clears the shared caches of the collections, given as database.collection
+        """
+        namespaces = set(namespaces)
+        with cls.lock:
+            caches = [cache for (namespace, _, _), cache in cls.caches.items()
+                      if namespace in namespaces]
+        for cache in caches:
+            cache.invalidate()
+
+    @classmethod
+    def synchronize(cls, versions):
+        """
+        Clears the shared caches of the collections written since the last call.
+
+        Parameters:
+        ____________
+        versions:dict
+            number of writes of the workflow by database.collection
+        """
+        changed = [namespace for namespace, version in (versions or {}).items()
+                   if version > cls.versions.get(namespace, 0)]
+        cls.versions.update(versions or {})
+        if changed:
+            cls.invalidate_namespaces(changed)
+
+    def values(self, document, path):
+        values = [document]
+        for name in path.split("."):
+            next_values = []
+            for value in values:
+                if isinstance(value, list):
+                    next_values.extend(item.get(name) for item in value if isinstance(item, dict))
+                elif isinstance(value, dict):
+                    next_values.append(value.get(name))
+            values = next_values
+        result = []
+        for value in values:
+            if isinstance(value, list):
+                result.extend(value)
+            elif value is not None:
+                result.append(value)
+        return result
+
+    def projection(self):
+        return {self.key: 1, self.value: 1}
+
+    def add_document(self, document, keys=None):
+        """
+        Adds the keys of the document, only the ones in keys if given (as returned by hashable),
+        and returns a dict with the added entries
+        """
+        value = self.values(document, self.value)
+        value = value[0] if len(value) == 1 else (value or None)
+        added = {}
+        for key in map(hashable, self.values(document, self.key)):
+            if keys is None or key in keys:
+                self.put(key, value)
+                added[key] = value
+        return added
+
+    def preload(self, filter=None, batch_size=10000):
+        """
+        Loads the keys of the collection that match the filter, in batches of batch_size.
+        Only max_items entries stay in memory.
+        """
+        filter = dict(filter or {})
+        filter.setdefault(self.key, {"$exists": True})
+        cursor = self.collection.find(filter, self.projection(), batch_size=batch_size)
+        self.counters["queries"] += 1
+        for document in cursor:
+            self.add_document(document)
+        self.preloaded = True
+
+    def put(self, key, value):
+        """
+        Adds an entry, ex: after inserting a new document
+        """
+        key = hashable(key)
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.max_items:
+            old_key, old_value = self.items.popitem(last=False)
+            self.counters["evictions"] += 1
+            if self.spill_directory:
+                self.spill_put(old_key, old_value)
+
+    def lookup(self, key):
+        """
+        Returns the cached value of the key, LookupCache.missing if it is not in the cache
+        """
+        key = hashable(key)
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.counters["hits"] += 1
+            return self.items[key]
+        if self.spill is not None:
+            value = self.spill_get(key)
+            if value is not LookupCache.missing:
+                self.counters["spill_hits"] += 1
+                self.put(key, value)
+                return value
+        return LookupCache.missing
+
+    def get(self, key, default=None):
+        """
+        Returns the value of the key, querying the database if it is not in the cache
+        """
+        return self.get_many([key], default)[hashable(key)]
+
+    def get_many(self, keys, default=None):
+        """
+        Returns a dict with the values of the keys, the keys not in the cache
+        are queried together in the database. The keys of the dict are the ones
+        returned by hashable, the same keys unless they are dicts or lists.
+        """
+        result = {}
+        pending = []
+        pending_keys = set()
+        for key in keys:
+            value = self.lookup(key)
+            if value is LookupCache.missing:
+                pending.append(key)
+                pending_keys.add(hashable(key))
+            else:
+                result[hashable(key)] = default if value is None else value
+        if pending:
+            self.counters["misses"] += len(pending)
+            self.counters["queries"] += 1
+            found = {}
+            for document in self.collection.find({self.key: {"$in": pending}}, self.projection()):
+                found.update(self.add_document(document, pending_keys))
+            for key in map(hashable, pending):
+                value = found.get(key, LookupCache.missing)
+                if value is LookupCache.missing:
+                    # cache the missing key
+                    self.put(key, None)
+                    value = None
+                result[key] = default if value is None else value
+        return result
+
+    def open_spill(self):
+        os.makedirs(self.spill_directory, exist_ok=True)
+        descriptor, self.spill_path = tempfile.mkstemp(
+            prefix="kahi_lookup_", suffix=".sqlite", dir=self.spill_directory)
+        os.close(descriptor)
+        self.spill = sqlite3.connect(self.spill_path, check_same_thread=False)
+        self.spill.execute("PRAGMA mmap_size={}".format(int(self.mmap_size)))
+        self.spill.execute("PRAGMA journal_mode=OFF")
+        self.spill.execute("PRAGMA synchronous=OFF")
+        self.spill.execute("CREATE TABLE items (key BLOB PRIMARY KEY, value BLOB)")
+        atexit.register(self.close)
+
+    def spill_put(self, key, value):
+        if self.spill is None:
+            self.open_spill()
+        self.spill.execute("INSERT OR REPLACE INTO items VALUES (?, ?)",
+                           (pickle.dumps(key), pickle.dumps(value)))
+
+    def spill_get(self, key):
+        row = self.spill.execute("SELECT value FROM items WHERE key = ?",
+                                 (pickle.dumps(key),)).fetchone()
+        if row is None:
+            return LookupCache.missing
+        return pickle.loads(row[0])
+
+    def invalidate(self):
+        """
+        Removes all the entries, the cache has to be preloaded again
+        """
+        self.items = OrderedDict()
+        self.preloaded = False
+        if self.spill is not None:
+            self.spill.execute("DELETE FROM items")
+
+    def close(self):
+        """
+        Removes the spill file
+        """
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+            if os.path.exists(self.spill_path):
+                os.remove(self.spill_path)
+
+    def stats(self):
+        """
+        Returns the counters of the cache and its size
+        """
+        stats = self.counters.copy()
+        stats["size"] = len(self.items)
+        return stats
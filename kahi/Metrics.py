@@ -0,0 +1,260 @@
+from pymongo import monitoring
+from bson import encode
+from time import time, process_time
+import contextvars
+import threading
+import resource
+import sys
+import os
+
+# collections written by the async step of the current asyncio task, see StepMetrics.start
+step_written = contextvars.ContextVar("kahi_step_written", default=None)
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Command listener that counts the MongoDB operations of the process,
+    the documents read and written and optionally the bytes of the commands
+    and replies. The listener of the process is registered globally with
+    pymongo.monitoring.register, so it is in every client created after kahi is
+    imported, the ones of the ClientManager and the ones created by the plugins.
+    The commands on the databases in ignore_databases (the log database) are not counted.
+    The writes of every collection, as database.collection, are counted in writes, and the
+    collections are also added to the set of step_written when it is set, it is the set of
+    the async step running in the current asyncio task.
+    """
+    _default = None
+    read_commands = {"find": "firstBatch", "aggregate": "firstBatch", "getMore": "nextBatch"}
+    write_commands = ("insert", "update", "delete", "findAndModify")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ignore_databases = set()
+        self.count_bytes = False
+        self.commands = {}
+        self.writes = {}
+        self.reset()
+
+    @classmethod
+    def default(cls):
+        """
+        Returns the listener of the process
+        """
+        if cls._default is None:
+            cls._default = cls()
+            monitoring.register(cls._default)
+        return cls._default
+
+    @classmethod
+    def _reset_after_fork(cls):
+        # the lock can be held by another thread of the parent, the child starts its own counts
+        if cls._default is not None:
+            cls._default.lock = threading.Lock()
+            cls._default.commands = {}
+            cls._default.writes = {}
+            cls._default.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {
+                "operations": 0,
+                "documents_read": 0,
+                "documents_written": 0,
+                "bytes_sent": 0,
+                "bytes_received": 0,
+                "failed": 0
+            }
+            self.operations = {}
+
+    def add_written(self, namespaces):
+        """
+        Counts writes to the collections, they are also added to the collections of the
+        step of the asyncio task. Used by the command listener and for the collections
+        written by the step in other processes, ex: the workers of ParallelScan.
+        """
+        written = step_written.get()
+        with self.lock:
+            for namespace in namespaces:
+                self.writes[namespace] = self.writes.get(namespace, 0) + 1
+                if written is not None:
+                    written.add(namespace)
+
+    def written_since(self, writes):
+        """
+        Returns the collections written since the copy of the counts of writes was taken
+        """
+        with self.lock:
+            return sorted(namespace for namespace, count in self.writes.items()
+                          if count > writes.get(namespace, 0))
+
+    def writes_snapshot(self):
+        with self.lock:
+            return self.writes.copy()
+
+    def snapshot(self):
+        """
+        Returns a copy of the counters
+        """
+        with self.lock:
+            counters = self.counters.copy()
+            counters["commands"] = self.operations.copy()
+        return counters
+
+    def started(self, event):
+        if event.database_name in self.ignore_databases:
+            return
+        size = len(encode(event.command)) if self.count_bytes else 0
+        if event.command_name in self.write_commands:
+            self.add_written([event.database_name + "." + str(event.command.get(event.command_name))])
+        with self.lock:
+            self.commands[(event.connection_id, event.request_id)] = event.command_name
+            self.counters["operations"] += 1
+            self.counters["bytes_sent"] += size
+            self.operations[event.command_name] = self.operations.get(event.command_name, 0) + 1
+
+    def succeeded(self, event):
+        with self.lock:
+            command_name = self.commands.pop((event.connection_id, event.request_id), None)
+        if command_name is None:
+            return
+        reply = event.reply
+        documents_read = 0
+        documents_written = 0
+        if command_name in self.read_commands:
+            documents_read = len(reply.get("cursor", {}).get(self.read_commands[command_name], []))
+        elif command_name in self.write_commands:
+            documents_written = reply.get("n", 0)
+        size = len(encode(reply)) if self.count_bytes else 0
+        with self.lock:
+            self.counters["documents_read"] += documents_read
+            self.counters["documents_written"] += documents_written
+            self.counters["bytes_received"] += size
+
+    def failed(self, event):
+        with self.lock:
+            if self.commands.pop((event.connection_id, event.request_id), None) is not None:
+                self.counters["failed"] += 1
+
+
+# the clients created from now on send their commands to the listener
+CommandMetrics.default()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=CommandMetrics._reset_after_fork)
+
+
+class StepMetrics:
+    """
+    Measures a step: wall time, cpu time and the MongoDB operations counted by
+    CommandMetrics while the step runs. The peak RSS is the one of the process since
+    it started, saved as process_max_rss_mb, the process can run several steps.
+    """
+
+    def __init__(self, ignore_databases=None, count_bytes=False):
+        """
+        Parameters:
+        ____________
+        ignore_databases:list
+            databases whose commands are not counted, ex: the log database
+        count_bytes:bool
+            if True the size of the commands and replies is measured,
+            it encodes every command again, so it has a cost on heavy writes
+        """
+        self.listener = CommandMetrics.default()
+        self.listener.ignore_databases.update(
+            database for database in (ignore_databases or []) if database)
+        self.listener.count_bytes = count_bytes
+        self.metrics = None
+        self.written = None
+        self.written_token = None
+
+    def max_rss(self):
+        """
+        Returns the peak resident set size of the process in MB since it started
+        """
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            return max_rss / 1024 / 1024
+        return max_rss / 1024
+
+    def start(self, shared=False):
+        """
+        Starts measuring the step
+
+        Parameters:
+        ____________
+        shared:bool
+            True for the async steps that share the event loop with other steps, their
+            written collections are the ones of their asyncio task instead of the ones of the process
+        """
+        self.time_start = time()
+        self.cpu_start = process_time()
+        self.commands_start = self.listener.snapshot()
+        self.writes_start = self.listener.writes_snapshot()
+        if shared:
+            self.written = set()
+            self.written_token = step_written.set(self.written)
+
+    def stop(self):
+        """
+        Returns the metrics of the step
+        """
+        commands = self.listener.snapshot()
+        if self.written is not None:
+            step_written.reset(self.written_token)
+            with self.listener.lock:
+                written = sorted(self.written)
+        else:
+            written = self.listener.written_since(self.writes_start)
+        self.metrics = {
+            "wall_time": time() - self.time_start,
+            "cpu_time": process_time() - self.cpu_start,
+            "process_max_rss_mb": self.max_rss(),
+            "written": written
+        }
+        for name, value in commands.items():
+            if name == "commands":
+                self.metrics[name] = {
+                    command: count - self.commands_start["commands"].get(command, 0)
+                    for command, count in value.items()
+                    if count - self.commands_start["commands"].get(command, 0)
+                }
+            else:
+                self.metrics[name] = value - self.commands_start[name]
+        return self.metrics
+
+    @staticmethod
+    def write_prometheus(path, metrics):
+        """
+        Writes the metrics of the steps in the Prometheus text format,
+        ex: for the textfile collector of node_exporter.
+
+        Parameters:
+        ____________
+        path:str
+            output file, it is replaced atomically
+        metrics:dict
+            metrics of every step by log_id
+        """
+        lines = []
+        names = []
+        for step_metrics in metrics.values():
+            for name, value in step_metrics.items():
+                if isinstance(value, (int, float)) and name not in names:
+                    names.append(name)
+        for name in names:
+            metric = "kahi_step_" + name
+            lines.append("# TYPE {} gauge".format(metric))
+            for log_id, step_metrics in metrics.items():
+                if isinstance(step_metrics.get(name), (int, float)):
+                    lines.append('{}{{step="{}"}} {}'.format(
+                        metric, log_id.replace("\\", "\\\\").replace('"', '\\"'), step_metrics[name]))
+        if any(step_metrics.get("commands") for step_metrics in metrics.values()):
+            lines.append("# TYPE kahi_step_command_operations gauge")
+        for log_id, step_metrics in metrics.items():
+            for command, count in step_metrics.get("commands", {}).items():
+                lines.append('kahi_step_command_operations{{step="{}",command="{}"}} {}'.format(
+                    log_id.replace("\\", "\\\\").replace('"', '\\"'), command, count))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
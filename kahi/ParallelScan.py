@@ -0,0 +1,307 @@
+from concurrent.futures import ProcessPoolExecutor
+from kahi.ClientManager import ClientManager
+from kahi.BulkWriter import BulkWriter
+from kahi.Metrics import CommandMetrics
+from time import time
+import multiprocessing
+import traceback
+import queue
+import os
+
+# queue of the results of ParallelScan.map and event set when the caller stops reading them
+results_queue = None
+stop_event = None
+
+
+def init_worker(results, stop):
+    global results_queue, stop_event
+    results_queue = results
+    stop_event = stop
+
+
+class Partition:
+    """
+    Part of a collection processed by a worker process of ParallelScan.
+    It is passed to the function of the scan, which can use it to open
+    the client of the worker process and write from there.
+    """
+
+    def __init__(self, index, filter, database_url, database, collection, client_options=None):
+        self.index = index
+        self.filter = filter
+        self.database_url = database_url
+        self.database_name = database
+        self.collection_name = collection
+        self.client_options = client_options or {}
+
+    def client(self):
+        """
+        Returns the MongoClient of the worker process
+        """
+        return ClientManager.default().get_client(self.database_url, **self.client_options)
+
+    def database(self):
+        return self.client()[self.database_name]
+
+    def collection(self):
+        return self.database()[self.collection_name]
+
+    def bulk_writer(self, collection, **kwargs):
+        """
+        Returns a BulkWriter for a collection of the database of the scan
+        """
+        return BulkWriter(self.database()[collection], **kwargs)
+
+
+def scan_partition(partition, function, projection, batch_size, stream):
+    """
+    Applies the function to the batches of documents of a partition, executed
+    in the worker processes. Returns the status of the partition.
+    """
+    status = {"partition": partition.index, "status": "ok", "documents": 0,
+              "batches": 0, "pid": os.getpid()}
+    listener = CommandMetrics.default()
+    writes = listener.writes_snapshot()
+    time_start = time()
+    try:
+        cursor = partition.collection().find(partition.filter, projection, batch_size=batch_size)
+        batch = []
+        for document in cursor:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                process_batch(partition, function, batch, stream, status)
+                batch = []
+        if batch:
+            process_batch(partition, function, batch, stream, status)
+    except Exception as e:
+        status["status"] = "failed"
+        status["error"] = "{}: {}".format(type(e).__name__, e)
+        status["traceback"] = traceback.format_exc()
+    finally:
+        status["time"] = time() - time_start
+        # the collections written by the function, to invalidate the lookup caches of the parent
+        status["written"] = listener.written_since(writes)
+        if stream:
+            # end of the partition for ParallelScan.map
+            results_queue.put((partition.index, None))
+    return status
+
+
+def process_batch(partition, function, batch, stream, status):
+    if stream and stop_event.is_set():
+        raise RuntimeError("the scan was stopped")
+    result = function(batch, partition)
+    status["documents"] += len(batch)
+    status["batches"] += 1
+    if stream and result is not None:
+        results_queue.put((partition.index, list(result)))
+
+
+class ParallelScan:
+    """
+    Scan of a collection split in partitions processed by a pool of processes,
+    every process with its own client, so CPU-heavy transforms use all the cores.
+
+    The partitions are _id ranges with boundaries taken from a $sample of the collection
+    (mode range), or the documents whose hashed _id modulo the number of partitions is the
+    partition index (mode hashed, needs MongoDB 7.0 and every partition reads the whole
+    collection, use it when the _id values are not spread, ex: many types).
+
+    The function receives a list of documents and the Partition, and is pickled to the
+    worker processes, so it must be a module level function. With run the workers write
+    the results themselves, ex: with partition.bulk_writer; with map the function returns
+    the results of the batch, which are sent back to the calling process.
+
+    Example:
+        def transform(works, partition):
+            with partition.bulk_writer("works_processed") as writer:
+                for work in works:
+                    writer.insert(process_work(work))
+
+        status = self.parallel_scan("works", workers=16).run(transform)
+    """
+
+    def __init__(self, database_url, database, collection, workers=None, partitions=None,
+                 mode="range", filter=None, projection=None, batch_size=1000,
+                 client_options=None, sample_size=None):
+        """
+        Parameters:
+        ____________
+        database_url:str
+            mongodb url
+        database:str
+            database of the collection
+        collection:str
+            collection to scan
+        workers:int
+            number of processes, default the number of CPUs
+        partitions:int
+            number of partitions, default 4 per worker so the fast workers take more partitions
+        mode:str
+            range or hashed
+        filter:dict
+            filter of the documents
+        projection:dict
+            projection of the documents
+        batch_size:int
+            number of documents passed to the function at once
+        client_options:dict
+            keyword arguments of the MongoClient of the workers
+        sample_size:int
+            number of _id sampled to compute the ranges, default 20 per partition
+        """
+        if mode not in ("range", "hashed"):
+            raise ValueError("Unknown scan mode {}, use range or hashed".format(mode))
+        self.database_url = database_url
+        self.database = database
+        self.collection = collection
+        self.workers = max(1, int(workers or os.cpu_count() or 1))
+        self.partitions = max(1, int(partitions or 4 * self.workers))
+        self.mode = mode
+        self.filter = filter or {}
+        self.projection = projection
+        self.batch_size = batch_size
+        self.client_options = client_options or {}
+        self.sample_size = sample_size or 20 * self.partitions
+        self.status = []
+
+    def boundaries(self):
+        """
+        Returns the _id values that split the collection in ranges of similar size
+        """
+        collection = ClientManager.default().get_client(
+            self.database_url, **self.client_options)[self.database][self.collection]
+        sample = collection.aggregate([
+            {"$sample": {"size": self.sample_size}},
+            {"$project": {"_id": 1}},
+            {"$sort": {"_id": 1}}
+        ])
+        ids = [document["_id"] for document in sample]
+        boundaries = []
+        for i in range(1, self.partitions):
+            value = ids[i * len(ids) // self.partitions] if ids else None
+            if value is not None and (not boundaries or boundaries[-1] != value):
+                boundaries.append(value)
+        return boundaries
+
+    def partition_filters(self):
+        """
+        Returns the filter of every partition
+        """
+        if self.mode == "hashed":
+            filters = [{"$expr": {"$eq": [
+                {"$abs": {"$mod": [{"$toHashedIndexKey": "$_id"}, self.partitions]}}, i]}}
+                for i in range(self.partitions)]
+        else:
+            limits = [None] + self.boundaries() + [None]
+            filters = []
+            for low, high in zip(limits[:-1], limits[1:]):
+                condition = {}
+                if low is not None:
+                    condition["$gte"] = low
+                if high is not None:
+                    condition["$lt"] = high
+                filters.append({"_id": condition} if condition else {})
+        if self.filter:
+            filters = [{"$and": [self.filter, partition_filter]} if partition_filter else self.filter
+                       for partition_filter in filters]
+        return filters
+
+    def make_partitions(self):
+        return [Partition(i, partition_filter, self.database_url, self.database,
+                          self.collection, self.client_options)
+                for i, partition_filter in enumerate(self.partition_filters())]
+
+    def check(self, raise_errors):
+        failed = [status for status in self.status if status["status"] != "ok"]
+        # the errors of the plugin function first, then the broken processes
+        failed.sort(key=lambda status: "traceback" not in status)
+        if failed and raise_errors:
+            raise RuntimeError("Parallel scan of {}.{} failed in {} of {} partitions, first error: {}".format(
+                self.database, self.collection, len(failed), len(self.status), failed[0].get("error")))
+
+    def run(self, function, raise_errors=True):
+        """
+        Applies function(documents, partition) to all the documents, the results
+        are written by the function in the worker processes.
+
+        Returns:
+        ____________
+        list with the status of every partition: partition, status (ok or failed),
+        documents, batches, time, pid, written collections, and error and traceback if it failed
+        """
+        partitions = self.make_partitions()
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(partitions))) as pool:
+            futures = [pool.submit(scan_partition, partition, function, self.projection,
+                                   self.batch_size, False)
+                       for partition in partitions]
+            self.status = [self.future_status(future, partition)
+                           for future, partition in zip(futures, partitions)]
+        self.add_written()
+        self.check(raise_errors)
+        return self.status
+
+    def map(self, function, raise_errors=True):
+        """
+        Applies function(documents, partition) to all the documents and yields the
+        results it returns, in the order they arrive from the worker processes.
+        The status of the partitions is in the status attribute at the end.
+        """
+        partitions = self.make_partitions()
+        workers = min(self.workers, len(partitions))
+        context = multiprocessing.get_context()
+        results = context.Queue(maxsize=2 * workers)
+        stop = context.Event()
+        ended = set()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=init_worker, initargs=(results, stop)) as pool:
+            futures = [pool.submit(scan_partition, partition, function, self.projection,
+                                   self.batch_size, True)
+                       for partition in partitions]
+            try:
+                while len(ended) < len(partitions):
+                    try:
+                        index, values = results.get(timeout=0.5)
+                    except queue.Empty:
+                        # a process that dies breaks the pool and the end marks can be lost
+                        if all(future.done() for future in futures):
+                            break
+                        continue
+                    if values is None:
+                        ended.add(index)
+                    else:
+                        yield from values
+            except GeneratorExit:
+                # the caller stopped reading, the workers are unblocked and stop at the next batch
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                while not all(future.done() for future in futures):
+                    try:
+                        results.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                raise
+            self.status = [self.future_status(future, partition)
+                           for future, partition in zip(futures, partitions)]
+        for status in self.status:
+            if status["status"] == "ok" and status["partition"] not in ended:
+                status["status"] = "failed"
+                status["error"] = "the results of the partition were not received"
+        results.close()
+        self.add_written()
+        self.check(raise_errors)
+
+    def add_written(self):
+        """
+        Adds the collections written by the worker processes to the ones written by the step
+        """
+        CommandMetrics.default().add_written(
+            namespace for status in self.status for namespace in status.get("written", []))
+
+    def future_status(self, future, partition):
+        try:
+            return future.result()
+        except Exception as e:
+            return {"partition": partition.index, "status": "failed",
+                    "error": "{}: {}".format(type(e).__name__, e), "documents": 0, "batches": 0}
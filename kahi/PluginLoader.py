@@ -0,0 +1,100 @@
+from importlib import import_module
+from importlib.metadata import entry_points
+from importlib.util import find_spec
+
+
+class PluginLoader:
+    """
+    Finds and imports the plugins on demand.
+
+    The plugins are found in the entry points of the group kahi.plugins,
+    ex: in the setup.py of the plugin
+        entry_points={"kahi.plugins": ["openalex_works = kahi_openalex_works.Kahi_openalex_works:Kahi_openalex_works"]}
+    Plugins without entry points are found by the name of the package,
+    prefix + name, without importing them. A plugin is only imported when
+    load or version are called, so the workflow only pays for the plugins it runs.
+
+    The plugins that implement run_async are also declared in the group kahi.async_plugins,
+    with the same entry point, to run them in the event loop of kahi without importing them
+    in advance. The other async plugins run in the executor of the synchronous steps.
+    """
+    group = "kahi.plugins"
+    async_group = "kahi.async_plugins"
+    _entry_points = {}
+
+    def __init__(self, plugin_prefix="kahi_"):
+        """
+        Parameters:
+        ____________
+        plugin_prefix:str
+            prefix of the plugin packages
+        """
+        self.plugin_prefix = plugin_prefix
+        self.classes = {}
+        self.versions = {}
+
+    @classmethod
+    def entry_points(cls, group=None):
+        """
+        Returns the entry points of the installed plugins by name,
+        read once per process from the packages metadata.
+        """
+        group = group or cls.group
+        if group not in cls._entry_points:
+            try:
+                plugins = entry_points(group=group)
+            except TypeError:
+                # python 3.9
+                plugins = entry_points().get(group, [])
+            cls._entry_points[group] = {
+                entry_point.name: entry_point for entry_point in plugins}
+        return cls._entry_points[group]
+
+    def package(self, name):
+        """
+        Returns the package name of a plugin
+        """
+        entry_point = self.entry_points().get(name)
+        if entry_point is not None:
+            return entry_point.module.split(".")[0]
+        return self.plugin_prefix + name
+
+    def available(self, name):
+        """
+        Returns True if the plugin is installed, the plugin is not imported.
+        """
+        if name in self.entry_points():
+            return True
+        try:
+            return find_spec(self.plugin_prefix + name) is not None
+        except (ImportError, ValueError):
+            return False
+
+    def is_async(self, name):
+        """
+        Returns True if the plugin is declared in kahi.async_plugins, the plugin is not imported.
+        """
+        return name in self.entry_points(self.async_group)
+
+    def load(self, name):
+        """
+        Imports the plugin and returns its class
+        """
+        if name not in self.classes:
+            entry_point = self.entry_points().get(name)
+            if entry_point is not None:
+                self.classes[name] = entry_point.load()
+            else:
+                class_name = self.plugin_prefix.capitalize() + name
+                module = import_module(self.plugin_prefix + name + "." + class_name)
+                self.classes[name] = getattr(module, class_name)
+        return self.classes[name]
+
+    def version(self, name):
+        """
+        Imports the _version module of the plugin and returns its get_version function
+        """
+        if name not in self.versions:
+            module = import_module(self.package(name) + "._version")
+            self.versions[name] = getattr(module, "get_version")
+        return self.versions[name]
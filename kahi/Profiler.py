@@ -0,0 +1,150 @@
+from time import sleep
+import threading
+import cProfile
+import pstats
+import sys
+import os
+import re
+
+
+class Profiler:
+    """
+    Profiles a step and saves the results in a directory, named by the log_id of the step.
+
+    There are two modes:
+        cprofile: deterministic profile with cProfile saved in a .prof file,
+            it can be opened with pstats, snakeviz, etc.
+        sampling: a background thread samples the stack of the step every
+            interval seconds, it has a low overhead and can be used in production runs.
+    The sampled stacks are saved in collapsed format (.folded), ready for flamegraph.pl
+    or speedscope, in sampling mode or when collapsed is True.
+    In both modes a summary with the top functions is returned to be saved in the log.
+    """
+
+    def __init__(self, log_id, mode="cprofile", directory="profiles", top=20,
+                 collapsed=False, interval=0.01):
+        """
+        Parameters:
+        ____________
+        log_id:str
+            log id of the step, used for the file names
+        mode:str
+            cprofile or sampling
+        directory:str
+            output directory
+        top:int
+            number of functions in the summary
+        collapsed:bool
+            if True the collapsed stacks are also saved in cprofile mode
+        interval:float
+            seconds between samples
+        """
+        if mode not in ("cprofile", "sampling"):
+            raise ValueError("Unknown profile mode {}".format(mode))
+        self.log_id = log_id
+        self.mode = mode
+        self.directory = directory
+        self.top = top
+        self.collapsed = collapsed or mode == "sampling"
+        self.interval = interval
+
+        self.profile = None
+        self.samples = {}
+        self.total_samples = 0
+        self.stop_sampling = threading.Event()
+        self.sampler = None
+
+    def path(self, extension):
+        """
+        Returns the output file of the step with the given extension
+        """
+        name = re.sub(r"[^\w.\-\[\]]", "_", self.log_id)
+        return os.path.join(self.directory, name + extension)
+
+    def start(self):
+        if self.mode == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        if self.collapsed:
+            self.thread_id = threading.get_ident()
+            self.sampler = threading.Thread(
+                target=self.sample, name="kahi-profiler", daemon=True)
+            self.sampler.start()
+
+    def frame_name(self, code):
+        return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def sample(self):
+        while not self.stop_sampling.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if stack:
+                stack = tuple(reversed(stack))
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+                self.total_samples += 1
+            sleep(self.interval)
+
+    def stop(self):
+        """
+        Stops the profiler, saves the output files and returns the summary
+        """
+        summary = {"mode": self.mode}
+        # the profiling stops before the files are written, also if they can not be written
+        if self.profile is not None:
+            self.profile.disable()
+        if self.sampler is not None:
+            self.stop_sampling.set()
+            self.sampler.join()
+        os.makedirs(self.directory, exist_ok=True)
+        if self.profile is not None:
+            summary["file"] = self.path(".prof")
+            self.profile.dump_stats(summary["file"])
+            summary["hotspots"] = self.cprofile_hotspots()
+        if self.sampler is not None:
+            summary["collapsed_file"] = self.path(".folded")
+            self.write_collapsed(summary["collapsed_file"])
+            summary["samples"] = self.total_samples
+            if self.profile is None:
+                summary["hotspots"] = self.sampling_hotspots()
+        return summary
+
+    def cprofile_hotspots(self):
+        """
+        Returns the top functions by own time of the cProfile stats
+        """
+        stats = pstats.Stats(self.profile).stats
+        hotspots = []
+        for (filename, line, function), (_, calls, tottime, cumtime, _) in stats.items():
+            hotspots.append({
+                "function": "{} ({}:{})".format(function, os.path.basename(filename), line),
+                "calls": calls,
+                "tottime": tottime,
+                "cumtime": cumtime
+            })
+        hotspots.sort(key=lambda hotspot: hotspot["tottime"], reverse=True)
+        return hotspots[:self.top]
+
+    def sampling_hotspots(self):
+        """
+        Returns the top functions by number of samples on top of the stack
+        """
+        own = {}
+        for stack, count in self.samples.items():
+            name = self.frame_name(stack[-1])
+            own[name] = own.get(name, 0) + count
+        hotspots = [{
+            "function": name,
+            "samples": count,
+            "fraction": count / self.total_samples
+        } for name, count in own.items()]
+        hotspots.sort(key=lambda hotspot: hotspot["samples"], reverse=True)
+        return hotspots[:self.top]
+
+    def write_collapsed(self, path):
+        with open(path, "w") as file:
+            for stack, count in self.samples.items():
+                file.write(";".join(self.frame_name(code) for code in stack))
+                file.write(" {}\n".format(count))
@@ -0,0 +1,193 @@
+from datetime import timedelta
+from time import time
+import threading
+import sys
+
+
+class Progress:
+    """
+    Progress of a step, updated by the plugin from its loops with update,
+    which only adds to a counter. The rate and the ETA are computed by the
+    ProgressMonitor of the step when it samples the counter.
+    """
+
+    def __init__(self, total=None, unit="records"):
+        """
+        Parameters:
+        ____________
+        total:int
+            number of items to process, None if unknown
+        unit:str
+            name of the items, shown in the terminal
+        """
+        self.total = total
+        self.unit = unit
+        self.processed = 0
+        self.time_start = time()
+        self.rate = None
+        self.stalled = False
+
+    def update(self, count=1):
+        """
+        Adds count to the processed items
+        """
+        self.processed += count
+
+    def set_total(self, total):
+        self.total = total
+
+    def eta(self):
+        """
+        Returns the seconds left at the current rate, None if unknown
+        """
+        if self.total is None or not self.rate:
+            return None
+        return max(0.0, (self.total - self.processed) / self.rate)
+
+    def snapshot(self):
+        """
+        Returns the state of the progress saved in the log
+        """
+        return {
+            "processed": self.processed,
+            "total": self.total,
+            "unit": self.unit,
+            "percent": 100.0 * self.processed / self.total if self.total else None,
+            "rate": self.rate,
+            "eta": self.eta(),
+            "elapsed": time() - self.time_start,
+            "stalled": self.stalled,
+            "time": int(time())
+        }
+
+    def render(self, log_id):
+        """
+        Returns the line shown in the terminal
+        """
+        line = "{}: {:,}".format(log_id, self.processed)
+        if self.total:
+            line += "/{:,} ({:.1f}%)".format(self.total, 100.0 * self.processed / self.total)
+        line += " {}".format(self.unit)
+        if self.rate is not None:
+            line += " {:,.1f} {}/s".format(self.rate, self.unit)
+        eta = self.eta()
+        if eta is not None:
+            line += " ETA {}".format(timedelta(seconds=int(eta)))
+        if self.stalled:
+            line += " STALLED"
+        return line
+
+
+class ProgressMonitor:
+    """
+    Background thread of a step that samples its Progress every interval seconds,
+    shows it in the terminal, saves it in the log entry of the step every log_interval
+    seconds and flags the step as stalled when nothing was processed in stall_timeout seconds.
+    The thread starts when the plugin creates its progress with KahiBase.progress.
+    """
+
+    def __init__(self, log_id, collection=None, interval=10, log_interval=60, stall_timeout=1800,
+                 render=True, smoothing=0.3):
+        """
+        Parameters:
+        ____________
+        log_id:str
+            log id of the step
+        collection:pymongo.collection.Collection
+            log collection, None to not save the progress
+        interval:float
+            seconds between samples
+        log_interval:float
+            seconds between writes of the progress in the log
+        stall_timeout:float
+            seconds without progress to flag the step as stalled, 0 disables it
+        render:bool
+            if True the progress is printed in stderr every sample
+        smoothing:float
+            weight of the last sample in the rate
+        """
+        self.log_id = log_id
+        self.collection = collection
+        self.interval = interval
+        self.log_interval = log_interval
+        self.stall_timeout = stall_timeout
+        self.render = render
+        self.smoothing = smoothing
+        self.progress = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.last_processed = 0
+        self.last_sample = None
+        self.last_change = None
+        self.last_log = 0
+
+    def watch(self, progress):
+        """
+        Starts sampling progress
+        """
+        self.progress = progress
+        self.last_processed = progress.processed
+        self.last_sample = self.last_change = time()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.worker, name="kahi-progress", daemon=True)
+            self.thread.start()
+
+    def sample(self):
+        """
+        Updates the rate and the stalled flag of the progress
+        """
+        progress = self.progress
+        now = time()
+        processed = progress.processed
+        if now > self.last_sample:
+            rate = (processed - self.last_processed) / (now - self.last_sample)
+            progress.rate = rate if progress.rate is None else \
+                self.smoothing * rate + (1 - self.smoothing) * progress.rate
+        if processed != self.last_processed:
+            self.last_change = now
+            if progress.stalled:
+                progress.stalled = False
+                print("Plugin {} is processing again".format(self.log_id), file=sys.stderr)
+        elif self.stall_timeout and not progress.stalled and now - self.last_change >= self.stall_timeout:
+            progress.stalled = True
+            print("Plugin {} stalled: nothing processed in {} seconds".format(
+                self.log_id, int(now - self.last_change)), file=sys.stderr)
+            # the operators see the flag without waiting for the next write
+            self.last_log = 0
+        self.last_processed = processed
+        self.last_sample = now
+        if self.render:
+            print(progress.render(self.log_id), file=sys.stderr, flush=True)
+        if now - self.last_log >= self.log_interval:
+            self.save()
+
+    def save(self):
+        """
+        Saves the progress in the log entry of the step
+        """
+        self.last_log = time()
+        if self.collection is None or self.progress is None:
+            return
+        try:
+            self.collection.update_one(
+                {"_id": self.log_id}, {"$set": {"progress": self.progress.snapshot()}}, upsert=True)
+        except Exception as e:
+            print("Progress of {} not saved in the log: {}".format(self.log_id, e), file=sys.stderr)
+
+    def worker(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        """
+        Stops the thread and saves the final progress, returns its snapshot
+        """
+        if self.thread is None:
+            return None
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.progress.rate = self.progress.processed / max(time() - self.progress.time_start, 1e-9)
+        self.progress.stalled = False
+        self.save()
+        return self.progress.snapshot()
@@ -0,0 +1,234 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import itertools
+import glob
+import mmap
+import json
+import gzip
+import lzma
+import bz2
+import csv
+import io
+import os
+
+
+compressions = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+    ".xz": lzma.open
+}
+
+formats = {
+    ".csv": "csv",
+    ".tsv": "csv",
+    ".jsonl": "jsonl",
+    ".ndjson": "jsonl"
+}
+
+
+def parse_chunk(data, format, encoding="utf-8", fieldnames=None, csv_options=None):
+    """
+    Parses a chunk of complete lines, executed in the worker processes of RecordReader.
+    Returns the list of records.
+    """
+    text = data.decode(encoding)
+    if format == "jsonl":
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    return list(csv.DictReader(io.StringIO(text), fieldnames=fieldnames, **(csv_options or {})))
+
+
+class RecordReader:
+    """
+    Streaming reader of CSV and JSON Lines files, plain or compressed with gzip, bzip2 or xz,
+    that yields the records in batches of batch_size dicts, so the memory used does not
+    depend on the size of the files.
+
+    The files are read in chunks of about chunk_size bytes cut at line ends, uncompressed
+    files through a memory map. With workers > 1 the chunks are parsed in parallel by a pool
+    of processes, at most 2 * workers chunks at the same time, and the records keep the order
+    of the files. The chunks of a CSV file are cut at line ends, so parallel parsing needs
+    files without line breaks inside quoted fields; with workers = 1 CSV files are read with
+    csv.DictReader and can have them.
+
+    Example:
+        for batch in self.stream_records("openalex/works/*/*.gz", workers=8):
+            with self.bulk_writer("works") as writer:
+                for work in batch:
+                    writer.insert(self.process_work(work))
+    """
+
+    def __init__(self, paths, format=None, batch_size=10000, workers=1, chunk_size=32 * 1024 * 1024,
+                 encoding="utf-8", use_mmap=True, **csv_options):
+        """
+        Parameters:
+        ____________
+        paths:str or list
+            path or glob pattern of the files, or a list of them
+        format:str
+            csv or jsonl, by default from the extension of every file,
+            .json files need format='jsonl'
+        batch_size:int
+            number of records of every batch
+        workers:int
+            number of processes that parse the chunks, 1 to parse them in the calling process
+        chunk_size:int
+            approximate size in bytes of the chunks
+        encoding:str
+            encoding of the files
+        use_mmap:bool
+            read the uncompressed files through a memory map
+        csv_options:dict
+            keyword arguments of csv.DictReader, ex: delimiter=";"
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        self.paths = []
+        for path in paths:
+            self.paths.extend(sorted(glob.glob(path)) or [path])
+        self.format = format
+        self.batch_size = batch_size
+        self.workers = max(1, int(workers or 1))
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        self.use_mmap = use_mmap
+        self.csv_options = csv_options
+        self.counters = {"files": 0, "chunks": 0, "records": 0, "bytes": 0}
+
+    def file_format(self, path):
+        """
+        Returns the format, the compression extension and the csv options of a file
+        """
+        name, extension = os.path.splitext(path.lower())
+        compression = None
+        if extension in compressions:
+            compression = extension
+            name, extension = os.path.splitext(name)
+        csv_options = dict(self.csv_options)
+        if extension == ".tsv":
+            csv_options.setdefault("delimiter", "\t")
+        if self.format:
+            return self.format, compression, csv_options
+        if extension == ".json":
+            # a .json file is usually a single document, not a record per line
+            raise ValueError(
+                "{} can be a JSON document, use format='jsonl' if it has a JSON record per line".format(path))
+        if extension not in formats:
+            raise ValueError(
+                "Unknown format of {}, use format='csv' or format='jsonl'".format(path))
+        return formats[extension], compression, csv_options
+
+    def mmap_chunks(self, path):
+        with open(path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            if size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                start = 0
+                while start < size:
+                    end = min(start + self.chunk_size, size)
+                    if end < size:
+                        newline = data.find(b"\n", end)
+                        end = size if newline == -1 else newline + 1
+                    yield data[start:end]
+                    start = end
+
+    def stream_chunks(self, stream):
+        rest = b""
+        while True:
+            block = stream.read(self.chunk_size)
+            if not block:
+                break
+            block = rest + block
+            cut = block.rfind(b"\n")
+            if cut == -1:
+                rest = block
+                continue
+            yield block[:cut + 1]
+            rest = block[cut + 1:]
+        if rest:
+            yield rest
+
+    def chunks(self, path, compression):
+        """
+        Yields the chunks of complete lines of a file
+        """
+        if compression is None and self.use_mmap:
+            yield from self.mmap_chunks(path)
+            return
+        opener = compressions.get(compression, open)
+        with opener(path, "rb") as stream:
+            yield from self.stream_chunks(stream)
+
+    def file_tasks(self, path):
+        """
+        Yields the arguments of parse_chunk for every chunk of a file
+        """
+        format, compression, csv_options = self.file_format(path)
+        self.counters["files"] += 1
+        fieldnames = None
+        for chunk in self.chunks(path, compression):
+            if format == "csv" and fieldnames is None:
+                # the first line of the file is the header
+                header, _, chunk = chunk.partition(b"\n")
+                fieldnames = next(csv.reader(
+                    [header.decode(self.encoding).rstrip("\r")], **csv_options))
+                if not chunk:
+                    continue
+            self.counters["chunks"] += 1
+            self.counters["bytes"] += len(chunk)
+            yield (chunk, format, self.encoding, fieldnames, csv_options)
+
+    def sequential_records(self):
+        """
+        Yields the records of the files parsing them in the calling process
+        """
+        for path in self.paths:
+            format, compression, csv_options = self.file_format(path)
+            if format == "csv":
+                self.counters["files"] += 1
+                opener = compressions.get(compression, open)
+                with opener(path, "rt", encoding=self.encoding, newline="") as stream:
+                    yield from csv.DictReader(stream, **csv_options)
+                continue
+            for task in self.file_tasks(path):
+                yield from parse_chunk(*task)
+
+    def parallel_records(self):
+        """
+        Yields the records of the files parsing their chunks in a pool of processes
+        """
+        tasks = itertools.chain.from_iterable(self.file_tasks(path) for path in self.paths)
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            for task in tasks:
+                pending.append(pool.submit(parse_chunk, *task))
+                if len(pending) >= 2 * self.workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def records(self):
+        """
+        Yields the records one by one
+        """
+        records = self.parallel_records() if self.workers > 1 else self.sequential_records()
+        for record in records:
+            self.counters["records"] += 1
+            yield record
+
+    def __iter__(self):
+        """
+        Yields the records in lists of batch_size records
+        """
+        records = self.records()
+        while True:
+            batch = list(itertools.islice(records, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def stats(self):
+        """
+        Returns the number of files, chunks, records and bytes read
+        """
+        return self.counters.copy()
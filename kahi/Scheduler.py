@@ -0,0 +1,269 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+class InlineExecutor:
+    """
+    Executor that runs the submitted callable in the calling process.
+    It keeps the sequential behaviour of Kahi when max_workers is 1.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class Scheduler:
+    """
+    Builds a DAG from the workflow and runs the steps whose dependencies
+    are satisfied, at most max_workers at the same time.
+
+    A step declares its dependencies with the reserved parameter depends_on,
+    either a single step name or a list of them. A plugin name without task
+    refers to all the plugin/task entries of that plugin.
+    Steps without depends_on depend on the previous step of the workflow,
+    which keeps the sequential order of the yaml file. Only the dependencies
+    declared with depends_on are kept in declared.
+
+    With fan_out enabled, list-valued entries are split into one shard per
+    element, named log_id[index], and consecutive plugin/task entries of the
+    same plugin do not depend on each other. Every shard is a node of the
+    DAG with its own log record.
+    """
+
+    def __init__(self, workflow, max_workers=1, fan_out=False, fan_out_workers=None,
+                 executor_factory=None, verbose=0):
+        """
+        Parameters:
+        ____________
+        workflow:OrderedDict
+            workflow section of the yaml file
+        max_workers:int
+            maximum number of steps running at the same time
+        fan_out:bool
+            if True list-valued entries and plugin/task entries are split in shards
+        fan_out_workers:int
+            maximum number of shards of the same plugin running at the same time,
+            default is max_workers
+        executor_factory:callable
+            returns the executor used to run the steps, by default the steps run
+            in the calling process or in a process pool depending on max_workers
+        verbose:int
+            verbosity level
+        """
+        self.workflow = workflow
+        self.max_workers = max(1, int(max_workers))
+        self.fan_out = fan_out
+        self.fan_out_workers = max(1, int(fan_out_workers)) if fan_out_workers else self.max_workers
+        self.executor_factory = executor_factory
+        self.verbose = verbose
+        self.nodes = OrderedDict()
+        # dependencies declared with depends_on, without the implicit previous step
+        self.declared = OrderedDict()
+        self.dependencies = self.build()
+
+    def declared_dependencies(self, params):
+        """
+        Returns the list of dependencies declared in a step or None
+        if the step does not declare depends_on.
+        """
+        if not isinstance(params, dict) or "depends_on" not in params:
+            return None
+        depends_on = params["depends_on"]
+        if depends_on is None:
+            return []
+        if isinstance(depends_on, str):
+            return [depends_on]
+        return list(depends_on)
+
+    def shards(self, log_id):
+        """
+        Returns the list of (node, shard index) of a workflow entry
+        """
+        params = self.workflow[log_id]
+        if self.fan_out and isinstance(params, list) and len(params) > 1:
+            return [("{}[{}]".format(log_id, i), i) for i in range(len(params))]
+        return [(log_id, None)]
+
+    def build(self):
+        """
+        Builds the dependency graph of the nodes, it raises ValueError if
+        a dependency does not exist or if the graph has cycles.
+        """
+        log_ids = list(self.workflow.keys())
+        entries = OrderedDict()
+        previous = set()
+        group = None
+        group_dependencies = set()
+        for log_id in log_ids:
+            declared = self.declared_dependencies(self.workflow[log_id])
+            module_name = log_id.split("/")[0]
+            is_task = len(log_id.split("/")) > 1
+            if declared is None:
+                if self.fan_out and is_task and group == module_name:
+                    entries[log_id] = set(group_dependencies)
+                    previous.add(log_id)
+                    continue
+                entries[log_id] = set(previous)
+            else:
+                entries[log_id] = set()
+                for name in declared:
+                    matches = [other for other in log_ids
+                               if other == name or other.split("/")[0] == name]
+                    if not matches:
+                        raise ValueError(
+                            "Step {} depends on {} which is not in the workflow".format(log_id, name))
+                    entries[log_id].update(
+                        match for match in matches if match != log_id)
+            group_dependencies = entries[log_id]
+            group = module_name if is_task else None
+            previous = set([log_id])
+
+        dependencies = OrderedDict()
+        for log_id, entry_dependencies in entries.items():
+            nodes = set()
+            for dependency in entry_dependencies:
+                nodes.update(node for node, _ in self.shards(dependency))
+            is_declared = self.declared_dependencies(self.workflow[log_id]) is not None
+            for node, shard in self.shards(log_id):
+                self.nodes[node] = (log_id, shard)
+                dependencies[node] = set(nodes)
+                self.declared[node] = set(nodes) if is_declared else set()
+        self.check_cycles(dependencies)
+        return dependencies
+
+    def check_cycles(self, dependencies):
+        """
+        Raises ValueError if the dependency graph has a cycle.
+        """
+        visited = set()
+        for log_id in dependencies.keys():
+            if log_id in visited:
+                continue
+            stack = [(log_id, iter(dependencies[log_id]))]
+            path = set([log_id])
+            while stack:
+                node, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    stack.pop()
+                    path.discard(node)
+                    visited.add(node)
+                    continue
+                if child in path:
+                    raise ValueError(
+                        "Workflow has a dependency cycle through {}".format(child))
+                if child not in visited:
+                    path.add(child)
+                    stack.append((child, iter(dependencies[child])))
+
+    def order(self):
+        """
+        Returns the nodes in topological order, keeping the order of the workflow
+        between independent nodes.
+        """
+        pending = OrderedDict(
+            (log_id, set(deps)) for log_id, deps in self.dependencies.items())
+        done = set()
+        order = []
+        while pending:
+            for log_id in list(pending.keys()):
+                if pending[log_id] <= done:
+                    del pending[log_id]
+                    done.add(log_id)
+                    order.append(log_id)
+                    break
+        return order
+
+    def group(self, log_id):
+        """
+        Returns the plugin name of a node, used to limit the shards running at the same time
+        """
+        return self.nodes[log_id][0].split("/")[0]
+
+    def executor(self):
+        """
+        Returns the executor used to run the steps.
+        """
+        if self.executor_factory:
+            return self.executor_factory()
+        return self.process_executor()
+
+    def process_executor(self):
+        """
+        Returns the default executor, the calling process if max_workers is 1,
+        otherwise a pool of max_workers processes.
+        """
+        if self.max_workers == 1:
+            return InlineExecutor()
+        return ProcessPoolExecutor(max_workers=self.max_workers)
+
+    def run(self, submit, on_success, on_failure, skip=None):
+        """
+        Runs the workflow.
+
+        Parameters:
+        ____________
+        submit:callable
+            submit(executor, log_id) submits the node and returns a future
+        on_success:callable
+            on_success(log_id, result) is called with the result of the step
+        on_failure:callable
+            on_failure(log_id, exception) is called when the step fails
+        skip:callable
+            skip(log_id) returns True if the step was already executed
+        """
+        pending = OrderedDict(
+            (log_id, set(deps)) for log_id, deps in self.dependencies.items())
+        done = set()
+        running = {}
+        running_groups = {}
+        error = None
+        executor = self.executor()
+        try:
+            while pending or running:
+                scheduled = True
+                while scheduled and error is None:
+                    scheduled = False
+                    for log_id in list(pending.keys()):
+                        if len(running) >= self.max_workers:
+                            break
+                        if not pending[log_id] <= done:
+                            continue
+                        group = self.group(log_id)
+                        if running_groups.get(group, 0) >= self.fan_out_workers:
+                            continue
+                        del pending[log_id]
+                        scheduled = True
+                        if skip and skip(log_id):
+                            done.add(log_id)
+                            continue
+                        running[submit(executor, log_id)] = log_id
+                        running_groups[group] = running_groups.get(group, 0) + 1
+                if not running:
+                    break
+                finished, _ = wait(list(running.keys()),
+                                   return_when=FIRST_COMPLETED)
+                for future in finished:
+                    log_id = running.pop(future)
+                    running_groups[self.group(log_id)] -= 1
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        on_failure(log_id, e)
+                        if error is None:
+                            error = e
+                        continue
+                    on_success(log_id, result)
+                    done.add(log_id)
+        finally:
+            executor.shutdown(wait=True)
+        if error is not None:
+            raise error
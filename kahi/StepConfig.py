@@ -0,0 +1,187 @@
+import pickle
+import re
+import os
+
+variable_pattern = re.compile(r"\$(\$?)\{([A-Za-z_][A-Za-z0-9_]*)(?::-([^}]*))?\}")
+
+
+def interpolate(value, environ=None, where=None):
+    """
+    Returns a copy of value with ${VAR} and ${VAR:-default} in the strings replaced by the
+    environment variables, $${VAR} is kept as ${VAR}. It raises ValueError if a variable
+    without default is not set.
+
+    Parameters:
+    ____________
+    value:object
+        value of the yaml file, the dicts and lists are copied recursively
+    environ:dict
+        variables, default os.environ
+    where:str
+        name of the section or step, for the error message
+    """
+    environ = os.environ if environ is None else environ
+    if isinstance(value, str):
+        if "${" not in value:
+            return value
+
+        def replace(match):
+            escape, name, default = match.groups()
+            if escape:
+                return match.group(0)[1:]
+            if name in environ:
+                return environ[name]
+            if default is not None:
+                return default
+            raise ValueError("Environment variable {} used in {} is not set".format(name, where))
+        return variable_pattern.sub(replace, value)
+    if isinstance(value, dict):
+        return type(value)((key, interpolate(item, environ, where)) for key, item in value.items())
+    if isinstance(value, list):
+        return [interpolate(item, environ, where) for item in value]
+    return value
+
+
+class FrozenDict(dict):
+    """
+    dict that can not be modified, the mappings of the parameters of a StepConfig
+    """
+    __slots__ = ()
+
+    def read_only(self, *args, **kwargs):
+        raise TypeError("The parameters of a step can not be modified")
+
+    __setitem__ = __delitem__ = __ior__ = read_only
+    clear = pop = popitem = setdefault = update = read_only
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(value):
+    """
+    Returns a copy of value that can not be modified, the dicts as FrozenDict and the lists as tuples
+    """
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """
+    Returns a mutable copy of a value returned by freeze, with dicts and lists
+    """
+    if isinstance(value, dict):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(item) for item in value]
+    return value
+
+
+class StepConfig:
+    """
+    Configuration of a step resolved once: the parameters of the workflow entry with the
+    task injected and without the reserved parameters, and the configuration passed to
+    the plugin, global config plus parameters, stored pickled.
+    The object can not be modified and does not share data with the workflow, params and
+    reserved are frozen (FrozenDict and tuples, see freeze), it is sent as it is to the worker
+    processes and every plugin instance gets its own copy of the configuration with plugin_config.
+    """
+    __slots__ = ("log_id", "entry", "shard", "module_name", "task", "params", "reserved", "data")
+
+    def __init__(self, log_id, entry, shard, module_name, task, params, reserved, data):
+        for name, value in zip(self.__slots__, (log_id, entry, shard, module_name, task, params, reserved, data)):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def build(cls, config, workflow, log_id, entry=None, shard=None, reserved_parameters=()):
+        """
+        Resolves the configuration of a step
+
+        Parameters:
+        ____________
+        config:dict
+            config section of the workflow, already interpolated
+        workflow:dict
+            workflow section of the workflow
+        log_id:str
+            log id of the step
+        entry:str
+            workflow entry of the step, default log_id
+        shard:int
+            index of the element of a list-valued entry, None if the entry is not split
+        reserved_parameters:tuple
+            parameters used by kahi that are not passed to the plugin
+        """
+        entry = entry or log_id
+        log_split = entry.split("/")
+        module_name = log_split[0]
+        task = log_split[1] if len(log_split) > 1 else None
+        params = interpolate(workflow[entry], where=entry)
+        reserved = {}
+        if isinstance(params, list):
+            if shard is not None:
+                params = [params[shard]]
+            for element in params:
+                element["task"] = task
+        else:
+            if params is None:
+                params = {}
+            if "task" in params and task is None:
+                task = params["task"]
+            for name in reserved_parameters:
+                if name in params:
+                    reserved[name] = params.pop(name)
+            params["task"] = task
+        plugin_config = dict(config)
+        plugin_config[module_name] = params
+        return cls(log_id, entry, shard, module_name, task, freeze(params), freeze(reserved),
+                   pickle.dumps(plugin_config, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def plugin_config(self):
+        """
+        Returns a new copy of the configuration passed to the plugin
+        """
+        return pickle.loads(self.data)
+
+    def to_document(self):
+        """
+        Returns the step as a document with plain values, to queue it in the database
+        """
+        return {
+            "log_id": self.log_id,
+            "entry": self.entry,
+            "shard": self.shard,
+            "module_name": self.module_name,
+            "task": self.task,
+            "params": thaw(self.params),
+            "reserved": thaw(self.reserved),
+            "config": self.plugin_config()
+        }
+
+    @classmethod
+    def from_document(cls, document):
+        """
+        Returns the StepConfig of a document returned by to_document
+        """
+        return cls(document["log_id"], document["entry"], document["shard"], document["module_name"],
+                   document["task"], freeze(document["params"]), freeze(document["reserved"]),
+                   pickle.dumps(document["config"], protocol=pickle.HIGHEST_PROTOCOL))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("StepConfig of {} can not be modified".format(self.log_id))
+
+    def __delattr__(self, name):
+        raise AttributeError("StepConfig of {} can not be modified".format(self.log_id))
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        return "StepConfig({})".format(self.log_id)
@@ -0,0 +1,138 @@
+from kahi.JobQueue import JobQueue
+from time import time, sleep
+import threading
+
+
+class Worker:
+    """
+    Runs the jobs of a JobQueue, one at a time, renewing the lease of the running job
+    every lease/3 seconds. Start several workers, on one or more hosts, to run the
+    steps of a workflow in parallel; see kahi_worker.
+    When the worker loses the lease of a job, ex: its heartbeats did not reach the
+    database in lease seconds and the job was queued again, the process of the step is
+    killed if the executor can terminate it (IsolatedExecutor), and the result or the
+    error of the step is not saved. Without an executor the step can not be stopped,
+    it runs until it finishes and its result is discarded.
+    """
+
+    def __init__(self, queue, function, executor=None, lease=300, poll_interval=2.0,
+                 max_jobs=None, idle_timeout=None, verbose=0):
+        """
+        Parameters:
+        ____________
+        queue:JobQueue
+            queue of the jobs
+        function:callable
+            function that runs a step with the arguments of JobQueue.call, ex: run_plugin
+        executor:executor
+            executor of the jobs, ex: IsolatedExecutor, None to run them in the worker process
+        lease:float
+            seconds the worker owns a job without a heartbeat
+        poll_interval:float
+            seconds to wait when the queue is empty
+        max_jobs:int
+            the worker stops after max_jobs jobs, None for no limit
+        idle_timeout:float
+            the worker stops after idle_timeout seconds without jobs, None to wait forever
+        verbose:int
+            verbosity level
+        """
+        self.queue = queue
+        self.function = function
+        self.executor = executor
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_jobs = max_jobs
+        self.idle_timeout = idle_timeout
+        self.verbose = verbose
+        self.id = JobQueue.worker_id()
+        self.stop = threading.Event()
+        self.jobs = 0
+
+    def heartbeat(self, job, done, lost, running):
+        while not done.wait(self.lease / 3):
+            try:
+                if not self.queue.heartbeat(job, self.id, self.lease):
+                    if self.verbose > 0:
+                        print("Worker {} lost the lease of job {}".format(self.id, job["_id"]))
+                    lost.set()
+                    self.terminate(running)
+                    return
+            except Exception as e:
+                # keep trying, the lease only expires after lease seconds
+                if self.verbose > 0:
+                    print("Heartbeat of job {} failed: {}".format(job["_id"], e))
+
+    def terminate(self, running):
+        """
+        Stops the step of a job that the worker lost, if the executor can terminate it
+        """
+        terminate = getattr(self.executor, "terminate", None)
+        if running and terminate is not None:
+            terminate(running[0], "worker {} lost the lease of the job".format(self.id))
+
+    def execute(self, job):
+        """
+        Runs a claimed job and saves its result or error in the queue
+        """
+        if self.verbose > 0:
+            print("Worker {} running {} (attempt {})".format(self.id, job["log_id"], job["attempts"]))
+        done = threading.Event()
+        lost = threading.Event()
+        # future of the step in the executor, to terminate it when the lease is lost
+        running = []
+        heartbeat = threading.Thread(
+            target=self.heartbeat, args=(job, done, lost, running), name="kahi-worker-heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            args = self.queue.call(job)
+            if self.executor is None:
+                result = self.function(*args)
+            else:
+                running.append(self.executor.submit(self.function, *args))
+                if lost.is_set():
+                    # the lease was lost while the step was submitted
+                    self.terminate(running)
+                result = running[0].result()
+        except Exception as e:
+            done.set()
+            heartbeat.join()
+            if lost.is_set() or not self.queue.fail(job, self.id, e):
+                if self.verbose > 0:
+                    print("Worker {}: {} lost, the error is discarded: {}".format(self.id, job["log_id"], e))
+                return
+            if self.verbose > 0:
+                print("Worker {}: {} failed: {}".format(self.id, job["log_id"], e))
+            return
+        done.set()
+        heartbeat.join()
+        if lost.is_set() or not self.queue.complete(job, self.id, result):
+            if self.verbose > 0:
+                print("Worker {}: {} lost, the result is discarded".format(self.id, job["log_id"]))
+            return
+        if self.verbose > 0:
+            print("Worker {}: {} finished".format(self.id, job["log_id"]))
+
+    def run(self):
+        """
+        Claims and runs jobs until stop is set, max_jobs jobs ran or the worker was idle
+        for idle_timeout seconds
+        """
+        idle_since = time()
+        try:
+            while not self.stop.is_set():
+                if self.max_jobs is not None and self.jobs >= self.max_jobs:
+                    break
+                job = self.queue.claim(self.id, self.lease)
+                if job is None:
+                    if self.idle_timeout is not None and time() - idle_since > self.idle_timeout:
+                        break
+                    sleep(self.poll_interval)
+                    continue
+                self.execute(job)
+                self.jobs += 1
+                idle_since = time()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+        return self.jobs
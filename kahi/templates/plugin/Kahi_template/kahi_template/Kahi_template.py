@@ -7,6 +7,8 @@ class Kahi_template(KahiBase):
 
     def __init__(self, config):
         self.config = config
+        # shared client for the database_url of the config section
+        # self.client = self.get_client()
 
     def run(self):
         # entry point for the execution of the plugin
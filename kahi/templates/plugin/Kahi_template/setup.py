@@ -82,6 +82,13 @@ def main():
         install_requires=[
             'kahi'
         ],
+
+        # Entry point used by kahi to find the plugin without importing it
+        entry_points={
+            'kahi.plugins': [
+                'template = kahi_template.Kahi_template:Kahi_template'
+            ]
+        },
     )
 
 
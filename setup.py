@@ -61,14 +61,14 @@ def main():
         author_email="colav@udea.edu.co",
 
         # Packages
-        packages=find_packages(exclude=['tests']),
+        packages=find_packages(exclude=['tests', 'benchmarks', 'benchmarks.*']),
 
         # Include additional files into the package
         include_package_data=True,
 
         # Details
         url="https://github.com/colav/Kahi",
-        scripts=['bin/kahi_run', 'bin/kahi_generate'],
+        scripts=['bin/kahi_run', 'bin/kahi_worker', 'bin/kahi_generate'],
 
         license="BSD",
 
@@ -84,6 +84,13 @@ def main():
             "pymongo"
         ],
         extras_require={
+            'blocking': [
+                'numpy'
+            ],
+            'bench': [
+                'mongomock',
+                'pymongo<4.11'
+            ],
             'all': [
                 'kahi_doaj_sources',
                 'kahi_minciencias_opendata_affiliations',